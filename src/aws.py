@@ -8,9 +8,21 @@ import shelve
 import sys
 import time
 import datetime
+import hashlib
 
 current_region = os.environ['AWS_REGION']
-boto_config = Config(retries=dict(max_attempts=10))
+boto_config = Config(retries=dict(max_attempts=10, mode='standard'))
+
+# error codes returned by AWS APIs when a caller is being throttled
+throttle_codes = [
+    'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'TooManyRequestsException', 'SlowDown', 'PriorRequestNotComplete'
+]
+
+
+class CarveThrottled(Exception):
+    ''' raised to the step function when an API call is still throttled after boto retries '''
+    pass
 
 aws_region_dict = {"us-east-1": "use1",
     "us-east-2": "use2",
@@ -57,10 +69,23 @@ def aws_assume_role(role_arn, session_name, token_life=900):
         assumed_role_object['Credentials']['Account'] = role_arn.split(':')[4]
         return assumed_role_object['Credentials'] 
     except ClientError as e:
+        if e.response['Error']['Code'] in throttle_codes:
+            aws_throttled(e, 'sts:AssumeRole', current_region, role_arn.split(':')[4])
         print(f'Failed to assume {role_arn}: {e}')
         sys.exit()
 
 
+def aws_throttled(e, api, region, account=None):
+    '''
+    report a throttled API call and raise it as CarveThrottled so the state machine can
+    retry it with backoff, any other ClientError is raised as is
+    '''
+    if e.response['Error']['Code'] in throttle_codes:
+        print(json.dumps({"throttle": api, "account": account, "region": region, "error": str(e)}))
+        raise CarveThrottled(f"{api} throttled in {account} {region}: {e}")
+    raise e
+
+
 
 def aws_current_account():
     sts = boto3.client('sts')
@@ -436,6 +461,27 @@ def aws_describe_transit_gateway_route_tables(region, credentials):
     return results
 
 
+def aws_search_transit_gateway_routes(route_table, region, credentials):
+    '''
+    return the active and blackhole routes of a transit gateway route table, and True when
+    the table has more than the 1000 routes one search returns
+    '''
+    client = boto3.client(
+        'ec2',
+        config=boto_config,
+        region_name=region,
+        aws_access_key_id = credentials['AccessKeyId'],
+        aws_secret_access_key = credentials['SecretAccessKey'],
+        aws_session_token = credentials['SessionToken']
+    )
+    response = client.search_transit_gateway_routes(
+        TransitGatewayRouteTableId=route_table,
+        Filters=[{'Name': 'state', 'Values': ['active', 'blackhole']}],
+        MaxResults=1000
+    )
+    return response['Routes'], response.get('AdditionalRoutesAvailable', False)
+
+
 # def aws_describe_transit_gateway_peering_attachments(tgw_id, region, credentials):
 #     client = boto3.client(
 #         'ec2',
@@ -600,6 +646,110 @@ def aws_find_stacks(startswith, account, region, credentials):
     return stacks
 
 
+def aws_describe_all_stacks(startswith, region, credentials=None):
+    ''' describe every active stack in an account/region with one paginated call, by stack name '''
+    if credentials is None:
+        client = boto3.client('cloudformation', config=boto_config, region_name=region)
+    else:
+        client = boto3.client(
+            'cloudformation',
+            config=boto_config,
+            region_name=region,
+            aws_access_key_id = credentials['AccessKeyId'],
+            aws_secret_access_key = credentials['SecretAccessKey'],
+            aws_session_token = credentials['SessionToken']
+            )
+
+    stacks = {}
+    paginator = client.get_paginator('describe_stacks')
+    for page in paginator.paginate():
+        for stack in page['Stacks']:
+            if stack['StackName'].startswith(startswith):
+                stacks[stack['StackName']] = stack
+
+    return stacks
+
+
+def aws_describe_stack_set(name):
+    # return a stack set description if it exists
+    client = boto3.client('cloudformation', config=boto_config, region_name=current_region)
+    try:
+        return client.describe_stack_set(StackSetName=name)['StackSet']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'StackSetNotFoundException':
+            return None
+        raise e
+
+
+def aws_put_stack_set(name, template, parameters, tags, preferences, exists):
+    '''
+    create a self managed stack set, or update the template and parameters of an existing one
+    and all its instances. stack sets are run by the carve stackset admin role, which deploys
+    thru the carve org role in each account. returns the operation id of an update, or None
+    '''
+    client = boto3.client('cloudformation', config=boto_config, region_name=current_region)
+    args = {
+        'StackSetName': name,
+        'TemplateBody': template,
+        'Parameters': parameters,
+        'Capabilities': ['CAPABILITY_NAMED_IAM'],
+        'Tags': tags,
+        'AdministrationRoleARN': f"arn:aws:iam::{aws_current_account()}:role/{os.environ['Prefix']}carve-stackset-admin",
+        'ExecutionRoleName': os.environ['OrgRoleName']
+    }
+    if not exists:
+        client.create_stack_set(**args)
+        return None
+    return client.update_stack_set(OperationPreferences=preferences, **args)['OperationId']
+
+
+def aws_list_stack_instances(name):
+    # return all instances of a stack set
+    client = boto3.client('cloudformation', config=boto_config, region_name=current_region)
+    instances = []
+    paginator = client.get_paginator('list_stack_instances')
+    for page in paginator.paginate(StackSetName=name):
+        instances.extend(page['Summaries'])
+    return instances
+
+
+def aws_stack_instances(name, action, accounts, regions, preferences, overrides=[]):
+    '''
+    create, update or delete the instances of a stack set in accounts x regions,
+    returns the operation id
+    '''
+    client = boto3.client('cloudformation', config=boto_config, region_name=current_region)
+    args = {
+        'StackSetName': name,
+        'Accounts': accounts,
+        'Regions': regions,
+        'OperationPreferences': preferences
+    }
+    if action == 'create':
+        response = client.create_stack_instances(ParameterOverrides=overrides, **args)
+    elif action == 'update':
+        response = client.update_stack_instances(ParameterOverrides=overrides, **args)
+    else:
+        response = client.delete_stack_instances(RetainStacks=False, **args)
+    return response['OperationId']
+
+
+def aws_import_stacks_to_stack_set(name, stack_ids, preferences):
+    # import existing stacks as instances of a self managed stack set, returns the operation id
+    client = boto3.client('cloudformation', config=boto_config, region_name=current_region)
+    response = client.import_stacks_to_stack_set(
+        StackSetName=name,
+        StackIds=stack_ids,
+        OperationPreferences=preferences)
+    return response['OperationId']
+
+
+def aws_describe_stack_set_operation(name, operation_id):
+    client = boto3.client('cloudformation', config=boto_config, region_name=current_region)
+    response = client.describe_stack_set_operation(StackSetName=name, OperationId=operation_id)
+    return response['StackSetOperation']
+
+
 def aws_describe_asg(asg, region, credentials):
     client = boto3.client(
         'autoscaling',
@@ -655,6 +805,17 @@ def aws_read_s3_direct(key):
         return None
 
 
+def aws_read_s3_binary(key):
+    # read an object from S3 without decoding it
+    resource = boto3.resource('s3', config=boto_config)
+    try:
+        obj = resource.Object(os.environ['CarveS3Bucket'], key)
+        return obj.get()['Body'].read()
+    except ClientError as e:
+        print(f"error reading s3: {e}")
+        return None
+
+
 def aws_put_direct(data, key, bucket=os.environ['CarveS3Bucket']):
     client = boto3.client('s3', config=boto_config)
     try:
@@ -668,12 +829,41 @@ def aws_put_direct(data, key, bucket=os.environ['CarveS3Bucket']):
         return None
 
 
+def aws_put_if_changed(data, key, bucket=os.environ['CarveS3Bucket']):
+    '''
+    put an object unless the object in s3 already has the same content, using a sha256 of the
+    content stored in the object metadata. data can be str or bytes. returns True if the
+    object was written
+    '''
+    client = boto3.client('s3', config=boto_config)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()
+    try:
+        head = client.head_object(Bucket=bucket, Key=key)
+        if head['Metadata'].get('content-sha256') == digest:
+            return False
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ['404', 'NoSuchKey', 'NotFound']:
+            print(f"error reading s3 object head: {e}")
+    try:
+        client.put_object(
+            Bucket=bucket,
+            Body=data,
+            Key=key,
+            Metadata={'content-sha256': digest})
+        return True
+    except ClientError as e:
+        print(f"error writing to s3: {e}")
+        return None
+
+
 def aws_s3_list_objects(prefix='', bucket=os.environ['CarveS3Bucket']):
     keys = []
     client = boto3.client('s3', config=boto_config)
     paginator = client.get_paginator('list_objects_v2')
     for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-        for key in page['Contents']:
+        for key in page.get('Contents', []):
             keys.append(key['Key'])
     return(keys)
 
@@ -825,6 +1015,62 @@ def aws_copy_image(name, source_image, region):
     return {"ImageId": response['ImageId'], "region": region}
 
 
+def aws_run_builder_instance(image, subnet, user_data, tags, region=current_region):
+    # launch an instance that builds an image and stops itself, returns the instance id
+    client = boto3.client('ec2', region_name=region, config=boto_config)
+    response = client.run_instances(
+        ImageId=image,
+        InstanceType='t3.micro',
+        MinCount=1,
+        MaxCount=1,
+        SubnetId=subnet,
+        UserData=user_data,
+        InstanceInitiatedShutdownBehavior='stop',
+        TagSpecifications=[{'ResourceType': 'instance', 'Tags': tags}]
+    )
+    return response['Instances'][0]['InstanceId']
+
+
+def aws_instance_state(instance, region=current_region):
+    # return the state name of an instance, or None if it does not exist
+    client = boto3.client('ec2', region_name=region, config=boto_config)
+    try:
+        response = client.describe_instances(InstanceIds=[instance])
+        return response['Reservations'][0]['Instances'][0]['State']['Name']
+    except (ClientError, IndexError):
+        return None
+
+
+def aws_terminate_instance(instance, region=current_region):
+    client = boto3.client('ec2', region_name=region, config=boto_config)
+    client.terminate_instances(InstanceIds=[instance])
+
+
+def aws_create_image(instance, name, tags, region=current_region):
+    # create an image from a stopped instance, returns the image id
+    client = boto3.client('ec2', region_name=region, config=boto_config)
+    response = client.create_image(
+        InstanceId=instance,
+        Name=name,
+        Description='Carve beacon AMI',
+        NoReboot=True,
+        TagSpecifications=[
+            {'ResourceType': 'image', 'Tags': tags},
+            {'ResourceType': 'snapshot', 'Tags': tags}
+        ]
+    )
+    return response['ImageId']
+
+
+def aws_default_subnet(region=current_region):
+    # return a default subnet in a region, or None if the region has no default VPC
+    client = boto3.client('ec2', region_name=region, config=boto_config)
+    response = client.describe_subnets(Filters=[{'Name': 'default-for-az', 'Values': ['true']}])
+    if len(response['Subnets']) == 0:
+        return None
+    return response['Subnets'][0]['SubnetId']
+
+
 def aws_describe_image(image, region=current_region):
     client = boto3.client('ec2', config=boto_config, region_name=region)
     response = client.describe_images(ImageIds=[image])
@@ -929,6 +1175,61 @@ def aws_invoke_lambda(arn, payload, credentials=None):
     return data
 
 
+def aws_lambda_concurrency(region, credentials=None):
+    # return the unreserved concurrent executions of an account/region, or None if it can't be read
+    if credentials is None:
+        client = boto3.client('lambda', config=boto_config, region_name=region)
+    else:
+        client = boto3.client(
+            'lambda',
+            config=boto_config,
+            region_name=region,
+            aws_access_key_id = credentials['AccessKeyId'],
+            aws_secret_access_key = credentials['SecretAccessKey'],
+            aws_session_token = credentials['SessionToken']
+            )
+    try:
+        return client.get_account_settings()['AccountLimit']['UnreservedConcurrentExecutions']
+    except ClientError as e:
+        print(f"cannot read lambda account settings in {region}: {e}")
+        return None
+
+
+def aws_get_function(name, region, credentials):
+    # return the configuration and code location of a lambda function
+    client = boto3.client(
+        'lambda',
+        config=boto_config,
+        region_name=region,
+        aws_access_key_id = credentials['AccessKeyId'],
+        aws_secret_access_key = credentials['SecretAccessKey'],
+        aws_session_token = credentials['SessionToken']
+        )
+    return client.get_function(FunctionName=name)
+
+
+def aws_update_function_code(name, region, credentials, s3_bucket=None, s3_key=None, zip_file=None):
+    '''
+    update the code of a lambda function from an S3 artifact or zip bytes, and wait for the
+    update to finish. returns the function configuration after the update
+    '''
+    client = boto3.client(
+        'lambda',
+        config=boto_config,
+        region_name=region,
+        aws_access_key_id = credentials['AccessKeyId'],
+        aws_secret_access_key = credentials['SecretAccessKey'],
+        aws_session_token = credentials['SessionToken']
+        )
+    if zip_file is not None:
+        client.update_function_code(FunctionName=name, ZipFile=zip_file)
+    else:
+        client.update_function_code(FunctionName=name, S3Bucket=s3_bucket, S3Key=s3_key)
+    waiter = client.get_waiter('function_updated')
+    waiter.wait(FunctionName=name, WaiterConfig={'Delay': 2, 'MaxAttempts': 60})
+    return client.get_function_configuration(FunctionName=name)
+
+
 def schedule_cron(minutes):
     # return cron fields for a schedule for a self-invocation in 'minutes'
     now = datetime.datetime.now()
@@ -964,9 +1265,9 @@ def aws_delete_rule(name):
     return response
 
 
-def aws_update_tags(resource: str, tags: dict):
-    # return all images created by carve in a region
-    client = boto3.client('ec2', config=boto_config, region_name=current_region)
+def aws_update_tags(resource: str, tags: dict, region=current_region):
+    # add tags to an ec2 resource
+    client = boto3.client('ec2', config=boto_config, region_name=region)
     response = client.create_tags(Resources=[resource], Tags=tags)
     return response
 
@@ -985,13 +1286,21 @@ def aws_describe_all_carve_images(region):
 
 
 def aws_deregister_image(image, region):
-    client = boto3.resource('ec2', config=boto_config, region_name=region)
-    response = client.deregister_image(ImageId=image)
+    client = boto3.client('ec2', config=boto_config, region_name=region)
+    client.deregister_image(ImageId=image)
 
 
 def aws_delete_snapshot(snapshot, region):
-    client = boto3.resource('ec2', config=boto_config, region_name=region)
-    response = client.delete_snapshot(SnapshotId=snapshot)
+    # delete a snapshot, returns False if it is still in use by another image
+    client = boto3.client('ec2', config=boto_config, region_name=region)
+    try:
+        client.delete_snapshot(SnapshotId=snapshot)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'InvalidSnapshot.InUse':
+            print(f"snapshot {snapshot} in {region} is still in use: {e}")
+            return False
+        raise e
+    return True
 
 
 # def aws_invoke_self(arn, payload):
@@ -1046,6 +1355,40 @@ def aws_describe_peers(region, credentials):
     return pcxs
 
 
+def aws_describe_route_tables(region, credentials):
+    client = boto3.client(
+        'ec2',
+        config=boto_config,
+        region_name=region,
+        aws_access_key_id = credentials['AccessKeyId'],
+        aws_secret_access_key = credentials['SecretAccessKey'],
+        aws_session_token = credentials['SessionToken']
+        )
+
+    paginator = client.get_paginator('describe_route_tables')
+    tables = []
+    for page in paginator.paginate():
+        tables.extend(page['RouteTables'])
+    return tables
+
+
+def aws_describe_network_acls(region, credentials):
+    client = boto3.client(
+        'ec2',
+        config=boto_config,
+        region_name=region,
+        aws_access_key_id = credentials['AccessKeyId'],
+        aws_secret_access_key = credentials['SecretAccessKey'],
+        aws_session_token = credentials['SessionToken']
+        )
+
+    paginator = client.get_paginator('describe_network_acls')
+    acls = []
+    for page in paginator.paginate():
+        acls.extend(page['NetworkAcls'])
+    return acls
+
+
 def aws_describe_availability_zones(region):
     client = boto3.client(
         'ec2',
@@ -0,0 +1,228 @@
+import lambdavars
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from aws import (aws_copy_image, aws_create_image, aws_default_subnet, aws_delete_snapshot,
+                 aws_deregister_image, aws_describe_all_carve_images, aws_describe_image,
+                 aws_describe_stack,
+                 aws_discover_org_accounts, aws_instance_state, aws_run_builder_instance,
+                 aws_share_image, aws_ssm_get_parameter, aws_ssm_put_parameter,
+                 aws_terminate_instance, aws_update_tags, current_region)
+from privatelink import beacon_image_parameter, for_each_region
+from utils import get_deploy_key, load_graph, unique_node_values
+
+'''
+prebaked beacon image pipeline
+
+the private link beacon instances boot from an image with nginx and the SSM agent already
+installed, so a replaced instance passes the /up health check without package downloads.
+the pipeline is run by the beacon image state machine, which calls this lambda until the
+Step is done:
+ - launch: start a builder instance from the Amazon Linux image with beacon-image.sh
+ - building: wait for the builder to power off, then create the image
+ - imaging: wait for the image, then copy it to every deploy region in parallel
+ - replicating: wait for the copies, share them with the org, point the beacon image SSM
+   parameter in each region at them, and remove old versions that nothing uses
+the private link templates read the image id from the SSM parameter. a build that runs
+longer than BeaconImageMaxMinutes (default 60) fails, and the state machine catches any
+failure and calls this lambda with Abort to terminate the builder instance.
+'''
+
+base_image_parameter = "/aws/service/ami-amazon-linux-latest/amzn2-ami-minimal-hvm-x86_64-ebs"
+build_script = f"{os.path.dirname(__file__)}/managed_deployment/beacon-image.sh"
+
+
+class BeaconImageTimeout(Exception):
+    ''' raised to the step function when a build runs past BeaconImageMaxMinutes '''
+    pass
+
+
+def image_tags(version):
+    return [
+        {'Key': 'Name', 'Value': f"{os.environ['Prefix']}carve-beacon-{version}"},
+        {'Key': 'carve-image-version', 'Value': str(version)}
+    ]
+
+
+def deploy_regions():
+    # regions of the last deployed graph, the image is always built in the current region
+    regions = set([current_region])
+    deploy_key = get_deploy_key(last=True)
+    if deploy_key is not None:
+        regions.update(unique_node_values(load_graph(deploy_key, local=False), 'Region'))
+    return sorted(regions)
+
+
+def launch(state):
+    subnet = os.environ.get('BeaconImageSubnet', '') or aws_default_subnet()
+    if subnet is None:
+        raise Exception(f"no BeaconImageSubnet set and no default subnet in {current_region} to build the beacon image")
+    with open(build_script) as f:
+        user_data = f.read()
+    image = aws_ssm_get_parameter(base_image_parameter)
+    state['Version'] = int(time.time())
+    state['Started'] = state['Version']
+    state['Instance'] = aws_run_builder_instance(image, subnet, user_data, image_tags(state['Version']))
+    state['Step'] = 'building'
+    print(f"launched beacon image builder {state['Instance']} from {image} in {subnet}")
+    return state
+
+
+def building(state):
+    instance_state = aws_instance_state(state['Instance'])
+    if instance_state in ['pending', 'running', 'stopping', 'shutting-down']:
+        return state
+    if instance_state != 'stopped':
+        raise Exception(f"beacon image builder {state['Instance']} is {instance_state}")
+    name = f"{os.environ['Prefix']}carve-beacon-{state['Version']}"
+    state['Images'] = {current_region: aws_create_image(state['Instance'], name, image_tags(state['Version']))}
+    state['Step'] = 'imaging'
+    print(f"creating beacon image {state['Images'][current_region]} from {state['Instance']}")
+    return state
+
+
+def copy_thread(region, source, version):
+    image = aws_copy_image(f"{os.environ['Prefix']}carve-beacon-{version}", source, region)['ImageId']
+    aws_update_tags(image, image_tags(version), region)
+    return image
+
+
+def imaging(state):
+    source = state['Images'][current_region]
+    image = aws_describe_image(source)
+    if image is None or image['State'] == 'pending':
+        return state
+    if image['State'] != 'available':
+        raise Exception(f"beacon image {source} is {image['State']}")
+    aws_terminate_instance(state['Instance'])
+
+    regions = [r for r in deploy_regions() if r != current_region]
+    state['Images'].update(for_each_region(copy_thread, regions, source, state['Version']))
+    state['Step'] = 'replicating'
+    print(f"copying beacon image {source} to {len(regions)} regions")
+    return state
+
+
+def publish_thread(region, images, accounts):
+    # share the image and point the region's beacon image parameter at it
+    aws_share_image(images[region], accounts, region)
+    aws_ssm_put_parameter(beacon_image_parameter(), images[region], region)
+    return images[region]
+
+
+def images_in_use(region):
+    '''
+    the beacon images in use in a region: the image of the SSM parameter, and the image the
+    private link stack resolved the parameter to when it was last deployed, which its
+    beacon instances run until the stack is deployed again
+    '''
+    in_use = set([aws_ssm_get_parameter(beacon_image_parameter(), region)])
+    stack = aws_describe_stack(f"{os.environ['Prefix']}carve-managed-privatelink-{region}", region)
+    if stack is not None:
+        for parameter in stack.get('Parameters', []):
+            if parameter['ParameterKey'] == 'ImageId':
+                in_use.add(parameter.get('ResolvedValue', parameter['ParameterValue']))
+    return in_use
+
+
+def remove_old_images(region, keep):
+    '''
+    deregister the carve beacon images in a region that are older than the newest keep
+    images and not in use, and delete their snapshots. an image that can't be removed is
+    left for the next build
+    '''
+    prefix = f"{os.environ['Prefix']}carve-beacon-"
+    images = [i for i in aws_describe_all_carve_images(region)['Images'] if i['Name'].startswith(prefix)]
+    images.sort(key=lambda i: i['CreationDate'], reverse=True)
+    in_use = images_in_use(region)
+    removed = 0
+    for image in images[keep:]:
+        if image['ImageId'] in in_use:
+            print(f"keeping old beacon image {image['ImageId']} in {region}, it is still in use")
+            continue
+        try:
+            aws_deregister_image(image['ImageId'], region)
+            for device in image.get('BlockDeviceMappings', []):
+                if 'Ebs' in device and 'SnapshotId' in device['Ebs']:
+                    aws_delete_snapshot(device['Ebs']['SnapshotId'], region)
+        except ClientError as e:
+            print(f"cannot remove old beacon image {image['ImageId']} from {region}: {e}")
+            continue
+        print(f"removed old beacon image {image['ImageId']} from {region}")
+        removed += 1
+    return removed
+
+
+def replicating(state):
+    pending = []
+    for region, image_id in state['Images'].items():
+        image = aws_describe_image(image_id, region)
+        if image is None or image['State'] == 'pending':
+            pending.append(region)
+        elif image['State'] != 'available':
+            raise Exception(f"beacon image {image_id} is {image['State']} in {region}")
+    if len(pending) > 0:
+        print(f"waiting on beacon image copies in {pending}")
+        return state
+
+    accounts = list(aws_discover_org_accounts().keys())
+    images = state['Images']
+    for_each_region(publish_thread, sorted(images), images, accounts)
+
+    keep = max(1, int(os.environ.get('BeaconImageKeep', 2)))
+    for_each_region(remove_old_images, sorted(images), keep)
+
+    state['Step'] = 'done'
+    print(f"beacon image version {state['Version']} published in {len(images)} regions")
+    return state
+
+
+def abort(state):
+    # terminate the builder instance of a failed build, its images are removed once unused
+    if state.get('Instance') is not None:
+        aws_terminate_instance(state['Instance'])
+        print(f"terminated beacon image builder {state['Instance']}")
+    state['Step'] = 'aborted'
+    return state
+
+
+steps = {
+    'launch': launch,
+    'building': building,
+    'imaging': imaging,
+    'replicating': replicating
+}
+
+
+def lambda_handler(event, context):
+    '''
+    advance the beacon image pipeline by one step
+    event = {'Input': {'Step': step, ...state from the last call}}, an empty input starts a build
+    event = {'Input': {...state}, 'Abort': true} cleans up after a failed build
+    '''
+    # the payload structure changes if this is called after a task state vs a choice state
+    state = (event or {}).get('Input', {})
+    if 'Payload' in state:
+        state = state['Payload']
+    state = dict(state)
+    state.setdefault('Step', 'launch')
+
+    if (event or {}).get('Abort', False):
+        return json.dumps(abort(state), default=str)
+
+    limit = float(os.environ.get('BeaconImageMaxMinutes', 60)) * 60
+    if 'Started' in state and time.time() - state['Started'] > limit:
+        raise BeaconImageTimeout(f"beacon image build {state['Version']} ran longer than {limit / 60:.0f} minutes in step {state['Step']}")
+
+    state = steps[state['Step']](state)
+    state['Complete'] = state['Step'] == 'done'
+
+    # return json to step function
+    return json.dumps(state, default=str)
+
+
+if __name__ == '__main__':
+    print(lambda_handler({'Input': {}}, lambdavars.lambda_context))
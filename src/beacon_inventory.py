@@ -0,0 +1,59 @@
+import hashlib
+import json
+
+from aws import aws_put_direct, aws_read_s3_direct
+
+'''
+versioned beacon inventory
+
+the inventory maps each beacon (subnet id or external target) to its type and address.
+it is written in three forms:
+ - beacon-inventory.json: the beacons, indented for people
+ - beacon-inventory.min.json: {'Version', 'Hash', 'Beacons'} minified, for machine readers
+ - beacon-inventory.version.json: {'Version', 'Hash'} so readers can tell if anything changed
+the version increases by one each time the content hash changes.
+'''
+
+inventory_key = "managed_deployment/beacon-inventory.json"
+compact_key = "managed_deployment/beacon-inventory.min.json"
+version_key = "managed_deployment/beacon-inventory.version.json"
+
+
+def inventory_hash(beacons):
+    data = json.dumps(beacons, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def inventory_version():
+    ''' return {'Version', 'Hash'} of the current inventory, version 0 if there is none '''
+    data = aws_read_s3_direct(version_key)
+    if data is None:
+        return {'Version': 0, 'Hash': None}
+    return json.loads(data)
+
+
+def load_inventory():
+    ''' return {'Version', 'Hash', 'Beacons'}, from the compact form when it exists '''
+    data = aws_read_s3_direct(compact_key)
+    if data is not None:
+        return json.loads(data)
+    data = aws_read_s3_direct(inventory_key)
+    beacons = {} if data is None else json.loads(data)
+    return {'Version': 0, 'Hash': inventory_hash(beacons), 'Beacons': beacons}
+
+
+def save_inventory(beacons, previous):
+    ''' write the inventory if its content changed since previous, returns the new version '''
+    content_hash = inventory_hash(beacons)
+    if previous is not None and previous['Hash'] == content_hash and previous['Version'] > 0:
+        print(f"beacon inventory unchanged at version {previous['Version']}")
+        return previous['Version']
+
+    version = (previous or {'Version': 0})['Version'] + 1
+    compact = {'Version': version, 'Hash': content_hash, 'Beacons': beacons}
+    aws_put_direct(json.dumps(compact, sort_keys=True, separators=(',', ':')), compact_key)
+    aws_put_direct(json.dumps(beacons, ensure_ascii=True, indent=2, sort_keys=True), inventory_key)
+    # the version object is written last, readers that see it can read the new inventory
+    aws_put_direct(json.dumps({'Version': version, 'Hash': content_hash}), version_key)
+    print(f"beacon inventory version {version}: {len(beacons)} beacons")
+    return version
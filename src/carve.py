@@ -31,8 +31,8 @@ def lambda_handler(event, context):
 
             print(f"running carve route verification")
 
-            # verify current routes for deployed graph
-            current_routes = verify_routing()
+            # verify the scheduled slice of routes for deployed graph
+            current_routes = verify_routing(scheduled=True)
 
             # load the verification results as a graph
             V = json_graph.node_link_graph(current_routes)
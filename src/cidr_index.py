@@ -0,0 +1,190 @@
+import ipaddress
+import json
+
+from aws import aws_put_direct, aws_read_s3_direct
+
+'''
+CIDR prefix trie index
+
+network discovery finalize builds a binary prefix trie of the VPC CIDR blocks, primary and
+secondary, and the subnet CIDR blocks of the discovered graph, and saves the index next to the discovered graph. walking the trie
+once finds every overlapping pair of CIDRs without comparing all pairs, and an address is
+mapped to its subnet, and the VPC and VPC CIDR of that subnet, by a longest prefix match
+walk of at most 32 bits (128 for IPv6). when prefixes of more than one VPC hold the address,
+the lookup lists the other subnets or VPCs as Ambiguous.
+ - overlaps: VPC CIDR blocks of different VPCs that overlap. these VPCs can't route to each
+   other, and are the most common cause of routing failures
+ - conflicts: subnet CIDR blocks of different VPCs that overlap, an address in them belongs
+   to more than one subnet
+
+index = {
+    'Graph': discovered graph key,
+    'Vpcs': [[cidr, VpcId]],
+    'Subnets': [[cidr, subnet, VpcId, VPC cidr holding the subnet]],
+    'Overlaps': [[cidr, VpcId, cidr, VpcId]],
+    'Conflicts': [[cidr, subnet, cidr, subnet]]
+}
+'''
+
+
+def trie_node():
+    # [zero child, one child, entries ending at this prefix]
+    return [None, None, []]
+
+
+def insert(trie, cidr, entry):
+    ''' add entry for cidr to a trie {ip version: root node} '''
+    net = ipaddress.ip_network(cidr, strict=False)
+    node = trie.setdefault(net.version, trie_node())
+    address = int(net.network_address)
+    for i in range(net.prefixlen):
+        bit = (address >> (net.max_prefixlen - 1 - i)) & 1
+        if node[bit] is None:
+            node[bit] = trie_node()
+        node = node[bit]
+    node[2].append(entry)
+
+
+def build_trie(rows):
+    ''' build a trie from [[cidr, ...]] rows, each row is the entry for its cidr '''
+    trie = {}
+    for row in rows:
+        insert(trie, row[0], row)
+    return trie
+
+
+def matches(trie, ip):
+    ''' return the entries of every prefix containing ip, shortest prefix first '''
+    address = ipaddress.ip_address(ip)
+    node = trie.get(address.version)
+    value = int(address)
+    found = []
+    i = 0
+    while node is not None:
+        found.append(node[2])
+        if i == address.max_prefixlen:
+            break
+        node = node[(value >> (address.max_prefixlen - 1 - i)) & 1]
+        i += 1
+    return [entries for entries in found if len(entries) > 0]
+
+
+def longest_match(trie, ip):
+    ''' return the entries of the longest prefix containing ip, or [] '''
+    found = matches(trie, ip)
+    return found[-1] if len(found) > 0 else []
+
+
+def overlapping_pairs(trie):
+    '''
+    return every pair of entries whose prefixes overlap. two prefixes overlap when one is on
+    the path to the other, so a depth first walk pairs each entry with the entries above it
+    '''
+    pairs = []
+    for root in trie.values():
+        stack = [(root, [])]
+        while len(stack) > 0:
+            node, above = stack.pop()
+            for i, entry in enumerate(node[2]):
+                for other in above + node[2][:i]:
+                    pairs.append((other, entry))
+            if len(node[2]) > 0:
+                above = above + node[2]
+            for child in node[:2]:
+                if child is not None:
+                    stack.append((child, above))
+    return pairs
+
+
+def vpc_block(blocks, subnet_cidr):
+    # the VPC CIDR block a subnet was created in
+    net = ipaddress.ip_network(subnet_cidr, strict=False)
+    for block in blocks:
+        vpc = ipaddress.ip_network(block, strict=False)
+        if vpc.version == net.version and net.subnet_of(vpc):
+            return block
+    return None
+
+
+def build_cidr_index(G, graph_key=None):
+    ''' build the CIDR index of the subnets in graph G '''
+    vpcs = {}
+    subnets = []
+    for subnet, data in sorted(G.nodes(data=True)):
+        if data.get('Type') != 'managed':
+            continue
+        blocks = data.get('CidrBlocks', [data['CidrBlock']] if data.get('CidrBlock') is not None else [])
+        vpcs[data['VpcId']] = blocks
+        if data.get('SubnetCidrBlock') is not None:
+            subnets.append([data['SubnetCidrBlock'], subnet, data['VpcId'], vpc_block(blocks, data['SubnetCidrBlock'])])
+    vpc_rows = sorted([[cidr, vpc] for vpc, blocks in vpcs.items() for cidr in blocks])
+
+    overlaps = []
+    for a, b in overlapping_pairs(build_trie(vpc_rows)):
+        if a[1] != b[1]:
+            overlaps.append(a + b)
+
+    conflicts = []
+    for a, b in overlapping_pairs(build_trie(subnets)):
+        if a[2] != b[2]:
+            conflicts.append(a[:2] + b[:2])
+
+    print(f"cidr index: {len(vpcs)} VPCs with {len(vpc_rows)} CIDRs, {len(subnets)} subnets, {len(overlaps)} VPC overlaps, {len(conflicts)} subnet conflicts")
+    return {
+        'Graph': graph_key,
+        'Vpcs': vpc_rows,
+        'Subnets': subnets,
+        'Overlaps': sorted(overlaps),
+        'Conflicts': sorted(conflicts)
+    }
+
+
+def cidr_index_key(graph_key):
+    # the index of a discovered graph is saved next to it
+    return graph_key.replace('.json', '-cidr-index.json')
+
+
+def save_cidr_index(index, key):
+    aws_put_direct(json.dumps(index, sort_keys=True), key)
+
+
+def load_cidr_index(key):
+    ''' load a saved index and build its tries, returns None if the index does not exist '''
+    data = aws_read_s3_direct(key)
+    if data is None:
+        return None
+    index = json.loads(data)
+    index['VpcTrie'] = build_trie(index['Vpcs'])
+    index['SubnetTrie'] = build_trie(index['Subnets'])
+    return index
+
+
+def lookup(index, ip):
+    '''
+    return {'Subnet', 'SubnetCidr', 'VpcId', 'VpcCidr', 'Ambiguous'} for the owner of ip.
+    the owner is the subnet of the longest matching subnet prefix, with the VPC of that
+    subnet, or the VPC of the longest matching VPC prefix when no subnet holds ip. Ambiguous
+    lists the other subnets, or VPCs, of any VPC that also holds ip. values are None when
+    not found
+    '''
+    result = {'Subnet': None, 'SubnetCidr': None, 'VpcId': None, 'VpcCidr': None, 'Ambiguous': []}
+    subnets = [row for entries in matches(index['SubnetTrie'], ip) for row in entries]
+    if len(subnets) > 0:
+        best = subnets[-1]
+        result.update({'Subnet': best[1], 'SubnetCidr': best[0], 'VpcId': best[2], 'VpcCidr': best[3]})
+        result['Ambiguous'] = sorted(set([row[1] for row in subnets if row[2] != best[2]]))
+        return result
+
+    vpcs = [row for entries in matches(index['VpcTrie'], ip) for row in entries]
+    if len(vpcs) > 0:
+        best = vpcs[-1]
+        result.update({'VpcId': best[1], 'VpcCidr': best[0]})
+        result['Ambiguous'] = sorted(set([row[1] for row in vpcs if row[1] != best[1]]))
+    return result
+
+
+if __name__ == '__main__':
+    import sys
+    index = load_cidr_index(sys.argv[1])
+    for ip in sys.argv[2:]:
+        print(ip, lookup(index, ip))
@@ -0,0 +1,203 @@
+import concurrent.futures
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectTimeoutError, ReadTimeoutError
+
+from aws import (CarveThrottled, aws_lambda_concurrency, aws_put_direct, aws_read_s3_direct,
+                 throttle_codes)
+
+'''
+adaptive concurrency limits for fan-out thread pools
+
+a limiter holds an AIMD (additive increase, multiplicative decrease) limit of in-flight calls
+for each key, usually an (account, region) pair. executor threads hold a slot of their key
+for the duration of an API call:
+ - a call that succeeds without being slow raises the limit by 1/limit, about one more
+   in-flight call per round of calls
+ - a throttled call, a timeout, or a call slower than slow_factor times the average latency
+   of the key halves the limit, at most once per round of calls
+ - the limit stays between minimum and the cap of its key. verification caps each
+   account/region at half of its unreserved Lambda concurrent executions
+ - a call that waits for a slot past its deadline raises LimiterTimeout
+the limits a limiter ends with are saved in the carve s3 bucket, one object per limiter
+name, and are where the next run of the same limiter starts. every limiter reports the
+limits it chose when it finishes.
+'''
+
+limits_prefix = "managed_deployment/concurrency-limits"
+caps_seconds = 86400
+
+
+class LimiterTimeout(Exception):
+    ''' raised when a call waits for a limiter slot past its deadline '''
+    pass
+
+
+class AdaptiveLimiter:
+
+    def __init__(self, name, initial=10, minimum=1, maximum=1000, slow_factor=3):
+        self.name = name
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.slow_factor = slow_factor
+        self.keys = {}
+        self.caps = {}
+        self.condition = threading.Condition()
+        self.saved = load_limits(name)
+
+    def state(self, key):
+        # the limit of a key, started from the last saved limit
+        label = key_label(key)
+        if label not in self.keys:
+            limit = self.saved.get('Limits', {}).get(label, self.initial)
+            self.keys[label] = {
+                'Limit': float(max(self.minimum, min(limit, self.cap(key)))),
+                'InFlight': 0,
+                'Latency': None,
+                'Started': 0,
+                'Decreased': -1,
+                'Throttles': 0,
+                'Calls': 0
+            }
+        return self.keys[label]
+
+    def cap(self, key):
+        return min(self.maximum, self.caps.get(key_label(key), self.maximum))
+
+    def set_cap(self, key, cap):
+        with self.condition:
+            self.caps[key_label(key)] = cap
+            state = self.state(key)
+            state['Limit'] = min(state['Limit'], cap)
+
+    def acquire(self, key, deadline=None):
+        with self.condition:
+            state = self.state(key)
+            while state['InFlight'] >= int(state['Limit']):
+                if deadline is not None and time.time() >= deadline:
+                    raise LimiterTimeout(f"no {self.name} slot for {key_label(key)} before the deadline")
+                self.condition.wait(None if deadline is None else deadline - time.time())
+            state['InFlight'] += 1
+            state['Started'] += 1
+            return state['Started']
+
+    def release(self, key, ticket, latency, congested):
+        with self.condition:
+            state = self.state(key)
+            state['InFlight'] -= 1
+            state['Calls'] += 1
+            slow = state['Latency'] is not None and latency > state['Latency'] * self.slow_factor
+            if congested or slow:
+                # halve once per round, calls started before the last decrease don't count
+                if ticket > state['Decreased']:
+                    state['Limit'] = max(self.minimum, state['Limit'] / 2)
+                    state['Decreased'] = state['Started']
+                state['Throttles'] += 1 if congested else 0
+            else:
+                state['Limit'] = min(self.cap(key), state['Limit'] + 1 / state['Limit'])
+            if not congested:
+                state['Latency'] = latency if state['Latency'] is None else 0.8 * state['Latency'] + 0.2 * latency
+            self.condition.notify_all()
+
+    def slot(self, key, deadline=None):
+        return LimiterSlot(self, key, deadline)
+
+    def report(self):
+        ''' print and save the limit chosen for each key '''
+        limits = {label: round(state['Limit'], 1) for label, state in self.keys.items()}
+        throttles = sum([s['Throttles'] for s in self.keys.values()])
+        calls = sum([s['Calls'] for s in self.keys.values()])
+        print(f"concurrency {self.name}: {calls} calls, {throttles} throttled, limits {limits}")
+        save_limits(self.name, limits, self.caps, self.saved)
+        return limits
+
+
+class LimiterSlot:
+    ''' context manager holding a limiter slot for one call '''
+
+    def __init__(self, limiter, key, deadline=None):
+        self.limiter = limiter
+        self.key = key
+        self.deadline = deadline
+
+    def __enter__(self):
+        self.ticket = self.limiter.acquire(self.key, self.deadline)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.limiter.release(self.key, self.ticket, time.time() - self.start, congestion(exc))
+        return False
+
+
+def congestion(exc):
+    # true for throttles and timeouts
+    if exc is None:
+        return False
+    if isinstance(exc, (CarveThrottled, ConnectTimeoutError, ReadTimeoutError)):
+        return True
+    if isinstance(exc, ClientError):
+        return exc.response['Error']['Code'] in throttle_codes
+    return False
+
+
+def key_label(key):
+    return '/'.join(key) if isinstance(key, tuple) else str(key)
+
+
+def limits_key(name):
+    return f"{limits_prefix}/{name}.json"
+
+
+def load_limits(name):
+    ''' return the saved {'Limits', 'Caps'} of a limiter '''
+    data = aws_read_s3_direct(limits_key(name))
+    if data is None:
+        return {}
+    return json.loads(data)
+
+
+def save_limits(name, limits, caps, saved):
+    # limits of keys this run didn't use are kept, caps are kept for a day
+    now = int(time.time())
+    current = load_limits(name)
+    entry = {'Limits': dict(current.get('Limits', {}), **limits)}
+    entry['Caps'] = dict(current.get('Caps', {}), **saved.get('Caps', {}))
+    entry['Caps'] = {label: cap for label, cap in entry['Caps'].items() if now - cap['Time'] < caps_seconds}
+    for label, cap in caps.items():
+        entry['Caps'][label] = {'Cap': cap, 'Time': entry['Caps'].get(label, {}).get('Time', now)}
+    aws_put_direct(json.dumps(entry, sort_keys=True), limits_key(name))
+
+
+def lambda_cap(region, credentials):
+    # half of the unreserved concurrency, so verification leaves room for the account's own functions
+    unreserved = aws_lambda_concurrency(region, credentials)
+    if unreserved is None:
+        return None
+    return max(1, unreserved // 2)
+
+
+def lambda_caps(limiter, targets):
+    '''
+    cap the limits of [(account, region, credentials)] targets by the unreserved Lambda
+    concurrent executions of each account/region, looked up once a day
+    '''
+    saved = limiter.saved.get('Caps', {})
+    now = time.time()
+    lookups = {}
+    for account, region, credentials in targets:
+        label = key_label((account, region))
+        if label in saved and now - saved[label]['Time'] < caps_seconds:
+            limiter.set_cap((account, region), saved[label]['Cap'])
+        else:
+            saved.pop(label, None)
+            lookups[(account, region)] = credentials
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
+        futures = {executor.submit(lambda_cap, r, c): (a, r) for (a, r), c in lookups.items()}
+        for future in concurrent.futures.as_completed(futures):
+            if future.result() is not None:
+                limiter.set_cap(futures[future], future.result())
@@ -0,0 +1,129 @@
+import hashlib
+import json
+
+from aws import aws_copy_s3_object, aws_put_direct, aws_read_s3_direct
+from utils import get_deploy_key, load_graph
+
+'''
+graph-delta deployment planning for the per VPC beacon stacks
+
+the deployment list diffs the graph being deployed against the last deployed graph, and
+the hash of each rendered template and its parameters against the hashes recorded with
+the last deployment. only stacks for VPCs that were added or changed are deployed, and
+stacks for removed VPCs are left to the cleanup state machine. the plan for the running
+deployment is saved as pending, and the deploy graph finalize step records it as deployed
+once every stack in it has deployed.
+'''
+
+pending_key = "deploy_plan/pending.json"
+deployed_key = "deploy_plan/deployed.json"
+
+
+def stack_hash(template, parameters):
+    ''' return a hash of a rendered stack template string and its parameters '''
+    digest = hashlib.sha256(template.encode('utf-8'))
+    digest.update(json.dumps(parameters, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def graph_vpcs(G):
+    ''' return {vpc: {'Account', 'Region', 'Subnets'}} for the managed subnets in a graph '''
+    vpcs = {}
+    for subnet, data in G.nodes(data=True):
+        if data.get('Type') == 'external':
+            continue
+        vpc = data['VpcId']
+        if vpc not in vpcs:
+            vpcs[vpc] = {'Account': data['Account'], 'Region': data['Region'], 'Subnets': []}
+        vpcs[vpc]['Subnets'].append(subnet)
+    for vpc in vpcs:
+        vpcs[vpc]['Subnets'].sort()
+    return vpcs
+
+
+def load_deployed():
+    ''' return the last deployed plan and graph vpcs, or None if there is no deployed plan '''
+    data = aws_read_s3_direct(deployed_key)
+    if data is None:
+        return None
+    deployed = json.loads(data)
+
+    last_key = get_deploy_key(last=True)
+    if last_key is None:
+        deployed['Vpcs'] = {}
+    else:
+        deployed['Vpcs'] = graph_vpcs(load_graph(last_key, local=False))
+    return deployed
+
+
+def vpc_change(vpc, info, stack, deployed):
+    '''
+    return why the stack for a VPC needs to be deployed, or None if it is unchanged
+    '''
+    if deployed is None:
+        return 'full'
+    if stack['StackName'] not in deployed['Stacks']:
+        return 'added'
+    last = deployed['Vpcs'].get(vpc)
+    if last is None or last['Account'] != info['Account'] or last['Region'] != info['Region']:
+        return 'added'
+    if last['Subnets'] != info['Subnets']:
+        return 'subnets'
+    if deployed['Stacks'][stack['StackName']] != stack['TemplateHash']:
+        return 'template'
+    return None
+
+
+def save_pending(stacks, changes, deployed):
+    '''
+    save the plan for this deployment. stacks holds the template hash of every stack in the
+    graph, changes holds the reason each deployed stack is in the plan
+    '''
+    hashes = {s['StackName']: s['TemplateHash'] for s in stacks}
+
+    removed = []
+    if deployed is not None:
+        removed = sorted([s for s in deployed['Stacks'] if s not in hashes])
+
+    plan = {
+        'Graph': get_deploy_key(),
+        'Stacks': hashes,
+        'Changes': changes,
+        'Removed': removed
+    }
+    aws_put_direct(json.dumps(plan, sort_keys=True), pending_key)
+
+    counts = {}
+    for reason in changes.values():
+        counts[reason] = counts.get(reason, 0) + 1
+    print(json.dumps({'deploy_plan': counts, 'unchanged': len(hashes) - len(changes), 'removed': len(removed)}))
+    return plan
+
+
+def load_pending():
+    ''' return the plan of the running deployment, or None if there is none '''
+    data = aws_read_s3_direct(pending_key)
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+def record_deployed():
+    ''' record the pending plan as deployed, called once every stack in it is deployed '''
+    if aws_read_s3_direct(pending_key) is not None:
+        aws_copy_s3_object(pending_key, deployed_key)
+
+
+def record_stacks(stacks):
+    '''
+    record the template hashes of stacks that were brought up to date outside of a graph
+    deployment, so the next deployment plan treats them as unchanged
+    '''
+    data = aws_read_s3_direct(deployed_key)
+    if data is None:
+        print("no deployed plan to record stacks in")
+        return
+    deployed = json.loads(data)
+    for stack in stacks:
+        deployed['Stacks'][stack['StackName']] = stack['TemplateHash']
+    aws_put_direct(json.dumps(deployed, sort_keys=True), deployed_key)
@@ -0,0 +1,164 @@
+import concurrent.futures
+import json
+import os
+import time
+
+from aws import aws_put_direct, aws_read_s3_direct
+
+'''
+hedged subnet function invocations
+
+VPC subnet functions have a long latency tail (cold starts with an ENI attach, slow regions).
+routing verification keeps the last latencies of every subnet function, and when a call
+runs past the hedge threshold of its function it is invoked a second time. the first
+response wins. the hedge threshold of a function is the VerifyHedgePercentile (default 95)
+latency of its recent calls, or of all functions until it has 5 calls, and never less than
+VerifyHedgeMinSeconds (default 1.5). a VerifyHedgePercentile of 0 turns hedging off.
+
+the latency of a call is the time from the first invocation of its subnet function to the
+winning response, and a function that doesn't answer by the deadline records the time to
+the deadline. latencies are saved in one object per account/region, so verification runs
+only rewrite the latencies of the account/regions they called.
+
+latencies = {subnet: [seconds of the last 20 calls]}
+'''
+
+latency_prefix = "managed_deployment/verify-latency"
+latency_samples = 20
+
+
+def latency_key(group):
+    # the latency object of an (account, region)
+    return f"{latency_prefix}/{group[0]}/{group[1]}.json"
+
+
+def load_group(group):
+    data = aws_read_s3_direct(latency_key(group))
+    if data is None:
+        return {}
+    return json.loads(data)
+
+
+def load_latencies(groups):
+    ''' load the latencies of the subnet functions in every (account, region) of groups '''
+    latencies = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
+        for group_latencies in executor.map(load_group, sorted(groups)):
+            latencies.update(group_latencies)
+    return latencies
+
+
+def save_latencies(latencies, measured, groups):
+    '''
+    add the {subnet: seconds} latencies of this run, and update the object of each
+    account/region measured. groups is the {subnet: (account, region)} of every subnet
+    '''
+    by_group = {}
+    for subnet, seconds in measured.items():
+        latencies[subnet] = (latencies.get(subnet, []) + [round(seconds, 3)])[-latency_samples:]
+        by_group.setdefault(groups[subnet], []).append(subnet)
+
+    def save_group(group):
+        data = load_group(group)
+        data.update({subnet: latencies[subnet] for subnet in by_group[group]})
+        aws_put_direct(json.dumps(data, sort_keys=True), latency_key(group))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
+        list(executor.map(save_group, by_group))
+    return latencies
+
+
+def percentile(values, pct):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def hedge_thresholds(latencies, subnets):
+    ''' return {subnet: seconds} after which a call to the subnet function is hedged, None when hedging is off '''
+    pct = float(os.environ.get('VerifyHedgePercentile', 95))
+    if pct <= 0:
+        return None
+    minimum = float(os.environ.get('VerifyHedgeMinSeconds', 1.5))
+    overall = percentile([s for samples in latencies.values() for s in samples], pct)
+    thresholds = {}
+    for subnet in subnets:
+        samples = latencies.get(subnet, [])
+        threshold = percentile(samples, pct) if len(samples) >= 5 else overall
+        thresholds[subnet] = max(minimum, threshold or minimum)
+    return thresholds
+
+
+def hedged_calls(executor, function, calls, deadline, latencies, groups):
+    '''
+    run function(**kwargs) for each {subnet: kwargs} in calls on the executor until the
+    deadline, hedging stragglers. function returns {subnet: [results]}, and a response of
+    only unknown results doesn't win while the other call of the subnet is still running.
+    groups is the {subnet: (account, region)} latencies are saved by.
+    returns ({subnet: response}, report)
+    '''
+    thresholds = hedge_thresholds(latencies, calls)
+    pending = {}
+    started = {}
+    for subnet, kwargs in calls.items():
+        future = executor.submit(function, **kwargs)
+        pending[future] = subnet
+        started[subnet] = time.time()
+
+    responses = {}
+    measured = {}
+    hedged = set()
+    hedges = set()
+    wins = 0
+    while len(pending) > 0 and time.time() < deadline:
+        # wake up for the next hedge, or the deadline
+        wake = deadline
+        if thresholds is not None:
+            waiting = [started[s] + thresholds[s] for s in calls if s not in hedged and s not in responses]
+            wake = min([deadline] + waiting)
+        done, _ = concurrent.futures.wait(pending, timeout=max(0.01, wake - time.time()), return_when=concurrent.futures.FIRST_COMPLETED)
+
+        for future in done:
+            subnet = pending.pop(future)
+            if subnet in responses:
+                continue
+            response = future.result()
+            racing = [f for f, s in pending.items() if s == subnet]
+            if len(racing) > 0 and all([r['result'] == 'unknown' for r in response[subnet]]):
+                continue
+            responses[subnet] = response
+            measured[subnet] = time.time() - started[subnet]
+            if future in hedges:
+                wins += 1
+            for f in racing:
+                f.cancel()
+                pending.pop(f)
+
+        if thresholds is None:
+            continue
+        now = time.time()
+        for subnet in calls:
+            if subnet not in hedged and subnet not in responses and now - started[subnet] >= thresholds[subnet]:
+                hedged.add(subnet)
+                hedge = executor.submit(function, **calls[subnet])
+                hedges.add(hedge)
+                pending[hedge] = subnet
+
+    for future in pending:
+        future.cancel()
+
+    # functions that never answered took at least until the deadline
+    for subnet in calls:
+        if subnet not in responses:
+            measured[subnet] = deadline - started[subnet]
+
+    report = {
+        'Calls': len(calls),
+        'Hedged': len(hedged),
+        'HedgeWins': wins,
+        'HedgeRate': round(len(hedged) / len(calls), 3) if len(calls) > 0 else 0
+    }
+    print(f"hedged {report['Hedged']} of {report['Calls']} subnet functions, {wins} hedges answered first")
+    save_latencies(latencies, measured, groups)
+    return responses, report
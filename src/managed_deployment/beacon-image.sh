@@ -0,0 +1,23 @@
+#!/bin/bash
+# build script for the carve beacon image, the instance powers off when the image is ready
+amazon-linux-extras install -y nginx1
+cat <<CONF > /etc/nginx/nginx.conf
+events {}
+http {
+    server {
+        listen       *:80;
+        server_name carve;
+        root    /dev/null;
+        location /up {
+            add_header Content-Type text/plain;
+            return 200 'OK';
+        }
+    }
+}
+CONF
+systemctl enable nginx
+yum install -y https://s3.amazonaws.com/ec2-downloads-windows/SSMAgent/latest/linux_amd64/amazon-ssm-agent.rpm
+systemctl enable amazon-ssm-agent
+yum clean all
+rm -rf /var/cache/yum /var/lib/cloud/instances/*
+shutdown -h now
@@ -1,17 +1,21 @@
 import concurrent.futures
+import time
 import urllib3
 
 '''
-this subnet lambda code file is kept separate from the VPC stack CFN template for easier 
-editing/testing and is injected into the CFN template at deploy time by carve-core lambda
+this subnet lambda code file is kept separate from the VPC stack CFN template for easier
+editing/testing. at deploy time the carve-core lambda zips it as index.py and uploads it to
+the carve managed bucket of each region under a key containing the hash of the code, and
+every subnet function in the region references that S3 object
 '''
 
-def http_call(beacon):
+def http_call(beacon, timeout=1.0):
     print(f'getting results for beacon: {beacon}')
     http = urllib3.PoolManager()
     result = None
+    start = time.monotonic()
     try:
-        r = http.request('GET', beacon, retries=False, timeout=1.0)
+        r = http.request('GET', beacon, retries=False, timeout=timeout)
         if r.status == 200:
             result = {'beacon': beacon, 'result': 'up'}
         else:
@@ -26,19 +30,32 @@ def http_call(beacon):
         print(f'ERROR: HTTPError — {beacon}')
         result = {'beacon': beacon, 'result': 'down', 'error': 'HTTPError'}
 
+    result['latency'] = int((time.monotonic() - start) * 1000)
     print(result)
     return result
 
 
-def test_beacons(beacons):
+def test_beacons(beacons, deadline=None, timeout=1.0):
+    '''
+    probe the beacons and return the results measured before the deadline (epoch seconds),
+    beacons still being probed at the deadline are returned as unknown
+    '''
+    if deadline is not None:
+        timeout = max(0.1, min(timeout, deadline - time.time()))
 
     results = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=1000) as executor:
-        futures = []
-        for beacon in beacons:
-            futures.append(executor.submit(http_call, beacon=beacon))
-        for future in concurrent.futures.as_completed(futures):
-            results.append(future.result())
+    # one thread per beacon up to 1000, probes are network bound
+    workers = max(1, min(len(beacons), 1000))
+    print(f"probing {len(beacons)} beacons with {workers} threads")
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    futures = {executor.submit(http_call, beacon=beacon, timeout=timeout): beacon for beacon in beacons}
+    wait = None if deadline is None else max(0, deadline - time.time())
+    done, pending = concurrent.futures.wait(futures, timeout=wait)
+    for future in done:
+        results.append(future.result())
+    for future in pending:
+        results.append({'beacon': futures[future], 'result': 'unknown', 'error': 'Deadline'})
+    executor.shutdown(wait=False, cancel_futures=True)
 
     return results
 
@@ -46,7 +63,12 @@ def test_beacons(beacons):
 def lambda_handler(event, context):
     print(event)
     if event['action'] == 'verify':
-        return test_beacons(event['beacons'])
+        # return before the run deadline, and before this function times out
+        deadline = event.get('deadline')
+        if context is not None:
+            local = time.time() + context.get_remaining_time_in_millis() / 1000 - 1
+            deadline = local if deadline is None else min(deadline, local)
+        return test_beacons(event['beacons'], deadline, event.get('timeout', 1.0))
 
 
 if __name__ == '__main__':
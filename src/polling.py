@@ -0,0 +1,111 @@
+import json
+import os
+import time
+
+from aws import aws_put_direct, aws_read_s3_direct
+
+'''
+adaptive status polling for the deploy stacks and cleanup state machines
+
+the handler that starts a phase (stack, changeset, execute, delete) stamps the start time in
+the state machine payload, and the describe handlers record each poll and return PollSeconds
+for the next wait state. a phase is polled at the time it is expected to finish, based on how
+long the same phase took on the last deploy of the stack, then backs off while it is overdue.
+'''
+
+# phase durations in seconds used for stacks with no deploy history, by carve stack type
+default_durations = {
+    'beacons': {'stack': 5, 'changeset': 5, 'execute': 90, 'delete': 120},
+    'privatelink': {'stack': 5, 'changeset': 10, 'execute': 300, 'delete': 300},
+    'bucket': {'stack': 5, 'changeset': 5, 'execute': 20, 'delete': 20},
+}
+
+# shortest and longest wait between polls in seconds, by phase
+poll_limits = {
+    'stack': (2, 10),
+    'changeset': (2, 10),
+    'execute': (3, 30),
+    'delete': (3, 10),
+}
+
+
+def stack_type(stackname):
+    # return the carve stack type from a managed stack name
+    for t in default_durations:
+        if stackname.startswith(f"{os.environ['Prefix']}carve-managed-{t}-"):
+            return t
+    return 'beacons'
+
+
+def history_key(stackname):
+    return f"deploy_metrics/{stackname}.json"
+
+
+def load_history(payload):
+    ''' add the phase durations from the last deploy of this stack to the payload '''
+    data = aws_read_s3_direct(history_key(payload['StackName']))
+    if data is not None:
+        payload['ExpectedDurations'] = json.loads(data)
+    return payload
+
+
+def save_history(payload):
+    ''' save the measured phase durations of this deploy for the next deploy of the stack '''
+    durations = dict(payload.get('ExpectedDurations', {}))
+    for phase, timing in payload['Timings'].items():
+        if 'Seconds' in timing:
+            durations[phase] = timing['Seconds']
+    aws_put_direct(json.dumps(durations), history_key(payload['StackName']))
+
+
+def start_phase(payload, phase):
+    ''' mark the start of a deployment phase in the state machine payload '''
+    if 'Timings' not in payload:
+        payload['Timings'] = {}
+    payload['Phase'] = phase
+    payload['Timings'][phase] = {'Start': time.time(), 'Polls': 0}
+    return payload
+
+
+def poll_phase(payload, done):
+    '''
+    record a status poll of the current phase. when the phase is done, record how long it
+    took, otherwise set PollSeconds for the state machine wait state
+    '''
+    phase = payload['Phase']
+    timing = payload['Timings'][phase]
+    timing['Polls'] += 1
+    elapsed = time.time() - timing['Start']
+
+    if done:
+        timing['Seconds'] = round(elapsed)
+        print(json.dumps({
+            'stack': payload['StackName'],
+            'phase': phase,
+            'seconds': timing['Seconds'],
+            'polls': timing['Polls']
+            }))
+        payload['PollSeconds'] = poll_limits[phase][0]
+    else:
+        payload['PollSeconds'] = poll_seconds(payload, phase, elapsed)
+
+    return payload
+
+
+def poll_seconds(payload, phase, elapsed):
+    '''
+    wait until the phase is expected to finish, and once it is overdue wait a quarter
+    of the time elapsed so far, within the limits for the phase
+    '''
+    if phase in payload.get('ExpectedDurations', {}):
+        expected = payload['ExpectedDurations'][phase]
+    else:
+        expected = default_durations[stack_type(payload['StackName'])][phase]
+
+    if elapsed < expected:
+        wait = expected - elapsed
+    else:
+        wait = elapsed * 0.25
+
+    shortest, longest = poll_limits[phase]
+    return int(min(max(wait, shortest), longest))
@@ -1,9 +1,21 @@
+import concurrent.futures
 import os
 from copy import deepcopy
 from aws import *
+from stack_outputs import core_account, harvest_stacks, stack_outputs
 import time
 
 
+# bounded parallelism for per region work in the private link lambdas
+region_workers = 10
+
+# AZ name to AZ id maps of the carve account, cached in memory and in s3. the mapping is
+# fixed for an account, but a cached region is refreshed after a week to pick up new AZs
+az_cache_key = "managed_deployment/az-maps.json"
+az_cache_seconds = 7 * 24 * 3600
+_az_maps = {}
+
+
 #
 # first seed just a small VPC stack template to the current region to create the VPC
 # can just be straight JSON
@@ -12,6 +24,16 @@ import time
 #
 
 
+def beacon_image_parameter():
+    # the SSM parameter in each region with the id of the prebaked beacon image
+    return f"/{os.environ['Prefix']}carve-resources/beacon-image"
+
+
+def beacon_image(region):
+    # the beacon image id in a region, or None if none has been built for it
+    return aws_ssm_get_parameter(beacon_image_parameter(), region)
+
+
 def private_link_deployment(deployments, account, regions, routing=False):
     ''' deploy the private link CFN templates '''
     deploy = []
@@ -19,10 +41,13 @@ def private_link_deployment(deployments, account, regions, routing=False):
     # get core region vpc id from stack output
     stackname = f"{os.environ['Prefix']}carve-managed-privatelink-{current_region}"
     try:
-        core_vpc_id = aws_get_stack_outputs_dict(stackname, current_region)['VpcId']
+        core_vpc_id = stack_outputs(stackname, current_region)['VpcId']
     except:
         core_vpc_id = None
 
+    # boot the beacon instances from the prebaked beacon image in regions that have one
+    images = for_each_region(beacon_image, list(deployments))
+
     print(f"creating {len(deployments.items())} item deployment input list for deploy-stacks state machine")
     for region, template in deployments.items():
         # if region == current_region:
@@ -54,6 +79,13 @@ def private_link_deployment(deployments, account, regions, routing=False):
                     "ParameterValue": core_vpc_id
                 })
         
+        if images[region] is not None:
+            parameters.append(
+                {
+                    "ParameterKey": "ImageId",
+                    "ParameterValue": beacon_image_parameter()
+                })
+
         # if multiple regions, pass in the peer region's VPC id for peering
         if routing:
             parameters.append(
@@ -151,10 +183,11 @@ def privatelink_template(region, second_octet, deploy_accounts, azs):
 def add_peer_routes(template, deploy_regions):
     ''' add routes to the peered regions in CFN '''
     stackname = f"{os.environ['Prefix']}carve-managed-privatelink-{current_region}"
+    harvest = harvest_stacks([(core_account, r, None) for r in deploy_regions])
     for region in deploy_regions:
         if region == current_region:
             continue
-        outputs = aws_get_stack_outputs_dict(stackname, region)
+        outputs = harvest[(core_account, region)].get(stackname, {}).get('Outputs', {})
         if 'VpcPeeringConnectionId' in outputs:
             print(f"{current_region}: adding route to {current_region} template for peered region: {region}")
 
@@ -178,8 +211,10 @@ def add_peer_routes(template, deploy_regions):
 def discover_privatelink_services(deploy_regions):
     print(f"discovering privatelink services in regions: {deploy_regions}")
     services = []
+    stackname = f"{os.environ['Prefix']}carve-managed-privatelink"
+    harvest = harvest_stacks([(core_account, r, None) for r in deploy_regions])
     for region in deploy_regions:
-        outputs = aws_get_stack_outputs_dict(f"{os.environ['Prefix']}carve-managed-privatelink", region)
+        outputs = harvest[(core_account, region)].get(stackname, {}).get('Outputs', {})
         if 'EndpointService' in outputs:
             print(f"{region}: found privatelink service: {outputs['EndpointService']}")
             service_data = aws_describe_vpc_endpoint_service_configuration(outputs['EndpointService'], region)
@@ -188,3 +223,43 @@ def discover_privatelink_services(deploy_regions):
             print(f"{region}: failed to find privatelink service")
     
     return services
+
+
+def for_each_region(function, regions, *args):
+    ''' run function(region, *args) for each region, region_workers at a time, returns {region: result} '''
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=region_workers) as executor:
+        futures = {executor.submit(function, region, *args): region for region in regions}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+def describe_az_map(region):
+    azs = aws_describe_availability_zones(region)['AvailabilityZones']
+    return {'Time': int(time.time()), 'Zones': {az['ZoneName']: az['ZoneId'] for az in azs}}
+
+
+def az_maps(regions):
+    '''
+    return {region: {zone name: zone id}} for the carve account in each region, describing
+    only the regions missing from the cache, concurrently
+    '''
+    if len(_az_maps) == 0:
+        data = aws_read_s3_direct(az_cache_key)
+        if data is not None:
+            _az_maps.update(json.loads(data))
+
+    now = time.time()
+    missing = [r for r in regions if r not in _az_maps or now - _az_maps[r]['Time'] > az_cache_seconds]
+    if len(missing) > 0:
+        _az_maps.update(for_each_region(describe_az_map, missing))
+        aws_put_direct(json.dumps(_az_maps, sort_keys=True), az_cache_key)
+        print(f"described availability zones in {len(missing)} regions: {missing}")
+
+    return {r: _az_maps[r]['Zones'] for r in regions}
+
+
+def deployment_az_map(zones, deploy_azids):
+    ''' map the AZ names of a region that are in the deployment to their AZ id '''
+    return {name: azid for name, azid in zones.items() if azid in deploy_azids}
@@ -0,0 +1,166 @@
+import os
+import time
+import zlib
+
+'''
+probe plan compiler
+
+routing verification sends beacons to subnet functions, and each function probes the
+beacons it is given. the probe plan decides which beacons each managed subnet probes, and
+which edges of the routing graph are inferred without a probe. pruning rules can be set
+with the ProbePruneRules environment variable as a comma separated list (default: self,intra_vpc,symmetric,classes,model):
+ - classes: subnets in the same VPC and AZ with the same route table and network ACL have
+   the same reachability. only one representative per class probes and is probed, and its
+   links are expanded to the other members of the class. the representative rotates every
+   ProbeRotationHours hours (default 24) so every member is probed over time
+ - self: a subnet does not probe its own beacon
+ - intra_vpc: subnets in the same VPC route to each other with the local route, the edge is
+   inferred instead of probed
+ - symmetric: the routing graph is undirected, so only one direction of a pair of managed
+   subnets is probed, from the subnet with fewer probes planned so far
+ - model: pairs of managed subnets the static reachability model is certain about are not
+   probed, the edge is inferred when the model expects the pair to route. ProbeModelSample
+   percent of those pairs (default 10) are still probed each rotation to check the model,
+   and pairs the model disagreed with at the last verification are always probed
+
+plan = {
+    'Probes': {subnet: [beacon addresses]},
+    'Inferred': [[subnet, target, rule]],
+    'Classes': {representative: [members]},
+    'Checks': [[subnet, target, expected]]
+}
+'''
+
+default_rules = 'self,intra_vpc,symmetric,classes,model'
+
+
+def prune_rules():
+    rules = os.environ.get('ProbePruneRules', default_rules)
+    return [r.strip() for r in rules.split(',') if r.strip() != '']
+
+
+def class_key(G, subnet):
+    # subnets with the same key have the same reachability, a subnet missing an association is its own class
+    data = G.nodes[subnet]
+    if data.get('RouteTableId') is None or data.get('NetworkAclId') is None:
+        return (subnet,)
+    return (data['VpcId'], data['AvailabilityZoneId'], data['RouteTableId'], data['NetworkAclId'])
+
+
+def rotation_slot():
+    # the current ProbeRotationHours time slot
+    return int(time.time() // (float(os.environ.get('ProbeRotationHours', 24)) * 3600))
+
+
+def equivalence_classes(G, subnets, rotation=None):
+    '''
+    group subnets into reachability equivalence classes, returns {representative: [members]}.
+    the representative of each class is picked by rotation, which defaults to the current
+    ProbeRotationHours time slot
+    '''
+    if rotation is None:
+        rotation = rotation_slot()
+    groups = {}
+    for subnet in sorted(subnets):
+        groups.setdefault(class_key(G, subnet), []).append(subnet)
+    return {members[rotation % len(members)]: members for members in groups.values()}
+
+
+def class_edges(G, classes):
+    '''
+    expand the links of class representatives in graph G to every member of their classes,
+    returns [[subnet, target, 'classes']] for links not already in the graph
+    '''
+    members = {rep: m for rep, m in classes.items() if len(m) > 1}
+    edges = []
+    for rep, rep_members in members.items():
+        for neighbor in list(G.neighbors(rep)):
+            for a in rep_members:
+                for b in classes.get(neighbor, [neighbor]):
+                    if a != b and not G.has_edge(a, b):
+                        edges.append([a, b, 'classes'])
+    return edges
+
+
+def model_sample(a, b, rotation):
+    # true for ProbeModelSample percent of the pairs, a different sample each rotation
+    sample = float(os.environ.get('ProbeModelSample', 10))
+    pair = '|'.join(sorted([a, b]))
+    return zlib.crc32(f"{pair}|{rotation}".encode()) % 100 < sample
+
+
+def compile_probe_plan(G, inventory, rules=None, rotation=None, model=None, disagreements=[]):
+    '''
+    compile a probe plan for the managed subnets of graph G, probing the beacons in the
+    beacon inventory {beacon: {'type', 'address', ...}}. model is an optional function
+    expected(a, b) from the static reachability model, disagreements are the [a, b] pairs
+    it disagreed with at the last verification
+    '''
+    if rules is None:
+        rules = prune_rules()
+    if rotation is None:
+        rotation = rotation_slot()
+    disagreed = set([tuple(sorted(pair[:2])) for pair in disagreements])
+
+    managed = sorted([s for s, d in inventory.items() if d['type'] == 'managed' and s in G.nodes])
+    classes = {subnet: [subnet] for subnet in managed}
+    if 'classes' in rules:
+        classes = equivalence_classes(G, managed, rotation)
+        managed = sorted(classes)
+    represented = set([m for members in classes.values() for m in members])
+    targets = sorted([t for t in inventory if t in classes or t not in represented])
+
+    probes = {subnet: [] for subnet in managed}
+    inferred = []
+    checks = []
+    planned = set()
+
+    # members of a class share a VPC, so they reach each other with the local route
+    if 'intra_vpc' in rules:
+        for members in classes.values():
+            for i, a in enumerate(members):
+                for b in members[i + 1:]:
+                    inferred.append([a, b, 'intra_vpc'])
+
+    for source in managed:
+        for target in targets:
+            if target == source:
+                if 'self' not in rules:
+                    probes[source].append(inventory[target]['address'])
+                continue
+
+            target_managed = inventory[target]['type'] == 'managed' and target in G.nodes
+
+            if 'intra_vpc' in rules and target_managed and G.nodes[source]['VpcId'] == G.nodes[target]['VpcId']:
+                if source < target:
+                    inferred.append([source, target, 'intra_vpc'])
+                continue
+
+            if 'model' in rules and model is not None and target_managed:
+                expected = model(source, target)
+                if expected != 'uncertain':
+                    if tuple(sorted([source, target])) in disagreed or model_sample(source, target, rotation):
+                        # probe the pair to check the model
+                        if source < target:
+                            checks.append([source, target, expected])
+                    else:
+                        if expected == 'yes' and source < target:
+                            inferred.append([source, target, 'model'])
+                        continue
+
+            if 'symmetric' in rules and target_managed:
+                pair = tuple(sorted([source, target]))
+                if pair in planned:
+                    continue
+                planned.add(pair)
+                # probe from whichever side of the pair has less work so far
+                if len(probes[target]) < len(probes[source]):
+                    probes[target].append(inventory[source]['address'])
+                    continue
+
+            probes[source].append(inventory[target]['address'])
+
+    full = len(represented) * len(inventory)
+    total = sum([len(p) for p in probes.values()])
+    print(f"probe plan: {total} of {full} probes with rules {rules}, {len(classes)} classes, {len(inferred)} edges inferred, {len(checks)} model checks")
+    return {'Probes': probes, 'Inferred': inferred, 'Classes': classes, 'Checks': checks}
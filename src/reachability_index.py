@@ -0,0 +1,211 @@
+import json
+import sys
+import time
+
+from aws import aws_put_direct, aws_read_s3_direct
+
+'''
+reachability query index
+
+every routing verification updates a small index of the verified graph in the carve s3
+bucket, so reachability questions don't need the node-link graph or networkx. each subnet
+has a row bitset of the subnets it reaches, and the index keeps:
+ - Rows: adjacency bitsets, in the order of Nodes
+ - Components: the connected component number of each node
+ - Groups: per VpcId and per Account, the Members bitset, the Any bitset of nodes reached by
+   any member and the All bitset of nodes reached by every member
+ - Since: {epoch: {row: bitset}} the verification run each link was first seen in, links are
+   stored on the row of the lower node
+bitsets are stored as hex strings and held as ints once loaded, so point, row and group
+queries are a few bit operations.
+
+    python reachability_index.py point subnet-a subnet-b
+    python reachability_index.py row subnet-a
+    python reachability_index.py group VpcId vpc-a vpc-b
+'''
+
+index_key = "managed_deployment/reachability-index.json"
+group_keys = ['VpcId', 'Account']
+
+
+def bits(positions):
+    value = 0
+    for i in positions:
+        value |= 1 << i
+    return value
+
+
+def positions(value):
+    # the set bits of value, lowest first
+    result = []
+    while value:
+        low = value & -value
+        result.append(low.bit_length() - 1)
+        value ^= low
+    return result
+
+
+def components(rows):
+    labels = [None] * len(rows)
+    label = 0
+    for start in range(len(rows)):
+        if labels[start] is not None:
+            continue
+        seen = 1 << start
+        frontier = 1 << start
+        while frontier:
+            reached = 0
+            for i in positions(frontier):
+                reached |= rows[i]
+            frontier = reached & ~seen
+            seen |= reached
+        for i in positions(seen):
+            labels[i] = label
+        label += 1
+    return labels
+
+
+def first_seen(previous, a, b):
+    # the Since time of link a-b in the previous index, or None
+    if previous is None or a not in previous['Position'] or b not in previous['Position']:
+        return None
+    i, j = sorted([previous['Position'][a], previous['Position'][b]])
+    for since, rows in previous['Since'].items():
+        if rows.get(i, 0) >> j & 1:
+            return since
+    return None
+
+
+def build_reachability_index(R, previous=None, now=None):
+    ''' build the index of the verified graph R, links seen in the previous index keep their Since time '''
+    if now is None:
+        now = int(time.time())
+    nodes = sorted(R.nodes)
+    position = {n: i for i, n in enumerate(nodes)}
+
+    rows = [0] * len(nodes)
+    since = {}
+    for a, b in R.edges:
+        if a == b:
+            continue
+        i, j = sorted([position[a], position[b]])
+        rows[i] |= 1 << j
+        rows[j] |= 1 << i
+        seen = first_seen(previous, a, b) or now
+        since.setdefault(seen, {})
+        since[seen][i] = since[seen].get(i, 0) | 1 << j
+
+    groups = {}
+    for key in group_keys:
+        members = {}
+        for n in nodes:
+            value = R.nodes[n].get(key)
+            if value is not None:
+                members.setdefault(value, []).append(position[n])
+        groups[key] = {}
+        for value, group in members.items():
+            reach_any = 0
+            reach_all = -1
+            for i in group:
+                reach_any |= rows[i]
+                reach_all &= rows[i] | 1 << i
+            groups[key][value] = {'Members': bits(group), 'Any': reach_any, 'All': reach_all}
+
+    index = {
+        'Name': R.graph.get('Name'),
+        'Built': now,
+        'Nodes': nodes,
+        'Position': position,
+        'Rows': rows,
+        'Components': components(rows),
+        'Groups': groups,
+        'Since': since
+    }
+    print(f"reachability index: {len(nodes)} nodes, {len(R.edges)} links, {len(set(index['Components']))} components")
+    return index
+
+
+def encode(index):
+    return json.dumps({
+        'Name': index['Name'],
+        'Built': index['Built'],
+        'Nodes': index['Nodes'],
+        'Rows': [format(r, 'x') for r in index['Rows']],
+        'Components': index['Components'],
+        'Groups': {k: {v: {g: format(b, 'x') for g, b in d.items()} for v, d in vals.items()} for k, vals in index['Groups'].items()},
+        'Since': {str(t): {str(i): format(b, 'x') for i, b in rows.items()} for t, rows in index['Since'].items()}
+    })
+
+
+def decode(data):
+    index = json.loads(data)
+    index['Position'] = {n: i for i, n in enumerate(index['Nodes'])}
+    index['Rows'] = [int(r, 16) for r in index['Rows']]
+    index['Groups'] = {k: {v: {g: int(b, 16) for g, b in d.items()} for v, d in vals.items()} for k, vals in index['Groups'].items()}
+    index['Since'] = {int(t): {int(i): int(b, 16) for i, b in rows.items()} for t, rows in index['Since'].items()}
+    return index
+
+
+def save_reachability_index(index, key=index_key):
+    aws_put_direct(encode(index), key)
+
+
+def load_reachability_index(key=index_key, local=False):
+    ''' load an index from the carve s3 bucket, or a local file, returns None if there is none '''
+    if local:
+        with open(key) as f:
+            data = f.read()
+    else:
+        data = aws_read_s3_direct(key)
+    if data is None:
+        return None
+    return decode(data)
+
+
+def update_reachability_index(R, previous=None):
+    ''' rebuild the saved index from the verified graph R, previous defaults to the saved index '''
+    if previous is None:
+        previous = load_reachability_index()
+    index = build_reachability_index(R, previous)
+    save_reachability_index(index)
+    return index
+
+
+def point(index, a, b):
+    ''' can subnet a reach subnet b, and since which verification run '''
+    i, j = index['Position'][a], index['Position'][b]
+    reachable = bool(index['Rows'][i] >> j & 1)
+    return {'Reachable': reachable, 'Since': first_seen(index, a, b) if reachable else None}
+
+
+def row(index, a):
+    ''' every subnet a reaches '''
+    return [index['Nodes'][j] for j in positions(index['Rows'][index['Position'][a]])]
+
+
+def group(index, key, x, y):
+    ''' Any: some member of group x reaches some member of group y, All: every member of x reaches every member of y '''
+    gx = index['Groups'][key][x]
+    gy = index['Groups'][key][y]
+    return {
+        'Any': gx['Any'] & gy['Members'] != 0,
+        'All': gx['All'] & gy['Members'] == gy['Members']
+    }
+
+
+def connected(index, a, b):
+    ''' true when subnets a and b are in the same connected component '''
+    return index['Components'][index['Position'][a]] == index['Components'][index['Position'][b]]
+
+
+queries = {
+    'point': point,
+    'row': row,
+    'group': group,
+    'connected': connected
+}
+
+
+if __name__ == '__main__':
+    index = load_reachability_index()
+    print(json.dumps(queries[sys.argv[1]](index, *sys.argv[2:]), default=str))
@@ -0,0 +1,161 @@
+import ipaddress
+import json
+from functools import lru_cache
+
+from aws import aws_put_direct, aws_read_s3_direct, aws_s3_list_objects
+
+'''
+static reachability model
+
+network discovery saves the route tables, VPC peerings, transit gateway attachments and
+transit gateway route tables of each account in the routing_discovery directory. the model
+uses them to compute the expected reachability of a pair of subnets offline, following the
+longest prefix match route of each hop:
+ - the route table of the source subnet, local routes stay in the VPC
+ - a VPC peering reaches the VPC on the other side of the peering, and only that VPC
+ - a transit gateway is entered through the attachment of the source VPC, and the route
+   table associated with that attachment picks the attachment traffic leaves through
+each direction of a pair has to route for the pair to be reachable. the model returns:
+ - 'yes' or 'no' when every hop is known
+ - 'uncertain' when a hop is not modeled (appliance VPCs, VPN, direct connect, transit gateway
+   peering, prefix list routes) or its routing data was not discovered
+network ACLs and security groups are not modeled, probes of the pairs the model is certain
+about are sampled to catch the pairs where it disagrees with the network.
+'''
+
+routing_prefix = "routing_discovery/"
+disagreements_key = "managed_deployment/reachability-disagreements.json"
+
+
+def load_routing():
+    ''' merge the routing data of every discovered account and region, returns None if there is none '''
+    routing = {'RouteTables': {}, 'Peerings': {}, 'Attachments': {}, 'TransitGatewayRouteTables': {}}
+    keys = aws_s3_list_objects(prefix=routing_prefix)
+    for key in keys:
+        for region_routing in json.loads(aws_read_s3_direct(key) or '{}').values():
+            for section, items in region_routing.items():
+                routing[section].update(items)
+    if len(keys) == 0:
+        return None
+    return routing
+
+
+def load_disagreements():
+    ''' return the subnet pairs the model disagreed with at the last verification '''
+    data = aws_read_s3_direct(disagreements_key)
+    if data is None:
+        return []
+    return json.loads(data)
+
+
+def save_disagreements(disagreements):
+    aws_put_direct(json.dumps(disagreements), disagreements_key)
+
+
+@lru_cache(maxsize=None)
+def network(cidr):
+    return ipaddress.ip_network(cidr, strict=False)
+
+
+def longest_match(routes, cidr):
+    '''
+    return the target of the longest prefix match route for every address of cidr. returns
+    'uncertain' when a more specific route or a prefix list route could take part of the cidr
+    '''
+    destination = network(cidr)
+    best = None
+    for route_cidr, target in routes:
+        if not route_cidr[0].isdigit():
+            # prefix list routes are not expanded
+            return 'uncertain'
+        route = network(route_cidr)
+        if route.version != destination.version:
+            continue
+        if destination.subnet_of(route):
+            if best is None or route.prefixlen > best[0]:
+                best = (route.prefixlen, target)
+        elif route.subnet_of(destination):
+            return 'uncertain'
+    if best is None:
+        return None
+    return best[1]
+
+
+def transit_gateway_hop(routing, transit_gateway, source_vpc, destination_vpc, cidr):
+    # route from source_vpc through its attachment to the transit gateway
+    attachments = routing['Attachments']
+    entry = None
+    for attachment in attachments.values():
+        if attachment['TransitGatewayId'] == transit_gateway and attachment['ResourceId'] == source_vpc:
+            entry = attachment
+            break
+    if entry is None or entry['RouteTableId'] is None:
+        return 'no'
+    table = routing['TransitGatewayRouteTables'].get(entry['RouteTableId'])
+    if table is None or table.get('Truncated', False):
+        # the transit gateway owner account was not discovered, or not every route was
+        return 'uncertain'
+
+    target = longest_match(table['Routes'], cidr)
+    if target in [None, 'blackhole']:
+        return 'no'
+    if target == 'uncertain':
+        return 'uncertain'
+    for attachment_id in target:
+        attachment = attachments.get(attachment_id)
+        if attachment is not None and attachment['ResourceType'] == 'vpc' and attachment['ResourceId'] == destination_vpc:
+            return 'yes'
+    # traffic leaves through another VPC, a VPN, direct connect or a peered transit gateway
+    return 'uncertain'
+
+
+def route_direction(routing, route_table, source_vpc, destination_vpc, cidr):
+    ''' expected reachability of cidr in destination_vpc from a subnet using route_table in source_vpc '''
+    if source_vpc == destination_vpc:
+        return 'yes'
+    table = routing['RouteTables'].get(route_table)
+    if table is None:
+        return 'uncertain'
+
+    target = longest_match(table['Routes'], cidr)
+    if target == 'uncertain':
+        return 'uncertain'
+    if target in [None, 'blackhole', 'local']:
+        # no route, or a VPC CIDR that overlaps the destination keeps traffic local
+        return 'no'
+    if target.startswith('pcx-'):
+        return 'yes' if destination_vpc in routing['Peerings'].get(target, []) else 'no'
+    if target.startswith('tgw-'):
+        return transit_gateway_hop(routing, target, source_vpc, destination_vpc, cidr)
+    if target.startswith(('igw-', 'nat-', 'eigw-')):
+        return 'no'
+    return 'uncertain'
+
+
+def reachability_model(G, routing):
+    '''
+    return a function expected(a, b) that gives the expected reachability of the subnets a and
+    b of graph G from the routing data. directions are cached by source route table, so subnets
+    that share a route table are only computed once
+    '''
+    cache = {}
+
+    def direction(source, destination):
+        s = G.nodes[source]
+        d = G.nodes[destination]
+        if d.get('SubnetCidrBlock') is None or s.get('RouteTableId') is None:
+            return 'uncertain'
+        key = (s['RouteTableId'], s['VpcId'], destination)
+        if key not in cache:
+            cache[key] = route_direction(routing, s['RouteTableId'], s['VpcId'], d['VpcId'], d['SubnetCidrBlock'])
+        return cache[key]
+
+    def expected(a, b):
+        results = [direction(a, b), direction(b, a)]
+        if 'no' in results:
+            return 'no'
+        if 'uncertain' in results:
+            return 'uncertain'
+        return 'yes'
+
+    return expected
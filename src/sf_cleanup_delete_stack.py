@@ -1,13 +1,21 @@
 import json
 import os
+from botocore.exceptions import ClientError
+from polling import start_phase
 from utils import carve_role_arn
-from aws import aws_delete_stack, aws_purge_s3_bucket, aws_assume_role
+from aws import (aws_delete_stack, aws_describe_stack, aws_describe_stack_set,
+                 aws_list_stack_instances, aws_purge_s3_bucket, aws_assume_role,
+                 aws_stack_instances, aws_throttled)
+from stackset_backend import operation_preferences
 
 
 def lambda_handler(event, context):
     '''
     Send delete stack command to account/region for the CFN stack in the event
     - will also empty the S3 bucket if the stack is a bucket stack
+    - a stack without a StackId gets the id of the stack, which its delete is described by
+    - a bucket stack that is an instance of the managed bucket stack set is deleted thru
+      the stack set, so the stack set doesn't keep an instance of a deleted stack
     '''
     print(event)
     input = event['Input']
@@ -28,15 +36,32 @@ def lambda_handler(event, context):
         bucket = f"{os.environ['Prefix']}carve-managed-bucket-{unique}-{region}"
         aws_purge_s3_bucket(bucket)
 
-    aws_delete_stack(
-        stackname=input['StackName'],
-        region=input['Region'],
-        credentials=credentials)
+        stackset = f"{os.environ['Prefix']}carve-managed-bucket"
+        if os.environ.get('DeployBackend', 'stacks') == 'stacksets' and aws_describe_stack_set(stackset) is not None:
+            for instance in aws_list_stack_instances(stackset):
+                if (instance['Account'], instance['Region']) == (account, region):
+                    aws_stack_instances(stackset, 'delete', [account], [region], operation_preferences())
+                    print(f"WILL DELETE STACK SET INSTANCE: {stackset} from {account} in {region}")
+                    input['StackId'] = instance['StackId']
+                    return start_phase(input, 'delete')
+
+    if 'StackId' not in input:
+        stack = aws_describe_stack(input['StackName'], region, credentials)
+        if stack is not None:
+            input['StackId'] = stack['StackId']
+
+    try:
+        aws_delete_stack(
+            stackname=input['StackName'],
+            region=input['Region'],
+            credentials=credentials)
+    except ClientError as e:
+        aws_throttled(e, 'cloudformation:DeleteStack', region, account)
 
     print(f"WILL DELETE STACK: {input['StackName']} from {account} in {region}")
 
     # return json to step function
-    return input
+    return start_phase(input, 'delete')
 
 
 
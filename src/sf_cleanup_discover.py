@@ -3,49 +3,60 @@ import json
 import os
 
 from aws import aws_all_regions, aws_assume_role, aws_find_stacks
-from utils import carve_role_arn
+from concurrency import AdaptiveLimiter
+from utils import carve_role_arn, write_manifest_part
 
 
 def lambda_handler(event, context):
     '''
     discover all deployments of carve named stacks and determine if they should exist
     by checking against the safe_stacks list
-    - returns a list of stacks to be deleted
+    - writes the list of stacks to be deleted as a manifest part for this account
+    - returns the count of stacks to be deleted
 
-    event = {'Input': {'Account': '123456789012', 'SafeStacks': []}}
+    event = {'Input': {'Account': '123456789012', 'SafeStacks': [], 'DeletePrefix': 'manifests/cleanup-delete/1700000000-0a1b2c3d/'}}
 
     '''
     print(event)
 
     account = event['Input']['Account']
     safe_stacks = event['Input']['SafeStacks']
+    delete_prefix = event['Input']['DeletePrefix']
 
     credentials = aws_assume_role(carve_role_arn(account), f"carve-cleanup")
     startswith = f"{os.environ['Prefix']}carve-managed-"
 
     futures = set()
     delete_stacks = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        for region in aws_all_regions():
+    regions = aws_all_regions()
+    limiter = AdaptiveLimiter('cleanup', initial=10, maximum=len(regions))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(regions)) as executor:
+        for region in regions:
             futures.add(executor.submit(
                 threaded_find_stacks,
                 account=account,
                 region=region,
                 safe_stacks=safe_stacks,
                 startswith=startswith,
-                credentials=credentials
+                credentials=credentials,
+                limiter=limiter
             ))
         for future in concurrent.futures.as_completed(futures):
             for stack in future.result():
                 delete_stacks.append(stack)
+    limiter.report()
+
+    if len(delete_stacks) > 0:
+        write_manifest_part(delete_stacks, delete_prefix, account)
 
     # return json to step function
-    return delete_stacks
+    return {'Account': account, 'Count': len(delete_stacks)}
 
 
-def threaded_find_stacks(account, region, safe_stacks, startswith, credentials):
+def threaded_find_stacks(account, region, safe_stacks, startswith, credentials, limiter):
     # find all carve managed stacks in an account
-    stacks = aws_find_stacks(startswith, account, region, credentials)
+    with limiter.slot(account):
+        stacks = aws_find_stacks(startswith, account, region, credentials)
 
     if stacks is None:
         # print(f"cannot list stacks in {account} in {region}.")        
@@ -1,77 +1,97 @@
 import json
-import os
+import time
 
-from aws import aws_current_account, aws_discover_org_accounts, current_region
-from utils import get_deploy_key, load_graph, unique_node_values
+from aws import aws_discover_org_accounts
+from stack_registry import (graph_stacks, load_registry, prune_deleted, remove_markers, save_registry,
+                            stale_stacks, stack_key, sweep_due)
+from utils import get_deploy_key, load_graph, manifest_prefix, write_manifest, write_manifest_part
 
 
 def lambda_handler(event, context):
     '''
     Prepare to clean up carve managed stacks from all accounts that are not in the graph
-    - get a list of all accounts
     - create a list of stacks to protect that are used by the deployed graph
-    - return the list to the step function
+    - drop the stacks whose delete was confirmed since the last cleanup from the registry
+    - if a full sweep is not due, queue the registered stacks that are not protected for deletion,
+      they stay registered until their delete is confirmed
+    - if a full sweep is due, or requested with {'sweep': true}, get a list of all accounts and
+      write it to an s3 manifest for discovery in every region
+    - return the manifest reference to the step function
     '''
 
     deploy_key = get_deploy_key()
     G = load_graph(deploy_key, local=False)
 
-    # remove external beacons from the graph
-    external = [node for node in G.nodes() if G.nodes().data()[node]['Type'] == 'external']
-    G.remove_nodes_from(external)
-
     print(f'cleaning up after graph deploy: {deploy_key}')
 
-    accounts = aws_discover_org_accounts()
-
     # create a list for carve stacks to not delete
-    safe_stacks = []
+    safe_stacks = graph_stacks(G)
+    print(f'all safe stacks: {safe_stacks}')
 
-    # add the s3 bucket stacks for active regions to safe stacks
-    deploy_region_list = set(sorted(unique_node_values(G, 'Region')))
-    deploy_region_list.add(current_region)
-    for region in deploy_region_list:
-        s3_stack = f"{os.environ['Prefix']}carve-managed-bucket-{region}"
-        safe_stacks.append({
-            'StackName': s3_stack,
-            'Account': context.invoked_function_arn.split(":")[4],
-            'Region': region
-            })
+    # discovery writes stacks to delete into this manifest path, one part per account
+    delete_prefix = manifest_prefix('cleanup-delete')
 
-    # add all VPC stacks in the graph to safe stacks
-    vpcs = []
-    for subnet in list(G.nodes):
-        vpc = G.nodes().data()[subnet]['VpcId']
-        if vpc not in vpcs:
-            vpcs.append(vpc)
-            safe_stacks.append({
-                'StackName': f"{os.environ['Prefix']}carve-managed-beacons-{vpc}",
-                'Account': G.nodes().data()[subnet]['Account'],
-                'Region': G.nodes().data()[subnet]['Region']
-                })
+    registry = load_registry()
+    markers = []
+    if registry is not None:
+        markers = prune_deleted(registry, safe_stacks)
+    event = event or {}
+    sweep = sweep_due(registry) or event.get('Input', {}).get('sweep', False)
 
-    # add all private link stacks from the current account to safe stacks
-    for region in sorted(unique_node_values(G, 'Region')):
-        safe_stacks.append({
-            'StackName': f"{os.environ['Prefix']}carve-managed-privatelink-{region}",
-            'Account': aws_current_account(),
-            'Region': region
-            })
+    if not sweep:
+        # the stacks to delete are the registered stacks that are not in the graph
+        delete_stacks = {}
+        for stack in stale_stacks(registry, safe_stacks):
+            if stack.get('StackSet') is not None:
+                # the deploy removed the instance from its stack set
+                print(f"{stack['StackName']} in {stack['Account']} in {stack['Region']} was removed by {stack['StackSet']}")
+                del registry['Stacks'][stack_key(stack)]
+                continue
+            print(f"found {stack['StackName']} for deletion in {stack['Account']} in {stack['Region']}.")
+            delete_stack = {
+                'StackName': stack['StackName'],
+                'Region': stack['Region'],
+                'Account': stack['Account']
+                }
+            # the delete step looks up the id of stacks registered without one
+            if stack['StackId'] is not None:
+                delete_stack['StackId'] = stack['StackId']
+            delete_stacks.setdefault(stack['Account'], []).append(delete_stack)
+        for account, stacks in delete_stacks.items():
+            write_manifest_part(stacks, delete_prefix, account)
+        save_registry(registry)
+        remove_markers(markers)
 
-    print(f'all safe stacks: {safe_stacks}')
+        count = sum([len(s) for s in delete_stacks.values()])
+        print(f"registry cleanup: {count} stacks to delete in {len(delete_stacks)} accounts")
+        manifest = write_manifest([], 'cleanup-discover')
+        return {'Manifest': manifest, 'DeletePrefix': delete_prefix, 'Sweep': False,
+                'DeleteCount': count, 'DeleteParts': len(delete_stacks)}
+
+    accounts = aws_discover_org_accounts()
 
     # create discovery list of all accounts for step function
     discover_stacks = []
     for account_id, account_name in accounts.items():
         cleanup = {}
         cleanup['Account'] = account_id
+        cleanup['DeletePrefix'] = delete_prefix
         cleanup['SafeStacks'] = []
         for stack in safe_stacks:
             if stack['Account'] == account_id:
-                # cleanup['SafeStacks'] = safe_stacks
                 cleanup['SafeStacks'].append(stack['StackName'])
         discover_stacks.append(cleanup)
 
+    # discovery deletes every stack that is not safe, so only safe stacks stay registered
+    safe = set([stack_key(s) for s in safe_stacks])
+    registry = registry or {'Stacks': {}}
+    registry['Stacks'] = {k: v for k, v in registry['Stacks'].items() if k in safe}
+    registry['LastSweep'] = int(time.time())
+    save_registry(registry)
+    remove_markers(markers)
+    print(f"full cleanup sweep of {len(discover_stacks)} accounts")
+
     # returns to a step function iterator
-    # return json.dumps(discover_stacks, default=str)
-    return discover_stacks
+    manifest = write_manifest(discover_stacks, 'cleanup-discover')
+    return {'Manifest': manifest, 'DeletePrefix': delete_prefix, 'Sweep': True,
+            'DeleteCount': 0, 'DeleteParts': 0}
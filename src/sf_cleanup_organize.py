@@ -1,20 +1,30 @@
 import json
 
+from utils import manifest_reference
+
 
 def lambda_handler(event, context):
     '''
-    organize incoming payloads from a step function's map output to a single list
-    and return the list
+    organize incoming counts from a step function's map output into a single manifest
+    reference for the stacks written by discovery, and return the reference
     '''
     print(event)
     input = event['Input']
-    results = []
-    for item in input:
-        for each in item['Payload']:
-            results.append(each)
+    prefix = input['Payload']['DeletePrefix']
+
+    # distributed map output is nested once per manifest part, discovery
+    # writes one part for each account that has stacks to delete
+    # registry cleanup writes its delete parts before discovery, which then has no accounts
+    count = input['Payload'].get('DeleteCount', 0)
+    parts = input['Payload'].get('DeleteParts', 0)
+    for part in input['Discovered']:
+        for item in part:
+            if item['Payload']['Count'] > 0:
+                count += item['Payload']['Count']
+                parts += 1
 
     # return json to step function
-    return results
+    return manifest_reference(prefix, count, parts)
 
 
 
@@ -1,18 +1,30 @@
 import lambdavars
+import concurrent.futures
 import json
 import os
-from copy import deepcopy
-from utils import load_graph, get_deploy_key
+from utils import (beacon_stacks, load_graph, get_deploy_key, load_shards, save_shards,
+                   shard_assignment, write_manifest_parts)
+from deploy_plan import graph_vpcs, load_deployed, save_pending, stack_hash, vpc_change
+from stack_outputs import stack_outputs
+from subnet_code import upload_subnet_code
 from aws import *
 
 
-def deployment_list(G, upload_template=True):
+def deployment_list(G, upload_template=True, full=False):
     ''' 
     return a list of stacks to deploy, formatted for the deploy stacks step function
+    - only stacks for VPCs added or changed since the last deployment are returned and
+      uploaded, unless full is set, and the plan is saved for the finalize step to record
     '''
 
     # create a list for deployments
     deploy_beacons = []
+    all_beacons = []
+    changes = {}
+    uploads = {}
+
+    deployed = None if full else load_deployed()
+    vpc_info = graph_vpcs(G)
 
     # remove external beacons from the graph
     external = [node for node in G.nodes() if G.nodes().data()[node]['Type'] == 'external']
@@ -27,78 +39,208 @@ def deployment_list(G, upload_template=True):
         vpcs[G.nodes().data()[subnet]['VpcId']] = (a, r)
         regions.add(r)
 
-    # create a region map of private link endpoints
+    # create a region map of private link endpoints from one harvest of the carve stacks
     region_map = {}
     for region in regions:
         # get carve private link stack outputs
         stackname = f"{os.environ['Prefix']}carve-managed-privatelink-{region}"
-        outputs = aws_get_stack_outputs_dict(stackname, current_region)
+        outputs = stack_outputs(stackname, current_region)
         try:
             region_map[region] = f"com.amazonaws.vpce.{current_region}.{outputs['EndpointService']}"
-        except:
-            raise f"No private link service found in region {region}"
+        except KeyError:
+            raise Exception(f"No private link service found in region {region}")
 
+    # ship the subnet lambda code to the managed bucket in each region
+    region_code = upload_subnet_code(regions, upload=upload_template)
 
-    # generate 1 CFN stack per VPC
+    # generate 1 CFN stack per VPC, split into shard stacks for VPCs with many subnets.
+    # subnets keep the shard they had in the last deployment list
+    previous_shards = load_shards()
+    shards = {}
     for vpc, ar in vpcs.items():
 
         account = ar[0]
         region = ar[1]
 
-        vpc_subnets = [x for x,y in G.nodes(data=True) if y['VpcId'] == vpc]
+        vpc_subnets = sorted([x for x,y in G.nodes(data=True) if y['VpcId'] == vpc])
+
+        vpc_stacks = beacon_stacks(vpc, vpc_subnets, previous_shards.get(vpc))
+        shards[vpc] = shard_assignment(vpc_stacks)
+        for shard in vpc_stacks:
+
+            # generate the CFN template for this VPC
+            vpc_template, stack = generate_template(vpc, vpc_subnets, account, region_map[region], region, region_code[region], shard)
+            data = render_template(vpc_template)
+            stack['TemplateHash'] = stack_hash(data, stack['Parameters'])
+            all_beacons.append(stack)
+
+            # skip stacks that are already deployed with the same template
+            change = vpc_change(vpc, vpc_info[vpc], stack, deployed)
+            if change is None:
+                continue
+            changes[stack['StackName']] = change
+
+            # queue template for upload to s3
+            uploads[stack['Template']] = data
 
-        # generate the CFN template for this VPC
-        vpc_template, stack = generate_template(vpc, vpc_subnets, account, region_map[region], region)
+            # add stack to list of stacks to deploy
+            deploy_beacons.append(stack)
 
-        # push template to s3
-        if upload_template:
-            key = f"managed_deployment/{vpc}.cfn.json"
-            data = json.dumps(vpc_template, ensure_ascii=True, indent=2, sort_keys=True)
-            aws_put_direct(data, key)
-        
-        # add stack to list of stacks to deploy
-        deploy_beacons.append(stack)
+    if upload_template:
+        upload_templates(uploads)
+        save_pending(all_beacons, changes, deployed)
+        save_shards(shards)
 
     return deploy_beacons
 
 
-def generate_template(vpc, vpc_subnets, account, vpce_service, region):
+def upload_templates(uploads):
+    '''
+    upload rendered templates to s3 concurrently, skipping templates already in s3 with the same content
+    uploads = {key: data, ...}
+    '''
+    written = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=50) as executor:
+        futures = [executor.submit(aws_put_if_changed, data, key) for key, data in uploads.items()]
+        for future in concurrent.futures.as_completed(futures):
+            if future.result():
+                written += 1
+    print(f"uploaded {written} templates, {len(uploads) - written} already current in s3")
 
-    # open vpc stack base template
-    with open("managed_deployment/carve-vpc-stack.cfn.json") as f:
-        vpc_template = json.load(f)
 
-    # open lambda code to insert into template
-    with open("managed_deployment/subnet_lambda.py") as f:
-        lambda_code = f.read()
+def deploy_limits():
+    '''
+    return the stack deployment concurrency limits, which can be set in the lambda environment
+     - DeployGroupConcurrency: stacks deployed at once in a single account/region
+     - DeployWaveConcurrency: account/region groups deployed at once
+     - DeployEngine: 'batch' deploys each group in the multiplexed stack engine lambda,
+       'map' deploys each stack in its own state machine iteration
+    '''
+    limits = {'group': 5, 'wave': 50, 'engine': 'map'}
+    if 'DeployGroupConcurrency' in os.environ:
+        limits['group'] = int(os.environ['DeployGroupConcurrency'])
+    if 'DeployWaveConcurrency' in os.environ:
+        limits['wave'] = int(os.environ['DeployWaveConcurrency'])
+    if os.environ.get('DeployEngine', '') in ['batch', 'map']:
+        limits['engine'] = os.environ['DeployEngine']
+    return limits
+
+
+def wave_plan(stacks):
+    '''
+    group stacks by account and region, and order the groups so that consecutive groups
+    are in different regions. the largest groups in each region are scheduled first, since
+    the per group concurrency limit makes them the longest to finish.
+    returns a list of groups, each a list of stacks
+    '''
+    groups = {}
+    for stack in stacks:
+        key = (stack['Account'], stack['Region'])
+        if key not in groups:
+            groups[key] = []
+        groups[key].append(stack)
+
+    # queue the groups for each region, largest first
+    regions = {}
+    for key in sorted(groups, key=lambda k: (-len(groups[k]), k)):
+        region = key[1]
+        if region not in regions:
+            regions[region] = []
+        regions[region].append(key)
+
+    # take one group from each region in turn, largest first
+    plan = []
+    while len(regions) > 0:
+        for region in sorted(regions, key=lambda r: (-len(groups[regions[r][0]]), r)):
+            plan.append(groups[regions[region].pop(0)])
+            if len(regions[region]) == 0:
+                del regions[region]
+
+    return plan
+
+
+# the base template is loaded once per lambda container
+base_templates = {}
 
-    # update the VPC CFN template to contain 1 lambda function per subnet
-    for subnet in vpc_subnets:
-        Function = deepcopy(vpc_template['Resources']['SubnetFunction'])
-        Function['Properties']['FunctionName'] = f"{os.environ['Prefix']}carve-{subnet}"
-        Function['Properties']['Environment']['Variables']['VpcSubnetIds'] = subnet
-        Function['Properties']['VpcConfig']['SubnetIds'] = [subnet]
-        Function['Properties']['Code']['ZipFile'] = lambda_code
-        name = f"Function{subnet.split('-')[-1]}"
-        vpc_template['Resources'][name] = deepcopy(Function)
 
-    # remove original SubnetFunction object from template
-    del vpc_template['Resources']['SubnetFunction']
+def load_base_template():
+    ''' return the VPC stack base template '''
+    if 'template' not in base_templates:
+        # open vpc stack base template
+        with open("managed_deployment/carve-vpc-stack.cfn.json") as f:
+            base_templates['template'] = json.load(f)
+
+    return base_templates['template']
+
+
+def subnet_function(base, subnet, code):
+    '''
+    build the lambda function resource for a subnet from the base SubnetFunction resource.
+    only the properties that differ per subnet are copied, the rest of the resource is
+    shared with the base template, which is never modified
+    '''
+    properties = dict(base['Properties'])
+    properties['FunctionName'] = f"{os.environ['Prefix']}carve-{subnet}"
+    properties['Environment'] = dict(properties['Environment'])
+    properties['Environment']['Variables'] = dict(properties['Environment']['Variables'])
+    properties['Environment']['Variables']['VpcSubnetIds'] = subnet
+    properties['VpcConfig'] = dict(properties['VpcConfig'])
+    properties['VpcConfig']['SubnetIds'] = [subnet]
+    properties['Code'] = code
+
+    function = dict(base)
+    function['Properties'] = properties
+    return function
+
+
+def render_template(vpc_template):
+    # minified template json for upload
+    return json.dumps(vpc_template, ensure_ascii=True, separators=(',', ':'))
+
+
+# resources in the base template that only the first stack of a VPC holds
+vpc_resources = ['CarvePrivateEndpoint', 'EndpointSecurityGroup', 'ENIAddressesLambda', 'GetPrivateIPs']
+
+
+def generate_template(vpc, vpc_subnets, account, vpce_service, region, code, shard=None):
+    '''
+    code is the lambda Code property for the subnet functions, the S3 artifact from upload_subnet_code()
+    shard is one of beacon_stacks(vpc, vpc_subnets), the template only has the functions for
+    the shard's subnets, and only the first shard has the VPC endpoint and Beacons output
+    '''
+    if shard is None:
+        shard = beacon_stacks(vpc, vpc_subnets)[0]
+
+    base = load_base_template()
+
+    # the VPC CFN template contains 1 lambda function per subnet in place of SubnetFunction
+    vpc_template = dict(base)
+    vpc_template['Resources'] = {k: v for k, v in base['Resources'].items() if k != 'SubnetFunction'}
+    if shard['Shard'] > 0:
+        vpc_template['Resources'] = {k: v for k, v in vpc_template['Resources'].items() if k not in vpc_resources}
+        del vpc_template['Outputs']
+    for subnet in shard['Subnets']:
+        name = f"Function{subnet.split('-')[-1]}"
+        vpc_template['Resources'][name] = subnet_function(base['Resources']['SubnetFunction'], subnet, code)
 
     # generate CFN stack deployment parameters
     stack = {}
-    stack['StackName'] = f"{os.environ['Prefix']}carve-managed-beacons-{vpc}"
+    stack['StackName'] = shard['StackName']
     stack['Account'] = account
     stack['Region'] = region
-    stack['Template'] = f"managed_deployment/{vpc}.cfn.json"
+    if shard['Shard'] > 0:
+        stack['Template'] = f"managed_deployment/{vpc}-shard{shard['Shard']}.cfn.json"
+    else:
+        stack['Template'] = f"managed_deployment/{vpc}.cfn.json"
     stack['Parameters'] = [
         {
             "ParameterKey": "VpcId",
             "ParameterValue": vpc
         },
         {
+            # the VPC endpoint in the first shard has an interface in every subnet
             "ParameterKey": "VpcSubnetIds",
-            "ParameterValue": ','.join(vpc_subnets)
+            "ParameterValue": ','.join(vpc_subnets if shard['Shard'] == 0 else shard['Subnets'])
         },      
         {
             "ParameterKey": "Prefix",
@@ -120,11 +262,25 @@ def generate_template(vpc, vpc_subnets, account, vpce_service, region):
 def lambda_handler(event, context):
 
     '''
-    returns a list of cfn stack deployments using deployment_list() to render the templates
-    and generate the stack parameters
+    writes a manifest of cfn stack deployments using deployment_list() to render the templates
+    and generate the stack parameters, and returns the manifest reference
+    - stacks are written as a wave plan, one manifest part per account/region group
+    - only stacks changed since the last deployment are written, unless the deploy graph
+      execution input has "full": true
     '''
+    full = False
+    if event is not None and 'Input' in event:
+        full = event['Input'].get('full', False) is True
+
     G = load_graph(get_deploy_key(), local=False)
-    stack_deployments = deployment_list(G)
+    stack_deployments = deployment_list(G, full=full)
+
+    limits = deploy_limits()
+    plan = wave_plan(stack_deployments)
+    for group in plan:
+        print(f"wave plan: {len(group)} stacks in {group[0]['Account']} {group[0]['Region']}")
+    print(f"wave plan: {len(plan)} groups, {limits['wave']} groups at once, {limits['group']} stacks per group at once, {limits['engine']} engine")
 
-    # return stack_deployments
-    return json.dumps(stack_deployments, default=str)
+    # the stack list is too large for a step function payload, pass it thru s3
+    manifest = write_manifest_parts(plan, 'deployment-list', limits['wave'], limits['group'], limits['engine'])
+    return json.dumps(manifest, default=str)
@@ -1,85 +1,120 @@
 import lambdavars
-from utils import get_deploy_key, carve_role_arn, load_graph
+from utils import beacon_stacks, get_deploy_key, carve_role_arn, load_graph, load_shards
+from beacon_inventory import load_inventory, save_inventory
+from deploy_plan import deployed_key, load_pending, record_deployed
+from stack_outputs import harvest_stacks
+from stack_registry import graph_stacks, register_stacks
 # from sf_deploy_graph_deployment_list import deployment_list
 from aws import *
-import concurrent.futures
 
 
 
-def inventory_beacons(account_dict):
+def inventory_beacons(account_dict, stack_ids=None):
     '''
-    run the stack_outputs_thread() function in parallel for all stacks in the account_dict
+    harvest the stack outputs of every account/region in the account_dict, and read the
+    beacons from the Beacons output of each VPC stack
     account_dict = {account_id: [{stackname: stackname1, region: region}, {stackname: stackname2, region: region}], ...}
+    the stack id of each registered stack found is added to stack_ids
     '''
-    futures = set()
+    if stack_ids is None:
+        stack_ids = {}
+
+    targets = []
+    for account_id, stacks in account_dict.items():
+        credentials = aws_assume_role(carve_role_arn(account_id), f"endpoint-inventory")
+        for region in set([stack['region'] for stack in stacks]):
+            targets.append((account_id, region, credentials))
+    harvest = harvest_stacks(targets, max_age=0)
+
     beacons = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=300) as executor:
-            # create threads
-            for account_id, stacks in account_dict.items():
-                credentials = aws_assume_role(carve_role_arn(account_id), f"endpoint-inventory")
-                for stack in stacks:
-                    futures.add(executor.submit(
-                        stack_outputs_thread,
-                        credentials=credentials,
-                        region=stack['region'],
-                        stackname=stack['stackname']
-                        ))
-            # collect thread results
-            for future in concurrent.futures.as_completed(futures):
-                beacons.update(future.result())
+    for account_id, stacks in account_dict.items():
+        for stack in stacks:
+            region_stacks = harvest[(account_id, stack['region'])]
+            for stackname in [stack['stackname']] + stack.get('shards', []):
+                if stackname in region_stacks:
+                    stack_ids[stackname] = region_stacks[stackname]['StackId']
+            try:
+                outputs = region_stacks[stack['stackname']]['Outputs']
+                stack_outputs = json.loads(outputs['Beacons'])
+            except KeyError:
+                raise Exception(f"No Beacons stack output found in {stack['stackname']} in account {account_id}")
+            for subnet, ip in stack_outputs.items():
+                beacons[subnet] = {
+                    'type': 'managed',
+                    'region': stack['region'],
+                    'account': account_id,
+                    'address': f"http://{ip}/up"
+                }
 
     return beacons
 
 
-def stack_outputs_thread(credentials, region, stackname):
-    ''' 
-    this function is used as a thread and will return a dict of the stack outputs for the provided stack
-    '''
-    outputs = aws_get_stack_outputs_dict(stackname, region, credentials=credentials)
-    try:
-        beacons = {}
-        stack_outputs = json.loads(outputs['Beacons'])
-        for subnet, ip in stack_outputs.items():
-            beacons[subnet] = {
-                'type': 'managed',
-                'region': region,
-                'account': credentials['Account'],
-                'address': f"http://{ip}/up"
-            }
-        return beacons
-    except KeyError:
-        raise Exception(f"No Beacons stack output found in {stackname} in account {credentials['Account']}")
-    
-
 def stacks_by_account(G):
     '''
     determine all deployed stacks for all VPCs in the graph G, with their account and region
     Using that, generate an account dictionary of stacks:
-       account_dict = {account_id: [{stackname: stackname1, region: region}, {stackname: stackname2, region: region}], ...}
+       account_dict = {account_id: [{stackname: stackname1, region: region, shards: [shard stacknames]}, ...], ...}
     '''
     account_dict = {}
-    vpcs = []
+    vpcs = {}
     for subnet in list(G.nodes):
         if G.nodes[subnet]['Type'] == 'managed':
             vpc = G.nodes().data()[subnet]['VpcId']
             if vpc not in vpcs:
-                account = G.nodes().data()[subnet]['Account']
-                region = G.nodes().data()[subnet]['Region']
-                stackname = f"{os.environ['Prefix']}carve-managed-beacons-{vpc}"
-                if account not in account_dict:
-                    account_dict[account] = []
-                account_dict[account].append({'stackname': stackname, 'region': region}) 
+                vpcs[vpc] = {
+                    'account': G.nodes().data()[subnet]['Account'],
+                    'region': G.nodes().data()[subnet]['Region'],
+                    'subnets': []
+                    }
+            vpcs[vpc]['subnets'].append(subnet)
+
+    shards = load_shards()
+    for vpc, info in vpcs.items():
+        # the Beacons output for all subnets is on the first stack of a sharded VPC
+        stacks = beacon_stacks(vpc, info['subnets'], shards.get(vpc))
+        if info['account'] not in account_dict:
+            account_dict[info['account']] = []
+        account_dict[info['account']].append({
+            'stackname': stacks[0]['StackName'],
+            'region': info['region'],
+            'shards': [s['StackName'] for s in stacks[1:]]
+            })
     return account_dict
 
 
-def update_beacon_inventory(G):
+def update_beacon_inventory(G, stack_ids=None, changed=None):
     '''
-    update the inventory of beacons in the graph G
+    update the inventory of beacons in the graph G. when changed is a set of stack names,
+    only VPCs with a changed stack are read from their stack outputs, the beacons of other
+    VPCs are kept from the previous inventory, and beacons no longer in the graph are dropped
     '''
+    previous = load_inventory()
+    managed = set([n for n in G.nodes if G.nodes[n]['Type'] == 'managed'])
+
     # get all stacks by account
     account_dict = stacks_by_account(G)
-    # add managed beacons to inventory
-    beacons = inventory_beacons(account_dict)
+
+    beacons = {}
+    if changed is not None and previous['Version'] > 0:
+        # keep the beacons of unchanged VPCs and refresh the VPCs touched by this deployment
+        refresh = {}
+        for account_id, stacks in account_dict.items():
+            for stack in stacks:
+                if len(changed.intersection([stack['stackname']] + stack['shards'])) > 0:
+                    refresh.setdefault(account_id, []).append(stack)
+        print(f"refreshing beacons of {sum([len(s) for s in refresh.values()])} changed VPC stacks")
+        for subnet, beacon in previous['Beacons'].items():
+            if beacon['type'] == 'managed' and subnet in managed:
+                beacons[subnet] = beacon
+        beacons.update(inventory_beacons(refresh, stack_ids))
+
+        if len(managed - set(beacons)) > 0:
+            print(f"{len(managed - set(beacons))} managed subnets missing from the previous inventory, refreshing all VPCs")
+            beacons = {}
+
+    if len(beacons) == 0:
+        # add managed beacons to inventory
+        beacons = inventory_beacons(account_dict, stack_ids)
 
     # add external targets
     for node in list(G.nodes):
@@ -89,12 +124,8 @@ def update_beacon_inventory(G):
                 'address': G.nodes[node]['Address']
             }
 
-    print("beacons:", beacons)
-
     # push inventory to S3
-    data = json.dumps(beacons, ensure_ascii=True, indent=2, sort_keys=True)
-    aws_put_direct(data, "managed_deployment/beacon-inventory.json")
-
+    return save_inventory(beacons, previous)
 
 
 def lambda_handler(event, context):
@@ -105,14 +136,24 @@ def lambda_handler(event, context):
 
     G = load_graph(deploy_key, local=False)
 
-    # get inventory of all beacons (endpoint private IP addresses)
-    update_beacon_inventory(G)
+    # get inventory of the beacons (endpoint private IP addresses) in stacks this deployment changed
+    pending = load_pending()
+    changed = None if pending is None else set(pending['Changes'])
+    stack_ids = {}
+    update_beacon_inventory(G, stack_ids, changed)
 
     # move deployment key to deployed_graph
     key_name = deploy_key.split('/')[-1]
     aws_copy_s3_object(deploy_key, f'deployed_graph/{key_name}')
     aws_delete_s3_object(deploy_key)
 
+    # record the stack template hashes of this deployment for the next deployment plan
+    record_deployed()
+
+    # register every stack of the deployed graph for cleanup
+    deployed = json.loads(aws_read_s3_direct(deployed_key) or '{"Stacks": {}}')
+    register_stacks(graph_stacks(G), hashes=deployed['Stacks'], stack_ids=stack_ids)
+
 
 # main handler for local testing
 if __name__ == '__main__':
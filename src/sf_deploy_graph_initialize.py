@@ -5,7 +5,7 @@ import concurrent.futures
 from networkx.readwrite import json_graph
 import json
 import os
-from utils import load_graph, unique_node_values
+from utils import load_graph, unique_node_values, write_manifest
 from aws import *
 import time
 
@@ -76,10 +76,23 @@ def lambda_handler(event, context):
             "Template": key
         })
 
+    # with the stacksets backend, the deploy buckets are instances of one stack set. the
+    # stack set is advanced even with no buckets, so instances of removed regions are deleted
+    engine = 'map'
+    stacksets = []
+    if os.environ.get('DeployBackend', 'stacks') == 'stacksets':
+        engine = 'stackset'
+        stacksets = [f"{os.environ['Prefix']}carve-managed-bucket"]
+        for stack in deploy_buckets:
+            stack['StackSet'] = stacksets[0]
+
     # return deploy_buckets
     print(f"creating buckets: {deploy_buckets}")
 
-    return json.dumps(deploy_buckets, default=str)
+    manifest = write_manifest(deploy_buckets, 'deploy-buckets', engine=engine)
+    if len(stacksets) > 0:
+        manifest['StackSetNames'] = stacksets
+    return json.dumps(manifest, default=str)
 
 
 
@@ -6,14 +6,112 @@ from aws import *
 from utils import (carve_role_arn, save_graph)
 
 
-def discover_subnets(region, account_id, account_name, credentials):
+def subnet_associations(tables, region, credentials):
+    '''
+    return the route table and network ACL of each subnet in a region. subnets without an
+    explicit route table association use the main route table, which is keyed by VpcId
+    '''
+    route_tables = {}
+    for table in tables:
+        for association in table.get('Associations', []):
+            if association.get('Main'):
+                route_tables[table['VpcId']] = table['RouteTableId']
+            elif 'SubnetId' in association:
+                route_tables[association['SubnetId']] = table['RouteTableId']
+
+    network_acls = {}
+    for acl in aws_describe_network_acls(region, credentials):
+        for association in acl.get('Associations', []):
+            network_acls[association['SubnetId']] = acl['NetworkAclId']
+
+    return route_tables, network_acls
+
+
+def route_target(route):
+    # the next hop of a VPC route table route, blackholed routes have no target
+    if route.get('State') == 'blackhole':
+        return 'blackhole'
+    for key in ['GatewayId', 'VpcPeeringConnectionId', 'TransitGatewayId', 'NatGatewayId',
+                'NetworkInterfaceId', 'InstanceId', 'EgressOnlyInternetGatewayId',
+                'LocalGatewayId', 'CarrierGatewayId', 'CoreNetworkArn']:
+        if key in route:
+            return route[key]
+    return 'unknown'
+
+
+def discover_routing(tables, region, credentials):
+    '''
+    return the routing data of a region for the static reachability model. only IPv4 routes
+    are kept, prefix list routes keep the prefix list id as their destination
+    routing = {
+        'RouteTables': {route_table: {'VpcId', 'Routes': [[destination, target]]}},
+        'Peerings': {pcx: [requester VpcId, accepter VpcId]},
+        'Attachments': {tgw attachment: {'TransitGatewayId', 'ResourceType', 'ResourceId', 'RouteTableId'}},
+        'TransitGatewayRouteTables': {tgw route table: {'TransitGatewayId', 'Routes': [[destination, [attachments] or 'blackhole']], 'Truncated'}}
+    }
+    transit gateway route tables with more routes than one search returns are Truncated
+    '''
+    routing = {'RouteTables': {}, 'Peerings': {}, 'Attachments': {}, 'TransitGatewayRouteTables': {}}
+
+    for table in tables:
+        routes = []
+        for route in table.get('Routes', []):
+            destination = route.get('DestinationCidrBlock', route.get('DestinationPrefixListId'))
+            if destination is not None:
+                routes.append([destination, route_target(route)])
+        routing['RouteTables'][table['RouteTableId']] = {'VpcId': table['VpcId'], 'Routes': routes}
+
+    for pcx in aws_describe_peers(region, credentials):
+        if pcx['Status']['Code'] == 'active':
+            routing['Peerings'][pcx['VpcPeeringConnectionId']] = [
+                pcx['RequesterVpcInfo']['VpcId'],
+                pcx['AccepterVpcInfo']['VpcId']
+            ]
+
+    for attachment in aws_describe_transit_gateway_attachments(region, credentials):
+        if attachment['State'] != 'available':
+            continue
+        association = attachment.get('Association', {})
+        routing['Attachments'][attachment['TransitGatewayAttachmentId']] = {
+            'TransitGatewayId': attachment['TransitGatewayId'],
+            'ResourceType': attachment['ResourceType'],
+            'ResourceId': attachment.get('ResourceId'),
+            'RouteTableId': association.get('TransitGatewayRouteTableId') if association.get('State') == 'associated' else None
+        }
+
+    # transit gateway route tables are only visible to the account that owns the transit gateway
+    for table in aws_describe_transit_gateway_route_tables(region, credentials):
+        if table['State'] != 'available':
+            continue
+        routes = []
+        found, truncated = aws_search_transit_gateway_routes(table['TransitGatewayRouteTableId'], region, credentials)
+        for route in found:
+            destination = route.get('DestinationCidrBlock', route.get('PrefixListId'))
+            if destination is None:
+                continue
+            if route['State'] == 'blackhole':
+                routes.append([destination, 'blackhole'])
+            else:
+                routes.append([destination, [a['TransitGatewayAttachmentId'] for a in route.get('TransitGatewayAttachments', [])]])
+        routing['TransitGatewayRouteTables'][table['TransitGatewayRouteTableId']] = {
+            'TransitGatewayId': table['TransitGatewayId'],
+            'Routes': routes,
+            'Truncated': truncated
+        }
+        if truncated:
+            print(f"transit gateway route table {table['TransitGatewayRouteTableId']} has more than {len(found)} routes, its routes are uncertain")
+
+    return routing
+
+
+def discover_subnets(region, account_id, account_name, credentials, tables):
     ''' get subnets in account/region, returns nx.Graph object of subnets nodes'''
 
     # create graph structure for subnets
     G = nx.Graph()
 
-    # list will be filled with all non-default VpcIds owned by this account
-    vpcids = []
+    # all non-default VpcIds owned by this account, with their IPv4 CIDR blocks, primary first
+    vpcids = {}
 
     vpcs = aws_describe_vpcs(region, credentials, account_id)
     for vpc in vpcs:
@@ -26,8 +124,14 @@ def discover_subnets(region, account_id, account_name, credentials):
             # don't add default VPCs
             continue
 
-        vpcids.append(vpc['VpcId'])
+        vpcids[vpc['VpcId']] = [vpc['CidrBlock']]
+        for association in vpc.get('CidrBlockAssociationSet', []):
+            if association['CidrBlockState']['State'] == 'associated' and association['CidrBlock'] not in vpcids[vpc['VpcId']]:
+                vpcids[vpc['VpcId']].append(association['CidrBlock'])
+
 
+    # route table and network ACL associations, for the routing equivalence classes
+    route_tables, network_acls = subnet_associations(tables, region, credentials)
 
     for subnet in aws_describe_subnets(region, account_id, credentials):
 
@@ -57,8 +161,12 @@ def discover_subnets(region, account_id, account_name, credentials):
             Region=region,
             AvailabilityZone=subnet['AvailabilityZone'],
             AvailabilityZoneId=subnet['AvailabilityZoneId'],
-            CidrBlock=vpc['CidrBlock'],
+            CidrBlock=vpcids[subnet['VpcId']][0],
+            CidrBlocks=vpcids[subnet['VpcId']],
+            SubnetCidrBlock=subnet['CidrBlock'],
             VpcId=subnet['VpcId'],
+            RouteTableId=route_tables.get(subnet['SubnetId'], route_tables.get(subnet['VpcId'])),
+            NetworkAclId=network_acls.get(subnet['SubnetId']),
             Type='managed'
             )
 
@@ -69,7 +177,8 @@ def discover_subnets(region, account_id, account_name, credentials):
 def lambda_handler(event, context):
     '''
     this lambda discovers all subnets in the regions and accounts defined in the event
-    the reults are uploaded to the carve managed S3 bucket in the discovery directory
+    the reults are uploaded to the carve managed S3 bucket in the discovery directory, and
+    the routing data of the account for the reachability model in the routing_discovery directory
 
     event = {'regions': ['us-east-1', ...], 'account': {'account_id': '123456789012', 'account_name': 'awsaccountname'}}
     
@@ -88,6 +197,9 @@ def lambda_handler(event, context):
     A = nx.Graph()
     A.graph['Name'] = f'subnets_{account_id}_{account_name}'
 
+    # route tables, peerings and transit gateway routes for all regions in this account
+    routing = {}
+
     # discover subnets in each region
     for region in regions:
         # test if we can connect to the region
@@ -95,16 +207,21 @@ def lambda_handler(event, context):
             continue
 
         # create networkx instance of all subnets in this region
-        R = discover_subnets(region, account_id, account_name, credentials)
+        tables = aws_describe_route_tables(region, credentials)
+        R = discover_subnets(region, account_id, account_name, credentials, tables)
         
         # add discovered subnets to A
         A.add_nodes_from(R.nodes.data())
 
+        routing[region] = discover_routing(tables, region, credentials)
+
 
     if len(A.nodes) > 0:
         save_graph(A, f"/tmp/{A.graph['Name']}.json")
         aws_upload_file_s3(f"discovery/{A.graph['Name']}.json", f"/tmp/{A.graph['Name']}.json")
 
+    aws_put_direct(json.dumps(routing, sort_keys=True), f"routing_discovery/{account_id}.json")
+
     print(f"discovered {len(A.nodes)} subnets in {account_id} {account_name}: {A.nodes.data()}")
 
 
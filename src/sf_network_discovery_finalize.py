@@ -8,6 +8,7 @@ from networkx.readwrite import json_graph
 
 from aws import *
 from utils import load_graph, save_graph
+from cidr_index import build_cidr_index, cidr_index_key, save_cidr_index
 
 
 def lambda_handler(event, context):
@@ -32,7 +33,15 @@ def lambda_handler(event, context):
     save_graph(G, f"/tmp/{name}.json")
     aws_upload_file_s3(f'discovered/{name}.json', f"/tmp/{name}.json")
 
-    result = {"discovered": f"s3://{os.environ['CarveS3Bucket']}/discovered/{name}.json"}
+    # index the CIDR blocks of the discovered subnets for overlap reports and address lookups
+    index = build_cidr_index(G, f'discovered/{name}.json')
+    save_cidr_index(index, cidr_index_key(f'discovered/{name}.json'))
+
+    result = {
+        "discovered": f"s3://{os.environ['CarveS3Bucket']}/discovered/{name}.json",
+        "overlaps": len(index['Overlaps']),
+        "conflicts": len(index['Conflicts'])
+    }
 
     return result
 
@@ -4,28 +4,33 @@ import json
 import os
 
 from aws import *
-from utils import load_graph, unique_node_values
-from privatelink import (add_peer_routes, private_link_deployment,
-                            privatelink_template)
+from stack_outputs import core_account, harvest_stacks
+from utils import load_graph, unique_node_values, write_manifest
+from privatelink import (add_peer_routes, az_maps, deployment_az_map,
+                            private_link_deployment, privatelink_template, for_each_region)
 
 
 def update_peer_names(deploy_regions):
-    routing = False
     stackname = f"{os.environ['Prefix']}carve-managed-privatelink"
+    harvest = harvest_stacks([(core_account, r, None) for r in deploy_regions])
+    peers = {}
     for region in deploy_regions:
-        # stack = aws_describe_stack(stackname, region)
-        outputs = aws_get_stack_outputs_dict(stackname, region)
+        outputs = harvest[(core_account, region)].get(stackname, {}).get('Outputs', {})
         if 'VpcPeeringConnectionId' in outputs:
-            routing = True
-            aws_update_tags(
-                resource=outputs['VpcPeeringConnectionId'],
-                tags = [
-                    {
-                        "Key": "Name",
-                        "Value": f"{os.environ['Prefix']}carve-privatelink-{region}"
-                    }])
-            print(f"updated the name on VPC peering connection id {outputs['VpcPeeringConnectionId']} in {region}")
-    return routing
+            peers[region] = outputs['VpcPeeringConnectionId']
+    for_each_region(update_peer_name, peers, peers)
+    return len(peers) > 0
+
+
+def update_peer_name(region, peers):
+    aws_update_tags(
+        resource=peers[region],
+        tags = [
+            {
+                "Key": "Name",
+                "Value": f"{os.environ['Prefix']}carve-privatelink-{region}"
+            }])
+    print(f"updated the name on VPC peering connection id {peers[region]} in {region}")
 
 
 def lambda_handler(event, context):
@@ -65,14 +70,8 @@ def lambda_handler(event, context):
     routing = update_peer_names(peer_regions)
     print(f"routing found: {routing}")
 
-    # get the AZ id to AZ name mapping for this account
-    azs = aws_describe_availability_zones(current_region)['AvailabilityZones']
-
     # map the AZ names that are in the deployment in this region to the AZ id
-    azmap = {}
-    for az in azs:
-        if az['ZoneId'] in deploy_azids:
-            azmap[az['ZoneName']] = az['ZoneId']
+    azmap = deployment_az_map(az_maps([current_region])[current_region], deploy_azids)
 
     # build the private link CFN template for the current region/subnets
     second_octet = 0
@@ -91,8 +90,9 @@ def lambda_handler(event, context):
 
     # deploy the private link CFN template using the deploy stacks step function
     deploy_stacks = private_link_deployment(deployments, aws_current_account(), deploy_regions, routing)
-    
-    return json.dumps(deploy_stacks, default=str)
+    manifest = write_manifest(deploy_stacks, 'privatelink-core')
+
+    return json.dumps(manifest, default=str)
 
 
 
@@ -101,7 +101,7 @@ if __name__ == '__main__':
     # event = {"Input": {"graph": "deploy_active/carve-test-pl-subnets.json"}}
     deploy = json.loads(lambda_handler(event, None))
 
-    if len(deploy) > 0:
+    if deploy['Count'] > 0:
         import time
         name = f"deploying-privatelink-{int(time.time())}"
         aws_start_stepfunction(os.environ['DeployStacksStateMachine'], {'Input': deploy}, name)
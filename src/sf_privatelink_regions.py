@@ -2,8 +2,19 @@ import lambdavars
 
 import json
 from aws import *
-from utils import load_graph, unique_node_values
-from privatelink import private_link_deployment, privatelink_template
+from utils import load_graph, unique_node_values, write_manifest
+from privatelink import (az_maps, deployment_az_map, private_link_deployment,
+                         privatelink_template, for_each_region)
+
+
+def upload_region_template(region, octets, private_link_subnets, deploy_accounts):
+    # build the privatelink CFN template for a region and upload it to s3
+    template = privatelink_template(region, octets[region], deploy_accounts, private_link_subnets[region])
+    key = f"managed_deployment/private-link-{region}.cfn.json"
+    data = json.dumps(template, ensure_ascii=True, indent=2, sort_keys=True)
+    aws_put_direct(data, key)
+    print(f"successfully uploaded privatelink template to s3: {key}")
+    return key
 
 
 def lambda_handler(event, context):
@@ -40,35 +51,22 @@ def lambda_handler(event, context):
 
     # get all azid's in use by region
     private_link_subnets = {}
-    i = 0
-    for region in deploy_regions:
-        private_link_subnets[region] = {}
-        # get the AZ id to AZ name mapping for this account
-        azs = aws_describe_availability_zones(region)['AvailabilityZones']
-        # map the AZ names that are in the deployment in this region to the AZ id
-        for az in azs:
-            if az['ZoneId'] in deploy_azids:
-                private_link_subnets[region][az['ZoneName']] = az['ZoneId']
-                i += 1
+    for region, zones in az_maps(deploy_regions).items():
+        private_link_subnets[region] = deployment_az_map(zones, deploy_azids)
+    i = sum([len(azmap) for azmap in private_link_subnets.values()])
 
     print(f"total azids in use across additional {len(deploy_regions)} regions: {i}")
 
     # build the privatelink CFN templates for each region with the correct azids and upload to s3
-    deployments = {}
-    second_octet = 1
-    for region, azmap in sorted(private_link_subnets.items()):
-        template = privatelink_template(region, second_octet, deploy_accounts, azmap)
-        key = f"managed_deployment/private-link-{region}.cfn.json"
-        data = json.dumps(template, ensure_ascii=True, indent=2, sort_keys=True)
-        aws_put_direct(data, key)
-        deployments[region] = key
-        second_octet += 1
-        print(f"successfully uploaded privatelink template to s3: {key}")
+    octets = {region: octet for octet, region in enumerate(sorted(private_link_subnets), start=1)}
+    keys = for_each_region(upload_region_template, sorted(private_link_subnets), octets, private_link_subnets, deploy_accounts)
+    deployments = {region: keys[region] for region in sorted(keys)}
 
     # deploy the private link CFN templates using the deploy stacks step function
     deploy_stacks = private_link_deployment(deployments, aws_current_account(), deploy_regions)
+    manifest = write_manifest(deploy_stacks, 'privatelink-regions')
 
-    return json.dumps(deploy_stacks, default=str)
+    return json.dumps(manifest, default=str)
 
 
 
@@ -76,7 +74,7 @@ if __name__ == '__main__':
     event = {"Input": {"graph": "discovered/carve-discovered-1652883036.json"}}
     deploy = json.loads(lambda_handler(event, None))
 
-    if len(deploy) > 0:
+    if deploy['Count'] > 0:
         import time
         name = f"deploying-privatelink-{int(time.time())}"
         aws_start_stepfunction(os.environ['DeployStacksStateMachine'], {'Input': deploy}, name)
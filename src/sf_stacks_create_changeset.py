@@ -2,8 +2,11 @@ import json
 import time
 from copy import deepcopy
 
+from botocore.exceptions import ClientError
+
 from aws import (aws_assume_role, aws_create_changeset, aws_get_carve_tags,
-                 aws_read_s3_direct, current_region)
+                 aws_read_s3_direct, aws_throttled, current_region)
+from polling import start_phase
 from utils import carve_role_arn
 
 
@@ -38,20 +41,24 @@ def lambda_handler(event, context):
 
     changeset_name = f"{payload['StackName']}-{int(time.time())}"
 
-    response = aws_create_changeset(
-        stackname=payload['StackName'],
-        changeset_name=changeset_name,
-        region=region,
-        template=template,
-        parameters=parameters,
-        credentials=credentials,
-        tags=aws_get_carve_tags(context.invoked_function_arn))
+    try:
+        response = aws_create_changeset(
+            stackname=payload['StackName'],
+            changeset_name=changeset_name,
+            region=region,
+            template=template,
+            parameters=parameters,
+            credentials=credentials,
+            tags=aws_get_carve_tags(context.invoked_function_arn))
+    except ClientError as e:
+        aws_throttled(e, 'cloudformation:CreateChangeSet', region, account)
 
     # create payload for next step in state machine
     result = deepcopy(payload)
     result['ChangeSetName'] = changeset_name
     result['ChangeSetId'] = response['Id']
     del result['StackStatus']
+    result = start_phase(result, 'changeset')
 
     # return json to step function
     return json.dumps(result, default=str)
@@ -1,8 +1,11 @@
 import json
 from copy import deepcopy
 
+from botocore.exceptions import ClientError
+
 from aws import (aws_assume_role, aws_create_stack, aws_describe_stack,
-                 aws_get_carve_tags)
+                 aws_get_carve_tags, aws_throttled)
+from polling import load_history, start_phase
 from utils import carve_role_arn
 
 
@@ -25,29 +28,34 @@ def lambda_handler(event, context):
 
     credentials = aws_assume_role(carve_role_arn(account), f"carve-create-{stackname}")
 
-    response = aws_describe_stack(
-        stackname=stackname,
-        region=region,
-        credentials=credentials
-        )
-
-    if response is None:
-        # create an empty bootstrap stack for changesets
-        with open('managed_deployment/bootstrap-stack.cfn.json') as f:
-            template = (json.load(f))
+    payload = start_phase(deepcopy(event['Input']), 'stack')
 
-        aws_create_stack(
+    try:
+        response = aws_describe_stack(
             stackname=stackname,
             region=region,
-            template=str(template),
-            parameters=[],
-            credentials=credentials,
-            tags=aws_get_carve_tags(context.invoked_function_arn)
+            credentials=credentials
             )
 
+        if response is None:
+            # create an empty bootstrap stack for changesets
+            with open('managed_deployment/bootstrap-stack.cfn.json') as f:
+                template = (json.load(f))
+
+            aws_create_stack(
+                stackname=stackname,
+                region=region,
+                template=str(template),
+                parameters=[],
+                credentials=credentials,
+                tags=aws_get_carve_tags(context.invoked_function_arn)
+                )
+    except ClientError as e:
+        aws_throttled(e, 'cloudformation:CreateStack', region, account)
+
     # create payload for next step in state machine
-    payload = deepcopy(event['Input'])
     payload['StackName'] = stackname
+    payload = load_history(payload)
 
     # return json to step function
     return json.dumps(payload, default=str)
@@ -0,0 +1,48 @@
+import json
+
+from aws import aws_get_carve_tags
+from stack_engine import checkpoint_key, run_engine
+
+
+def lambda_handler(event, context):
+    '''
+    Deploy every stack in a stack manifest part with the multiplexed stack engine
+
+    Expects the following event:
+        event['Input'] = {
+            "Bucket": manifest bucket,
+            "Key": manifest part key,
+            "PartConcurrency": concurrent API calls,
+            "Resume": true when called again for the same part
+        }
+
+    Returns the input with Complete, Failed and States added, the state machine calls
+    this again with Resume set until Complete is true
+    '''
+
+    # the payload structure changes if this is called after a task state vs a choice state
+    if 'Payload' in event['Input']:
+        payload = event['Input']['Payload']
+    else:
+        payload = event['Input']
+
+    result = run_engine(
+        key=payload['Key'],
+        resume=payload.get('Resume', False),
+        concurrency=int(payload.get('PartConcurrency', 10)),
+        tags=aws_get_carve_tags(context.invoked_function_arn),
+        context=context
+        )
+
+    response = {
+        'Bucket': payload['Bucket'],
+        'Key': payload['Key'],
+        'PartConcurrency': payload.get('PartConcurrency', 10),
+        'Engine': payload.get('Engine', 'batch'),
+        'Checkpoint': checkpoint_key(payload['Key']),
+        'Resume': True
+    }
+    response.update(result)
+
+    # return json to step function
+    return json.dumps(response, default=str)
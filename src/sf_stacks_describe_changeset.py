@@ -1,10 +1,37 @@
 import json
 from copy import deepcopy
 
-from aws import aws_assume_role, aws_describe_change_set
+from botocore.exceptions import ClientError
+
+from aws import aws_assume_role, aws_describe_change_set, aws_throttled
+from polling import poll_phase, save_history
 from utils import carve_role_arn
 
 
+def changeset_status(response):
+    ''' return the Status, ExecutionStatus and StatusReason of a describe_change_set response '''
+    result = {}
+    if 'StatusReason' in response.keys():
+        # CFN Transform will sometimes leave a failed change set for no changes, which isn't a failure
+        if response['StatusReason'] == "No updates are to be performed.":
+            result["Status"] = "NO_CHANGES"
+            result["ExecutionStatus"] = "NO_CHANGES"
+            result['StatusReason'] = response['StatusReason']
+        elif "didn't contain changes" in response['StatusReason']: 
+            result["Status"] = "NO_CHANGES"
+            result["ExecutionStatus"] = "NO_CHANGES"
+            result['StatusReason'] = response['StatusReason']
+        else:
+            result["Status"] = response["Status"]
+            result["ExecutionStatus"] = response["ExecutionStatus"]
+            result['StatusReason'] = response['StatusReason']
+    else:
+        result["Status"] = response["Status"]
+        result["ExecutionStatus"] = response["ExecutionStatus"]
+        result['StatusReason'] = "None"
+    return result
+
+
 def lambda_handler(event, context):
     '''
     Describes a cloudformation stack changeset in any account/region and return the response
@@ -32,34 +59,31 @@ def lambda_handler(event, context):
 
     credentials = aws_assume_role(carve_role_arn(account), f"carve-changeset-{region}")
 
-    response = aws_describe_change_set(
-        changesetname=payload['ChangeSetId'],
-        region=region,
-        credentials=credentials
-        )
+    try:
+        response = aws_describe_change_set(
+            changesetname=payload['ChangeSetId'],
+            region=region,
+            credentials=credentials
+            )
+    except ClientError as e:
+        aws_throttled(e, 'cloudformation:DescribeChangeSet', region, account)
 
     print(response)
 
     # create payload for next step in state machine
     result = deepcopy(payload)
-    if 'StatusReason' in response.keys():
-        # CFN Transform will sometimes leave a failed change set for no changes, which isn't a failure
-        if response['StatusReason'] == "No updates are to be performed.":
-            result["Status"] = "NO_CHANGES"
-            result["ExecutionStatus"] = "NO_CHANGES"
-            result['StatusReason'] = response['StatusReason']
-        elif "didn't contain changes" in response['StatusReason']: 
-            result["Status"] = "NO_CHANGES"
-            result["ExecutionStatus"] = "NO_CHANGES"
-            result['StatusReason'] = response['StatusReason']
-        else:
-            result["Status"] = response["Status"]
-            result["ExecutionStatus"] = response["ExecutionStatus"]
-            result['StatusReason'] = response['StatusReason']
+    result.update(changeset_status(response))
+
+    # this handler polls both changeset creation and execution
+    if result['Phase'] == 'execute':
+        done = result['ExecutionStatus'] not in ['AVAILABLE', 'EXECUTE_IN_PROGRESS']
     else:
-        result["Status"] = response["Status"]
-        result["ExecutionStatus"] = response["ExecutionStatus"]
-        result['StatusReason'] = "None"
+        done = result['Status'] not in ['CREATE_PENDING', 'CREATE_IN_PROGRESS']
+    result = poll_phase(result, done)
+
+    # the stack deployment ends here unless the changeset is executed next
+    if done and (result['Phase'] == 'execute' or result['Status'] != 'CREATE_COMPLETE'):
+        save_history(result)
 
     # return json to step function
     return json.dumps(result, default=str)
@@ -1,7 +1,11 @@
 import json
 from copy import deepcopy
 
-from aws import aws_assume_role, aws_describe_stack
+from botocore.exceptions import ClientError
+
+from aws import aws_assume_role, aws_describe_stack, aws_throttled
+from polling import poll_phase
+from stack_registry import record_deleted
 from utils import carve_role_arn
 
 
@@ -18,6 +22,9 @@ def lambda_handler(event, context):
             "Template": s3://bucket/template
         }
 
+    cleanup passes a StackId, since deleted stacks can only be described by id. a stack
+    described by name that no longer exists is DELETE_COMPLETE, and every DELETE_COMPLETE
+    stack is marked as deleted for the stack registry
     '''
 
     # the payload structure changes if this is called after a task state vs a choice state
@@ -30,18 +37,34 @@ def lambda_handler(event, context):
 
     credentials = aws_assume_role(carve_role_arn(account), f"carve-deploy-{payload['Region']}")
 
-    response = aws_describe_stack(
-        stackname=payload['StackName'],
-        region=payload['Region'],
-        credentials=credentials
-        )
+    if 'StackId' in payload:
+        stackname = payload['StackId']
+    else:
+        stackname = payload['StackName']
+
+    try:
+        response = aws_describe_stack(
+            stackname=stackname,
+            region=payload['Region'],
+            credentials=credentials
+            )
+    except ClientError as e:
+        aws_throttled(e, 'cloudformation:DescribeStacks', payload['Region'], account)
+
+    if response is None:
+        response = {'StackStatus': 'DELETE_COMPLETE'}
 
     # create payload for next step in state machine
     payload = deepcopy(payload)
     payload['StackStatus'] = response['StackStatus']
+    if response['StackStatus'] == 'DELETE_COMPLETE':
+        record_deleted(payload)
     if 'StackStatusReason' in response:
         payload['StackStatusReason'] = response['StackStatusReason']
 
+    done = not response['StackStatus'].endswith('_IN_PROGRESS')
+    payload = poll_phase(payload, done)
+
     # return json to step function
     return json.dumps(payload, default=str)
 
@@ -1,7 +1,10 @@
 import json
 from copy import deepcopy
 
-from aws import aws_assume_role, aws_execute_change_set
+from botocore.exceptions import ClientError
+
+from aws import aws_assume_role, aws_execute_change_set, aws_throttled
+from polling import start_phase
 from utils import carve_role_arn
 
 
@@ -29,16 +32,20 @@ def lambda_handler(event, context):
 
     credentials = aws_assume_role(carve_role_arn(account), f"carve-changeset-{region}")
 
-    aws_execute_change_set(
-        changesetname=payload['ChangeSetName'],
-        stackname=payload['StackName'],
-        region=region,
-        credentials=credentials)
+    try:
+        aws_execute_change_set(
+            changesetname=payload['ChangeSetName'],
+            stackname=payload['StackName'],
+            region=region,
+            credentials=credentials)
+    except ClientError as e:
+        aws_throttled(e, 'cloudformation:ExecuteChangeSet', region, account)
 
     # create payload for next step in state machine
     response = deepcopy(payload)
     if 'Status' in response:
         del response['Status']
+    response = start_phase(response, 'execute')
 
     # return json to step function
     return json.dumps(response, default=str)
@@ -0,0 +1,42 @@
+import json
+
+from stackset_backend import deploy_stacksets
+from utils import read_manifest
+
+
+def lambda_handler(event, context):
+    '''
+    Deploy the stacks in a stack manifest as CloudFormation stack set instances
+
+    Expects the following event:
+        event['Input'] = {
+            "Bucket": manifest bucket,
+            "Prefix": manifest prefix,
+            "Count": items in the manifest,
+            "Engine": "stackset",
+            "StackSetNames": stack sets to advance even when the manifest has no items of them,
+            "StackSets": state of each stack set when called again
+        }
+
+    Returns the input with Complete, Failed and StackSets added, the state machine waits
+    and calls this again until Complete is true
+    '''
+
+    # the payload structure changes if this is called after a task state vs a choice state
+    if 'Payload' in event['Input']:
+        payload = event['Input']['Payload']
+    else:
+        payload = event['Input']
+
+    items = read_manifest(payload)
+    sets = deploy_stacksets(items, payload.get('StackSets', {}), context.invoked_function_arn, payload.get('StackSetNames', []))
+
+    response = dict(payload)
+    response['StackSets'] = sets
+    response['Failed'] = len([s for s in sets.values() if s['Step'] == 'failed'])
+    response['Complete'] = len([s for s in sets.values() if s['Step'] not in ['done', 'failed']]) == 0
+
+    print(json.dumps({'stacksets': sets, 'complete': response['Complete']}))
+
+    # return json to step function
+    return json.dumps(response, default=str)
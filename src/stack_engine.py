@@ -0,0 +1,341 @@
+import concurrent.futures
+import json
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from aws import (CarveThrottled, aws_assume_role, aws_create_changeset,
+                 aws_create_stack, aws_delete_s3_object, aws_delete_stack,
+                 aws_describe_all_stacks, aws_describe_change_set,
+                 aws_execute_change_set, aws_put_direct, aws_read_s3_direct,
+                 aws_throttled)
+from polling import (load_history, poll_phase, poll_seconds, save_history,
+                     start_phase)
+from sf_stacks_describe_changeset import changeset_status
+from utils import carve_role_arn
+
+'''
+multiplexed stack deployment engine
+
+drives a batch of stacks thru the same lifecycle as the deploy stacks state machine (create
+a bootstrap stack, create a changeset, execute the changeset) inside one lambda invocation.
+API calls for all stacks in the batch run concurrently, stack status is read with one
+paginated describe_stacks per account/region for the whole batch instead of one call per
+stack, and the engine state is checkpointed to S3 after every round so the next invocation
+can resume where this one stopped.
+'''
+
+# stack status that lets the engine create a changeset. a stack in ROLLBACK_COMPLETE failed
+# to create and cannot be updated, the engine deletes and recreates it instead
+stack_ready = [
+    'CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE',
+    'IMPORT_COMPLETE', 'IMPORT_ROLLBACK_COMPLETE'
+]
+
+# stack status that is still worth waiting for
+stack_waiting = ['CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS', 'REVIEW_IN_PROGRESS', 'IMPORT_IN_PROGRESS']
+
+# engine states that wait on stack status from describe_stacks
+status_states = ['wait_stack', 'wait_delete', 'wait_execute']
+
+finished_states = ['done', 'failed']
+
+# seconds left in the invocation when the engine stops starting new rounds
+deadline_margin = 30
+
+
+def checkpoint_key(key):
+    return f"engine_checkpoints/{key}.json"
+
+
+def load_batch(key, resume):
+    ''' load the engine state from its checkpoint, or start fresh from a manifest part '''
+    if resume:
+        data = aws_read_s3_direct(checkpoint_key(key))
+        if data is not None:
+            return json.loads(data)
+
+    stacks = []
+    for line in aws_read_s3_direct(key).splitlines():
+        if line.strip() != "":
+            stack = json.loads(line)
+            stack['EngineState'] = 'create'
+            stack['NextPoll'] = 0
+            stacks.append(stack)
+    return stacks
+
+
+def save_checkpoint(stacks, key):
+    aws_put_direct(json.dumps(stacks, default=str), checkpoint_key(key))
+
+
+def engine_counts(stacks):
+    counts = {}
+    for stack in stacks:
+        counts[stack['EngineState']] = counts.get(stack['EngineState'], 0) + 1
+    return counts
+
+
+def fail_stack(stack, reason):
+    stack['EngineState'] = 'failed'
+    stack['StatusReason'] = reason
+    print(json.dumps({'stack': stack['StackName'], 'account': stack['Account'], 'region': stack['Region'], 'failed': reason}))
+    return stack
+
+
+def begin_phase(stack, phase):
+    ''' start a phase and schedule its first status poll for when it is expected to finish '''
+    stack = start_phase(stack, phase)
+    stack['NextPoll'] = time.time() + poll_seconds(stack, phase, 0)
+    return stack
+
+
+def wait_stack(stack, done):
+    ''' record a status poll and schedule the next one for a stack that is not done '''
+    stack = poll_phase(stack, done)
+    stack['NextPoll'] = time.time() + stack['PollSeconds']
+    return stack
+
+
+def advance_stack(stack, region_stacks, credentials, tags):
+    '''
+    move one stack forward in the deployment lifecycle, making at most one API call.
+    region_stacks is the batched describe_stacks result for the stack's account/region
+    '''
+    stackname = stack['StackName']
+    region = stack['Region']
+    state = stack['EngineState']
+
+    if state == 'create':
+        stack = begin_phase(load_history(stack), 'stack')
+        if stackname not in region_stacks:
+            # create an empty bootstrap stack for changesets
+            with open('managed_deployment/bootstrap-stack.cfn.json') as f:
+                template = (json.load(f))
+            aws_create_stack(
+                stackname=stackname,
+                region=region,
+                template=str(template),
+                parameters=[],
+                credentials=credentials,
+                tags=tags
+                )
+        else:
+            # the stack already exists, check its status next round
+            stack['NextPoll'] = 0
+        stack['EngineState'] = 'wait_stack'
+
+    elif state == 'wait_stack':
+        # a stack created moments ago may not be listed yet
+        status = region_stacks.get(stackname, {}).get('StackStatus', 'CREATE_IN_PROGRESS')
+        stack['StackStatus'] = status
+        if status in stack_ready:
+            stack = wait_stack(stack, True)
+            stack['EngineState'] = 'changeset'
+        elif status in stack_waiting:
+            stack = wait_stack(stack, False)
+        elif status == 'ROLLBACK_COMPLETE' and not stack.get('Recreated', False):
+            # the bootstrap stack failed to create, delete it and create it again once
+            aws_delete_stack(stackname, region, credentials)
+            stack['Recreated'] = True
+            stack = wait_stack(stack, False)
+            stack['EngineState'] = 'wait_delete'
+        elif status == 'ROLLBACK_COMPLETE':
+            stack = fail_stack(stack, f"{status}: the bootstrap stack failed to create again after it was deleted")
+        else:
+            stack = fail_stack(stack, status)
+
+    elif state == 'wait_delete':
+        # deleted stacks drop out of describe_stacks
+        status = region_stacks.get(stackname, {}).get('StackStatus', 'DELETE_COMPLETE')
+        stack['StackStatus'] = status
+        if status == 'DELETE_COMPLETE':
+            stack['NextPoll'] = 0
+            stack['EngineState'] = 'create'
+        elif status in ['ROLLBACK_COMPLETE', 'DELETE_IN_PROGRESS']:
+            stack = wait_stack(stack, False)
+        else:
+            stack = fail_stack(stack, region_stacks[stackname].get('StackStatusReason', status))
+
+    elif state == 'changeset':
+        changeset_name = f"{stackname}-{int(time.time())}"
+        response = aws_create_changeset(
+            stackname=stackname,
+            changeset_name=changeset_name,
+            region=region,
+            template=aws_read_s3_direct(stack['Template']),
+            parameters=stack['Parameters'],
+            credentials=credentials,
+            tags=tags)
+        stack['ChangeSetName'] = changeset_name
+        stack['ChangeSetId'] = response['Id']
+        stack = begin_phase(stack, 'changeset')
+        stack['EngineState'] = 'wait_changeset'
+
+    elif state == 'wait_changeset':
+        response = aws_describe_change_set(
+            changesetname=stack['ChangeSetId'],
+            region=region,
+            credentials=credentials
+            )
+        stack.update(changeset_status(response))
+        if stack['Status'] == 'CREATE_COMPLETE':
+            stack = wait_stack(stack, True)
+            stack['EngineState'] = 'execute'
+        elif stack['Status'] == 'NO_CHANGES':
+            stack = wait_stack(stack, True)
+            save_history(stack)
+            stack['EngineState'] = 'done'
+        elif stack['Status'] in ['CREATE_PENDING', 'CREATE_IN_PROGRESS']:
+            stack = wait_stack(stack, False)
+        else:
+            stack = fail_stack(stack, stack['StatusReason'])
+
+    elif state == 'execute':
+        aws_execute_change_set(
+            changesetname=stack['ChangeSetName'],
+            stackname=stackname,
+            region=region,
+            credentials=credentials)
+        stack = begin_phase(stack, 'execute')
+        stack['EngineState'] = 'wait_execute'
+
+    elif state == 'wait_execute':
+        # the stack reports the last changeset executed against it
+        described = region_stacks.get(stackname, {})
+        status = described.get('StackStatus', 'UPDATE_IN_PROGRESS')
+        if described.get('ChangeSetId') != stack['ChangeSetId'] or status.endswith('_IN_PROGRESS'):
+            stack = wait_stack(stack, False)
+        else:
+            stack['StackStatus'] = status
+            stack = wait_stack(stack, True)
+            if status in ['CREATE_COMPLETE', 'UPDATE_COMPLETE']:
+                save_history(stack)
+                stack['EngineState'] = 'done'
+            else:
+                stack = fail_stack(stack, described.get('StackStatusReason', status))
+
+    return stack
+
+
+def api_name(state):
+    return {
+        'create': 'cloudformation:CreateStack',
+        'wait_stack': 'cloudformation:DeleteStack',
+        'changeset': 'cloudformation:CreateChangeSet',
+        'wait_changeset': 'cloudformation:DescribeChangeSet',
+        'execute': 'cloudformation:ExecuteChangeSet'
+    }.get(state, 'cloudformation:DescribeStacks')
+
+
+def advance_thread(stack, region_stacks, credentials, tags):
+    '''
+    advance a stack, leaving it in place to retry next round if the API call is throttled.
+    any other error fails this stack only, the rest of the group keeps deploying
+    '''
+    try:
+        return advance_stack(stack, region_stacks, credentials, tags)
+    except ClientError as e:
+        try:
+            aws_throttled(e, api_name(stack['EngineState']), stack['Region'], stack['Account'])
+        except CarveThrottled:
+            stack['NextPoll'] = time.time() + 5
+            return stack
+        except ClientError:
+            return fail_stack(stack, str(e))
+    except Exception as e:
+        return fail_stack(stack, str(e))
+
+
+def describe_thread(account, region, credentials):
+    try:
+        stacks = aws_describe_all_stacks(f"{os.environ['Prefix']}carve-managed-", region, credentials)
+    except ClientError as e:
+        try:
+            aws_throttled(e, 'cloudformation:DescribeStacks', region, account)
+        except CarveThrottled:
+            pass
+        # stacks in this account/region are retried next round
+        stacks = None
+    return account, region, stacks
+
+
+def engine_round(stacks, credentials, tags, executor):
+    ''' advance every stack that is due, returns the number of stacks advanced '''
+    now = time.time()
+    due = [i for i, s in enumerate(stacks) if s['EngineState'] not in finished_states and s['NextPoll'] <= now]
+
+    # one describe_stacks per account/region covers every stack due for a status check
+    pairs = set()
+    for i in due:
+        if stacks[i]['EngineState'] in status_states + ['create']:
+            pairs.add((stacks[i]['Account'], stacks[i]['Region']))
+    described = {}
+    futures = [executor.submit(describe_thread, a, r, credentials[a]) for a, r in pairs]
+    for future in concurrent.futures.as_completed(futures):
+        account, region, region_stacks = future.result()
+        if region_stacks is not None:
+            described[(account, region)] = region_stacks
+
+    futures = {}
+    for i in due:
+        stack = stacks[i]
+        pair = (stack['Account'], stack['Region'])
+        if stack['EngineState'] in status_states + ['create'] and pair not in described:
+            continue
+        futures[executor.submit(
+            advance_thread,
+            stack,
+            described.get(pair, {}),
+            credentials[stack['Account']],
+            tags)] = i
+
+    for future in concurrent.futures.as_completed(futures):
+        stacks[futures[future]] = future.result()
+
+    return len(futures)
+
+
+def run_engine(key, resume, concurrency, tags, context):
+    '''
+    deploy the stacks in a manifest part until they are all finished or the invocation is
+    about to time out, returns a summary for the state machine
+    '''
+    stacks = load_batch(key, resume)
+
+    credentials = {}
+    for account in set([s['Account'] for s in stacks]):
+        credentials[account] = aws_assume_role(carve_role_arn(account), f"carve-engine-{account}")
+
+    def remaining():
+        return context.get_remaining_time_in_millis() / 1000
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while remaining() > deadline_margin:
+            pending = [s for s in stacks if s['EngineState'] not in finished_states]
+            if len(pending) == 0:
+                break
+
+            engine_round(stacks, credentials, tags, executor)
+            save_checkpoint(stacks, key)
+
+            # sleep until the next stack is due for a status poll
+            pending = [s for s in stacks if s['EngineState'] not in finished_states]
+            if len(pending) > 0:
+                next_poll = min([s['NextPoll'] for s in pending]) - time.time()
+                time.sleep(max(0, min(next_poll, remaining() - deadline_margin)))
+
+    complete = len([s for s in stacks if s['EngineState'] not in finished_states]) == 0
+    if complete:
+        # every stack is done or failed, nothing is left to resume
+        aws_delete_s3_object(checkpoint_key(key))
+
+    counts = engine_counts(stacks)
+    print(json.dumps({'engine': key, 'stacks': len(stacks), 'states': counts}))
+
+    return {
+        'Complete': complete,
+        'Failed': counts.get('failed', 0),
+        'States': counts
+    }
@@ -0,0 +1,106 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from aws import aws_describe_all_stacks, aws_throttled, current_region
+from concurrency import AdaptiveLimiter
+
+'''
+bulk stack outputs harvester
+
+instead of one describe_stacks call per stack, the harvester describes every stack in an
+account/region with one paginated call, keeps the carve stacks, and runs the account/region
+pairs concurrently. results are cached for a short time, so the lookups made by one lambda
+invocation share a single harvest per account/region.
+'''
+
+# the carve account in harvest targets and results, which uses the lambda's own credentials
+core_account = 'carve'
+cache_seconds = 60
+_cache = {}
+_lock = threading.Lock()
+
+
+def stack_summary(stack):
+    # the parts of a stack description carve uses, with the outputs as a dict
+    return {
+        'StackName': stack['StackName'],
+        'StackId': stack['StackId'],
+        'StackStatus': stack['StackStatus'],
+        'Outputs': {o['OutputKey']: o['OutputValue'] for o in stack.get('Outputs', [])}
+    }
+
+
+def harvest_thread(account, region, credentials, limiter=None):
+    # describe all carve stacks in one account/region, an unreachable region has no stacks
+    try:
+        if limiter is None:
+            stacks = aws_describe_all_stacks(f"{os.environ['Prefix']}carve-", region, credentials)
+        else:
+            with limiter.slot((account, region)):
+                stacks = aws_describe_all_stacks(f"{os.environ['Prefix']}carve-", region, credentials)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['AccessDenied', 'InvalidClientTokenId', 'UnrecognizedClientException']:
+            print(f"cannot describe stacks in {account} in {region}: {e}")
+            return account, region, {}
+        aws_throttled(e, 'cloudformation:DescribeStacks', region, account)
+    return account, region, {name: stack_summary(stack) for name, stack in stacks.items()}
+
+
+def harvest_stacks(targets, max_age=cache_seconds, workers=200):
+    '''
+    describe the carve stacks in each account/region target concurrently, up to workers
+    threads with the in-flight calls set by an adaptive limiter
+    targets = [(account, region, credentials)], credentials is None for the carve account (core_account)
+    returns {(account, region): {stackname: {'StackName', 'StackId', 'StackStatus', 'Outputs'}}}
+    '''
+    now = time.time()
+    harvest = {}
+    pending = {}
+    with _lock:
+        for account, region, credentials in targets:
+            cached = _cache.get((account, region))
+            if cached is not None and now - cached[0] < max_age:
+                harvest[(account, region)] = cached[1]
+            else:
+                pending[(account, region)] = credentials
+
+    if len(pending) == 1:
+        (account, region), credentials = list(pending.items())[0]
+        account, region, stacks = harvest_thread(account, region, credentials)
+        harvest[(account, region)] = stacks
+        with _lock:
+            _cache[(account, region)] = (now, stacks)
+    elif len(pending) > 1:
+        limiter = AdaptiveLimiter('harvest', initial=50, maximum=workers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            futures = [executor.submit(harvest_thread, a, r, c, limiter) for (a, r), c in pending.items()]
+            for future in concurrent.futures.as_completed(futures):
+                account, region, stacks = future.result()
+                harvest[(account, region)] = stacks
+                with _lock:
+                    _cache[(account, region)] = (now, stacks)
+        limiter.report()
+
+    return harvest
+
+
+def stack_outputs(stackname, region=current_region, account=None, credentials=None):
+    '''
+    return the outputs of one carve stack as a dict, or an empty dict if it does not exist.
+    a drop-in for aws_get_stack_outputs_dict that reads from the cached account/region harvest
+    '''
+    if account is None:
+        account = credentials['Account'] if credentials is not None else core_account
+    stacks = harvest_stacks([(account, region, credentials)])[(account, region)]
+    if stackname in stacks:
+        return stacks[stackname]['Outputs']
+    return {}
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
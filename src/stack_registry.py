@@ -0,0 +1,159 @@
+import json
+import os
+import time
+
+from aws import (aws_current_account, aws_delete_s3_object, aws_put_direct, aws_read_s3_direct,
+                 aws_s3_list_objects, current_region)
+from utils import beacon_stacks, load_shards, unique_node_values
+
+'''
+registry of every carve managed stack, kept in the carve s3 bucket
+
+the deploy graph finalize step registers every stack of the deployed graph, and cleanup
+computes the stacks to delete as the registered stacks that are not in the graph, without
+listing stacks in every region of every account. a stack stays in the registry until its
+delete is confirmed: the cleanup describe step writes a marker under stack_registry/deleted/
+when the stack is DELETE_COMPLETE, and the next cleanup drops the marked stacks, so a
+failed delete is queued again. stacks the registry does not know about (created by hand,
+or left by a failed delete) are found by a full sweep of all accounts and regions, which
+cleanup still runs every CleanupSweepHours hours (default 24). stacks that are instances of
+a stack set have its name in StackSet, the stack set deletes them and cleanup only drops
+them from the registry.
+
+registry = {
+    'Stacks': {'account/region/stackname': {'Account', 'Region', 'StackName', 'StackId', 'TemplateHash', 'StackSet'}},
+    'LastSweep': epoch seconds of the last full sweep
+}
+'''
+
+registry_key = "stack_registry/registry.json"
+deleted_prefix = "stack_registry/deleted/"
+
+
+def stack_key(stack):
+    return f"{stack['Account']}/{stack['Region']}/{stack['StackName']}"
+
+
+def load_registry():
+    ''' return the stack registry, or None if no registry has been written yet '''
+    data = aws_read_s3_direct(registry_key)
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+def save_registry(registry):
+    aws_put_direct(json.dumps(registry, sort_keys=True), registry_key)
+
+
+def record_deleted(stack):
+    ''' mark a stack as deleted, one object per stack so parallel deletes don't race on the registry '''
+    aws_put_direct(json.dumps({'StackId': stack.get('StackId')}), f"{deleted_prefix}{stack_key(stack)}")
+
+
+def prune_deleted(registry, safe_stacks):
+    '''
+    drop the stacks marked as deleted from the registry, except stacks in safe_stacks, which
+    were deployed again. returns the marker keys to remove once the registry is saved
+    '''
+    safe = set([stack_key(s) for s in safe_stacks])
+    markers = aws_s3_list_objects(prefix=deleted_prefix)
+    for marker in markers:
+        key = marker[len(deleted_prefix):]
+        if key not in safe and key in registry['Stacks']:
+            del registry['Stacks'][key]
+    print(f"{len(markers)} stack deletes confirmed since the last cleanup")
+    return markers
+
+
+def remove_markers(markers):
+    for marker in markers:
+        aws_delete_s3_object(marker)
+
+
+def graph_stacks(G):
+    '''
+    return every carve managed stack for the graph G: [{'StackName', 'Account', 'Region'}]
+     - the managed bucket and private link stacks in the carve account for each graph region,
+       with the stacksets backend the managed buckets outside the carve region have StackSet
+     - the beacon stacks, and their shard stacks, of each VPC in the graph
+    '''
+    core_account = aws_current_account()
+    stacks = []
+
+    regions = set(unique_node_values(G, 'Region'))
+    regions.add(current_region)
+    stackset = None
+    if os.environ.get('DeployBackend', 'stacks') == 'stacksets':
+        stackset = f"{os.environ['Prefix']}carve-managed-bucket"
+    for region in sorted(regions):
+        stack = {
+            'StackName': f"{os.environ['Prefix']}carve-managed-bucket-{region}",
+            'Account': core_account,
+            'Region': region
+            }
+        if stackset is not None and region != current_region:
+            stack['StackSet'] = stackset
+        stacks.append(stack)
+
+    for region in sorted(unique_node_values(G, 'Region')):
+        stacks.append({
+            'StackName': f"{os.environ['Prefix']}carve-managed-privatelink-{region}",
+            'Account': core_account,
+            'Region': region
+            })
+
+    vpcs = {}
+    for subnet, data in G.nodes(data=True):
+        if data.get('Type') == 'external':
+            continue
+        if data['VpcId'] not in vpcs:
+            vpcs[data['VpcId']] = {'Account': data['Account'], 'Region': data['Region'], 'Subnets': []}
+        vpcs[data['VpcId']]['Subnets'].append(subnet)
+    shards = load_shards()
+    for vpc, info in vpcs.items():
+        for stack in beacon_stacks(vpc, info['Subnets'], shards.get(vpc)):
+            stacks.append({
+                'StackName': stack['StackName'],
+                'Account': info['Account'],
+                'Region': info['Region']
+                })
+
+    return stacks
+
+
+def register_stacks(stacks, hashes={}, stack_ids={}):
+    '''
+    add or update stacks in the registry. hashes and stack_ids are optional dicts of the
+    template hash and stack id by stack name, existing values are kept when not provided
+    '''
+    registry = load_registry() or {'Stacks': {}, 'LastSweep': 0}
+    for stack in stacks:
+        key = stack_key(stack)
+        entry = registry['Stacks'].get(key, {'StackId': None, 'TemplateHash': None})
+        entry.update({
+            'Account': stack['Account'],
+            'Region': stack['Region'],
+            'StackName': stack['StackName'],
+            'StackId': stack_ids.get(stack['StackName'], entry['StackId']),
+            'TemplateHash': hashes.get(stack['StackName'], entry['TemplateHash']),
+            'StackSet': stack.get('StackSet')
+        })
+        registry['Stacks'][key] = entry
+    save_registry(registry)
+    print(f"registered {len(stacks)} stacks, {len(registry['Stacks'])} stacks in registry")
+    return registry
+
+
+def stale_stacks(registry, safe_stacks):
+    ''' return the registered stacks that are not in safe_stacks '''
+    safe = set([stack_key(s) for s in safe_stacks])
+    return [s for key, s in sorted(registry['Stacks'].items()) if key not in safe]
+
+
+def sweep_due(registry):
+    ''' true when the registry is missing or the last full sweep is older than CleanupSweepHours '''
+    if registry is None:
+        return True
+    hours = float(os.environ.get('CleanupSweepHours', 24))
+    return time.time() - registry.get('LastSweep', 0) > hours * 3600
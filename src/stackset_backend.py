@@ -0,0 +1,169 @@
+import json
+import os
+
+from aws import (aws_assume_role, aws_describe_stack, aws_describe_stack_set,
+                 aws_describe_stack_set_operation, aws_get_carve_tags,
+                 aws_import_stacks_to_stack_set, aws_list_stack_instances, aws_purge_s3_bucket,
+                 aws_put_stack_set, aws_read_s3_direct, aws_stack_instances)
+from subnet_code import managed_bucket
+from utils import carve_role_arn
+
+'''
+CloudFormation StackSets deployment backend
+
+stacks in a deploy stacks manifest that share a template are grouped by their StackSet
+key into one stack set, with one stack instance per account/region. CloudFormation runs
+the fan-out to accounts and regions itself, with the failure tolerance and concurrency
+percentages from the lambda environment. each stack set is moved thru these steps, one
+stack set operation at a time:
+ - template: create the stack set, or update its template and every instance
+ - import: import the stacks an earlier deployment with the stacks backend created under
+   the name of a missing instance, 10 at a time, so the new instance doesn't collide with
+   their resources (the managed bucket names)
+ - instances: create missing instances, one operation per account and parameter set
+ - remove: delete instances that are no longer in the manifest
+a stack set named in the manifest StackSets list with no items in the manifest has every
+instance removed.
+'''
+
+steps = ['template', 'import', 'instances', 'remove', 'done']
+
+
+def operation_preferences():
+    '''
+    stack set operation preferences, which can be set in the lambda environment
+     - StackSetFailureTolerance: percentage of accounts per region that may fail
+     - StackSetMaxConcurrent: percentage of accounts per region deployed at once
+    '''
+    return {
+        'RegionConcurrencyType': 'PARALLEL',
+        'FailureTolerancePercentage': int(os.environ.get('StackSetFailureTolerance', 0)),
+        'MaxConcurrentPercentage': int(os.environ.get('StackSetMaxConcurrent', 100))
+    }
+
+
+def stackset_groups(items):
+    ''' group manifest items by stack set, each account/region may only appear once in a group '''
+    groups = {}
+    for item in items:
+        group = groups.setdefault(item['StackSet'], [])
+        for other in group:
+            if (other['Account'], other['Region']) == (item['Account'], item['Region']):
+                raise Exception(f"{item['StackName']} and {other['StackName']} are both in {item['StackSet']} in {item['Account']} {item['Region']}")
+        group.append(item)
+    return groups
+
+
+def instance_batches(group, base_parameters):
+    '''
+    return the instance operations for a group, one per account and parameter set, with
+    parameter overrides for parameters that differ from the stack set parameters
+    '''
+    batches = {}
+    for item in group:
+        overrides = [p for p in item['Parameters'] if p not in base_parameters]
+        key = (item['Account'], json.dumps(overrides, sort_keys=True))
+        batches.setdefault(key, {'Account': item['Account'], 'Regions': [], 'Overrides': overrides})
+        batches[key]['Regions'].append(item['Region'])
+    return list(batches.values())
+
+
+def start_step(name, step, group, tags):
+    '''
+    start the next operation of a step for a stack set. returns the operation id, or
+    None when the step has nothing left to do
+    '''
+    preferences = operation_preferences()
+    if len(group) == 0:
+        # an emptied stack set keeps its template, and has nothing to do if it doesn't exist
+        if step in ['template', 'import', 'instances'] or aws_describe_stack_set(name) is None:
+            return None
+    base_parameters = group[0]['Parameters'] if len(group) > 0 else []
+
+    if step == 'template':
+        exists = aws_describe_stack_set(name) is not None
+        template = aws_read_s3_direct(group[0]['Template'])
+        return aws_put_stack_set(name, template, base_parameters, tags, preferences, exists)
+
+    instances = set([(i['Account'], i['Region']) for i in aws_list_stack_instances(name)])
+    wanted = set([(item['Account'], item['Region']) for item in group])
+
+    if step == 'import':
+        stack_ids = []
+        credentials = {}
+        for item in group:
+            if (item['Account'], item['Region']) in instances:
+                continue
+            if item['Account'] not in credentials:
+                credentials[item['Account']] = aws_assume_role(carve_role_arn(item['Account']), "carve-stackset-import")
+            stack = aws_describe_stack(item['StackName'], item['Region'], credentials[item['Account']])
+            if stack is not None and stack['StackStatus'] in ['CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE']:
+                print(f"importing {item['StackName']} in {item['Account']} {item['Region']} into {name}")
+                stack_ids.append(stack['StackId'])
+            if len(stack_ids) == 10:
+                break
+        if len(stack_ids) > 0:
+            return aws_import_stacks_to_stack_set(name, stack_ids, preferences)
+        return None
+
+    if step == 'instances':
+        for batch in instance_batches(group, base_parameters):
+            regions = [r for r in batch['Regions'] if (batch['Account'], r) not in instances]
+            if len(regions) > 0:
+                return aws_stack_instances(name, 'create', [batch['Account']], regions, preferences, batch['Overrides'])
+        return None
+
+    if step == 'remove':
+        for account, region in sorted(instances - wanted):
+            # managed buckets must be empty before their stack can be deleted
+            if name == f"{os.environ['Prefix']}carve-managed-bucket":
+                aws_purge_s3_bucket(managed_bucket(region))
+            return aws_stack_instances(name, 'delete', [account], [region], preferences)
+        return None
+
+
+def advance_stackset(name, state, group, tags):
+    '''
+    check the running operation of a stack set and start the next one.
+    state = {'Step': step, 'Operation': operation id or None}
+    '''
+    if state.get('Operation') is not None:
+        operation = aws_describe_stack_set_operation(name, state['Operation'])
+        if operation['Status'] in ['RUNNING', 'QUEUED', 'STOPPING']:
+            return state
+        print(json.dumps({'stackset': name, 'step': state['Step'], 'operation': state['Operation'], 'status': operation['Status']}))
+        if operation['Status'] != 'SUCCEEDED':
+            state['Step'] = 'failed'
+            state['Operation'] = None
+            return state
+        state['Operation'] = None
+        if state['Step'] == 'template':
+            state['Step'] = 'import'
+        # import, instances and remove steps run one operation at a time until nothing is left
+
+    while state['Step'] in steps[:-1]:
+        operation = start_step(name, state['Step'], group, tags)
+        if operation is not None:
+            state['Operation'] = operation
+            return state
+        state['Step'] = steps[steps.index(state['Step']) + 1]
+
+    return state
+
+
+def deploy_stacksets(items, sets, lambda_arn, names=[]):
+    '''
+    advance every stack set in a manifest, and every stack set in names, by one check.
+    returns the updated state of each stack set:
+    sets = {stackset name: {'Step': step, 'Operation': operation id}}
+    '''
+    tags = aws_get_carve_tags(lambda_arn)
+    groups = stackset_groups(items)
+    for name in names:
+        groups.setdefault(name, [])
+    for name, group in groups.items():
+        state = sets.get(name, {'Step': 'template', 'Operation': None})
+        if state['Step'] not in ['done', 'failed']:
+            state = advance_stackset(name, state, group, tags)
+        sets[name] = state
+    return sets
@@ -0,0 +1,75 @@
+import base64
+import concurrent.futures
+import hashlib
+import io
+import os
+import zipfile
+
+from aws import aws_put_if_changed
+
+'''
+the subnet lambda code is shipped as a versioned zip artifact in the carve managed bucket
+of each region, and every subnet function in the region references the same S3 object
+instead of carrying an inline copy of the code in its stack template. the artifact key
+contains the hash of the code, so a code change is a new key and a template change.
+'''
+
+code_file = "managed_deployment/subnet_lambda.py"
+
+
+def managed_bucket(region):
+    # the carve managed bucket in a region
+    if os.environ['UniqueId'] == "":
+        unique = os.environ['OrgId']
+    else:
+        unique = os.environ['UniqueId']
+    return f"{os.environ['Prefix']}carve-managed-bucket-{unique}-{region}"
+
+
+def subnet_code():
+    '''
+    return the subnet lambda code as a zip with the code as index.py, its hash and artifact
+    key, and the CodeSha256 lambda reports for a function running it. the zip is built with
+    fixed timestamps so the same code has the same hash
+    '''
+    with open(code_file) as f:
+        code = f.read()
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as z:
+        info = zipfile.ZipInfo('index.py', date_time=(1980, 1, 1, 0, 0, 0))
+        info.external_attr = 0o644 << 16
+        z.writestr(info, code)
+    data = buffer.getvalue()
+
+    code_hash = hashlib.sha256(code.encode('utf-8')).hexdigest()
+    return {
+        'Zip': data,
+        'Hash': code_hash,
+        'CodeSha256': base64.b64encode(hashlib.sha256(data).digest()).decode('utf-8'),
+        'Key': f"managed_deployment/subnet-lambda/{code_hash[:16]}.zip"
+    }
+
+
+def upload_subnet_code(regions, upload=True):
+    '''
+    upload the subnet lambda code artifact to the managed bucket in each region, skipping
+    regions that already have it. returns the lambda Code property for each region
+    '''
+    artifact = subnet_code()
+
+    code = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
+        futures = {}
+        for region in regions:
+            bucket = managed_bucket(region)
+            code[region] = {'S3Bucket': bucket, 'S3Key': artifact['Key']}
+            if not upload:
+                continue
+            futures[executor.submit(aws_put_if_changed, artifact['Zip'], artifact['Key'], bucket)] = region
+        for future in concurrent.futures.as_completed(futures):
+            if future.result() is None:
+                raise Exception(f"failed to upload subnet lambda code to {managed_bucket(futures[future])}")
+
+    print(f"subnet lambda code {artifact['Key']} in {len(code)} regions")
+    return code
@@ -0,0 +1,308 @@
+import lambdavars
+import base64
+import concurrent.futures
+import json
+import os
+import threading
+import urllib3
+
+from botocore.exceptions import ClientError, WaiterError
+
+from aws import (aws_assume_role, aws_delete_s3_object, aws_get_function, aws_invoke_lambda,
+                 aws_put_direct, aws_put_if_changed, aws_read_s3_direct,
+                 aws_update_function_code)
+from deploy_plan import record_stacks
+from sf_deploy_graph_deployment_list import deployment_list
+from subnet_code import managed_bucket, subnet_code, upload_subnet_code
+from utils import carve_role_arn, get_deploy_key, load_graph, unique_node_values
+
+'''
+push new subnet lambda code directly to every subnet function in the deployed graph,
+without a changeset on each beacons stack.
+
+a canary slice of functions, one per region first, is updated and verified before the
+rest. a function is verified when lambda reports the CodeSha256 of the new artifact and
+a verify call with no beacons succeeds. if the canary fails, or more than max_failures
+functions fail, every updated function is rolled back to the code it had before. the
+previous code of a function is copied to the managed bucket of its region before the
+update, so a rollback restores it from S3 and doesn't depend on the expiring code URL
+lambda returns. once
+all functions in a VPC run the new code, the template hash of its stack is recorded as
+deployed so the next graph deployment does not update the stack again.
+
+functions are updated and rolled back in batches, and the rollout is checkpointed to S3
+after every batch. an invocation stops before it runs out of time and returns Complete
+false, invoke the function again with {"resume": true} until it returns Complete true.
+'''
+
+checkpoint_key = "rollout_checkpoints/subnet-code.json"
+
+# seconds left in the invocation when the rollout stops starting new batches, a batch can
+# wait up to 2 minutes for its function updates
+deadline_margin = 180
+
+
+def subnet_functions(G):
+    # list the subnet functions for the managed subnets in the graph
+    functions = []
+    for subnet, data in G.nodes(data=True):
+        if data.get('Type') == 'managed':
+            functions.append({
+                'FunctionName': f"{os.environ['Prefix']}carve-{subnet}",
+                'Account': data['Account'],
+                'Region': data['Region'],
+                'VpcId': data['VpcId']
+                })
+    return functions
+
+
+def canary_slice(functions, size):
+    ''' split functions into a canary slice of the given size, one per region first, and the rest '''
+    picked = []
+    regions = set()
+    for i, function in enumerate(functions):
+        if len(picked) < size and function['Region'] not in regions:
+            picked.append(i)
+            regions.add(function['Region'])
+    for i in range(len(functions)):
+        if len(picked) < size and i not in picked:
+            picked.append(i)
+    picked_set = set(picked)
+    canary = [functions[i] for i in picked]
+    rest = [f for i, f in enumerate(functions) if i not in picked_set]
+    return canary, rest
+
+
+def save_previous_code(function, current, snapshots, lock):
+    '''
+    copy the code a function runs now to the managed bucket of its region, keyed by its
+    CodeSha256, and return the S3 location to roll back to
+    '''
+    sha = current['Configuration']['CodeSha256']
+    bucket = managed_bucket(function['Region'])
+    key = f"managed_deployment/subnet-lambda/previous/{base64.b64decode(sha).hex()[:16]}.zip"
+    with lock:
+        # download and upload each previous code once per region
+        if (sha, bucket) not in snapshots:
+            if sha not in snapshots:
+                http = urllib3.PoolManager()
+                snapshots[sha] = http.request('GET', current['Code']['Location']).data
+            if aws_put_if_changed(snapshots[sha], key, bucket) is None:
+                raise Exception(f"failed to save the previous code of {function['FunctionName']} to {bucket}")
+            snapshots[(sha, bucket)] = key
+    return {'S3Bucket': bucket, 'S3Key': key}
+
+
+def update_thread(function, code, artifact, credentials, abort, snapshots, lock):
+    ''' update and verify one subnet function, records the outcome in function['Result'] '''
+    if abort.is_set():
+        function['Result'] = 'skipped'
+        return function
+
+    name = function['FunctionName']
+    region = function['Region']
+    try:
+        current = aws_get_function(name, region, credentials)
+        if current['Configuration']['CodeSha256'] == artifact['CodeSha256']:
+            function['Result'] = 'current'
+            return function
+
+        # keep the previous code in s3 for rollback
+        function['PreviousSha256'] = current['Configuration']['CodeSha256']
+        function['PreviousCode'] = save_previous_code(function, current, snapshots, lock)
+
+        config = aws_update_function_code(
+            name, region, credentials,
+            s3_bucket=code[region]['S3Bucket'],
+            s3_key=code[region]['S3Key'])
+        function['Result'] = 'updated'
+
+        if config['CodeSha256'] != artifact['CodeSha256'] or config['LastUpdateStatus'] != 'Successful':
+            raise Exception(f"unexpected code {config['CodeSha256']} status {config['LastUpdateStatus']}")
+
+        arn = f"arn:aws:lambda:{region}:{function['Account']}:function:{name}"
+        response = aws_invoke_lambda(arn, {'action': 'verify', 'beacons': []}, credentials)
+        if not isinstance(response, list):
+            raise Exception(f"verify call failed: {response}")
+
+    except Exception as e:
+        function['Error'] = str(e)
+        function['Result'] = 'failed' if function.get('Result') != 'updated' else 'failed-updated'
+        print(json.dumps({'rollout': name, 'account': function['Account'], 'region': region, 'error': str(e)}))
+
+    return function
+
+
+def update_functions(functions, code, artifact, credentials, concurrency, max_failures):
+    ''' update functions in parallel, stop starting updates once max_failures is exceeded '''
+    abort = threading.Event()
+    snapshots = {}
+    lock = threading.Lock()
+    failures = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(update_thread, f, code, artifact, credentials[f['Account']], abort, snapshots, lock)
+            for f in functions
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            if future.result()['Result'].startswith('failed'):
+                failures += 1
+                if failures > max_failures:
+                    abort.set()
+    return failures
+
+
+def rollback_thread(function, credentials):
+    # restore the previous code from its copy in the managed bucket
+    try:
+        aws_update_function_code(
+            function['FunctionName'], function['Region'], credentials,
+            s3_bucket=function['PreviousCode']['S3Bucket'],
+            s3_key=function['PreviousCode']['S3Key'])
+        function['Result'] = 'rolled-back'
+    except (ClientError, WaiterError) as e:
+        function['Result'] = 'rollback-failed'
+        print(json.dumps({'rollback': function['FunctionName'], 'region': function['Region'], 'error': str(e)}))
+    return function
+
+
+def rollback_functions(functions, credentials, concurrency):
+    ''' restore the previous code on every function this rollout changed '''
+    changed = [f for f in functions if f.get('Result') in ['updated', 'failed-updated']]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(rollback_thread, f, credentials[f['Account']]) for f in changed]
+        concurrent.futures.wait(futures)
+    print(f"rolled back {len(changed)} subnet functions")
+
+
+def record_rollout(G, functions):
+    ''' record the stack hashes of VPCs where every subnet function runs the new code '''
+    failed_vpcs = set([f['VpcId'] for f in functions if f['Result'] not in ['updated', 'current']])
+    stacks = deployment_list(G, upload_template=False, full=True)
+    done = []
+    for stack in stacks:
+        vpc = [p['ParameterValue'] for p in stack['Parameters'] if p['ParameterKey'] == 'VpcId'][0]
+        if vpc not in failed_vpcs:
+            done.append(stack)
+    record_stacks(done)
+    print(f"recorded {len(done)} of {len(stacks)} beacon stacks as deployed with the new code")
+
+
+def summary(functions):
+    counts = {}
+    for f in functions:
+        counts[f.get('Result', 'pending')] = counts.get(f.get('Result', 'pending'), 0) + 1
+    return counts
+
+
+def load_rollout(event):
+    ''' resume the rollout from its checkpoint, or start a new one from the deployed graph '''
+    data = aws_read_s3_direct(checkpoint_key)
+    if event.get('resume', False):
+        if data is None:
+            raise Exception('No subnet code rollout to resume')
+        return json.loads(data)
+    if data is not None:
+        raise Exception('A subnet code rollout is in progress, invoke again with {"resume": true}')
+
+    deploy_key = get_deploy_key(last=True)
+    if deploy_key is None:
+        raise Exception('No deployed graph found')
+    G = load_graph(deploy_key, local=False)
+
+    functions = subnet_functions(G)
+    canary_size = int(event.get('canary', max(1, len(functions) // 20)))
+    concurrency = int(event.get('concurrency', 50))
+    canary, rest = canary_slice(functions, canary_size)
+
+    artifact = subnet_code()
+    return {
+        'DeployKey': deploy_key,
+        'Artifact': {'Key': artifact['Key'], 'CodeSha256': artifact['CodeSha256']},
+        'Code': upload_subnet_code(unique_node_values(G, 'Region')),
+        'Concurrency': concurrency,
+        'Batch': int(event.get('batch', concurrency)),
+        'MaxFailures': int(event.get('max_failures', 0)),
+        'Phase': 'canary',
+        'Status': 'running',
+        'Failures': 0,
+        'Canary': canary,
+        'Rest': rest
+        }
+
+
+def rollout_batch(rollout, credentials):
+    ''' run the next batch of the current rollout phase, or move on to the next phase '''
+    functions = rollout['Canary'] + rollout['Rest']
+    phase = rollout['Phase']
+
+    if phase in ['canary', 'rest']:
+        group = rollout['Canary'] if phase == 'canary' else rollout['Rest']
+        limit = 0 if phase == 'canary' else rollout['MaxFailures']
+        pending = [f for f in group if 'Result' not in f]
+        if len(pending) > 0 and rollout['Failures'] <= limit:
+            rollout['Failures'] += update_functions(
+                pending[:rollout['Batch']], rollout['Code'], rollout['Artifact'], credentials,
+                rollout['Concurrency'], limit - rollout['Failures'])
+        elif rollout['Failures'] > limit:
+            rollout['Status'] = 'canary-failed' if phase == 'canary' else 'failed'
+            rollout['Phase'] = 'rollback'
+        elif phase == 'canary':
+            rollout['Phase'] = 'rest'
+            rollout['Failures'] = 0
+        else:
+            rollout['Phase'] = 'record'
+
+    elif phase == 'rollback':
+        changed = [f for f in functions if f.get('Result') in ['updated', 'failed-updated']]
+        if len(changed) > 0:
+            rollback_functions(changed[:rollout['Batch']], credentials, rollout['Concurrency'])
+        else:
+            rollout['Phase'] = 'done'
+
+    elif phase == 'record':
+        record_rollout(load_graph(rollout['DeployKey'], local=False), functions)
+        rollout['Status'] = 'complete'
+        rollout['Phase'] = 'done'
+
+    return rollout
+
+
+def lambda_handler(event, context):
+    '''
+    roll out the current subnet lambda code to the deployed graph, event options:
+     - canary: functions in the canary slice (default 5% of functions, at least 1)
+     - concurrency: functions updated at once (default 50)
+     - batch: functions updated between checkpoints (default concurrency)
+     - max_failures: failed functions tolerated after the canary (default 0)
+     - resume: continue the rollout from its checkpoint, the other options are ignored
+    '''
+    event = event or {}
+    rollout = load_rollout(event)
+    print(f"rolling out subnet code {rollout['Artifact']['Key']} to {len(rollout['Canary']) + len(rollout['Rest'])} functions, canary {len(rollout['Canary'])}, phase {rollout['Phase']}")
+
+    credentials = {}
+    for account in set([f['Account'] for f in rollout['Canary'] + rollout['Rest']]):
+        credentials[account] = aws_assume_role(carve_role_arn(account), "carve-code-rollout")
+
+    while rollout['Phase'] != 'done' and context.get_remaining_time_in_millis() / 1000 > deadline_margin:
+        rollout = rollout_batch(rollout, credentials)
+        aws_put_direct(json.dumps(rollout), checkpoint_key)
+
+    complete = rollout['Phase'] == 'done'
+    if complete:
+        aws_delete_s3_object(checkpoint_key)
+
+    result = {
+        'Complete': complete,
+        'resume': True,
+        'status': rollout['Status'],
+        'code': rollout['Artifact']['Key'],
+        'functions': summary(rollout['Canary'] + rollout['Rest'])
+        }
+    print(json.dumps(result))
+    return result
+
+
+if __name__ == '__main__':
+    lambda_handler({}, lambdavars.lambda_context)
@@ -4,6 +4,8 @@ import pylab as plt
 import json
 import sys
 import os
+import time
+import uuid
 from aws import *
 
 
@@ -115,6 +117,61 @@ def get_deploy_key(last=False):
     return aws_newest_s3(path)
 
 
+# the shard of every subnet of the last deployment list, {vpc: {subnet: shard}}
+shards_key = "managed_deployment/beacon-shards.json"
+
+
+def load_shards():
+    data = aws_read_s3_direct(shards_key)
+    if data is None:
+        return {}
+    return json.loads(data)
+
+
+def save_shards(shards):
+    aws_put_direct(json.dumps(shards, sort_keys=True), shards_key)
+
+
+def beacon_stacks(vpc, subnets, assigned=None):
+    '''
+    split the subnets of a VPC into beacon stacks of at most BeaconShardSize subnet functions
+    (default 150), which keeps large VPCs under the CloudFormation resource limit and lets
+    their stacks deploy in parallel. the first stack is the VPC stack, which also holds the
+    VPC endpoint and the Beacons output, the rest are shard stacks with only subnet functions.
+    assigned is the {subnet: shard} of the last deployment list: subnets keep their shard, so a
+    subnet function never moves between stacks that deploy in parallel, and new subnets fill
+    the lowest shard with room. a shard whose subnets are all gone is dropped
+    returns [{'StackName': stackname, 'Shard': 0, 'Subnets': [subnets]}, ...]
+    '''
+    size = int(os.environ.get('BeaconShardSize', 150))
+    assigned = assigned or {}
+    shards = {0: []}
+    for subnet in sorted(subnets):
+        if subnet in assigned:
+            shards.setdefault(assigned[subnet], []).append(subnet)
+    for subnet in sorted(subnets):
+        if subnet not in assigned:
+            shard = 0
+            while len(shards.get(shard, [])) >= size:
+                shard += 1
+            shards.setdefault(shard, []).append(subnet)
+
+    stacks = []
+    for shard in sorted(shards):
+        if shard > 0 and len(shards[shard]) == 0:
+            continue
+        stackname = f"{os.environ['Prefix']}carve-managed-beacons-{vpc}"
+        if shard > 0:
+            stackname = f"{stackname}-shard{shard}"
+        stacks.append({'StackName': stackname, 'Shard': shard, 'Subnets': sorted(shards[shard])})
+    return stacks
+
+
+def shard_assignment(stacks):
+    # the {subnet: shard} of the beacon stacks of a VPC
+    return {subnet: stack['Shard'] for stack in stacks for subnet in stack['Subnets']}
+
+
 def unique_node_values(G, key):
     # from graph G, get all unique values of key
     values = set()
@@ -152,5 +209,92 @@ def save_graph(G, file_path):
         json.dump(json_graph.node_link_data(G), f)
 
 
+# manifests of runs older than this are removed when a new run of the same name is written
+manifest_max_age = 86400
+
+
+def manifest_prefix(name):
+    '''
+    return a new manifests/{name}/{run}/ prefix for one execution, so overlapping executions
+    never share or purge each other's manifests. the run id starts with the epoch, and the
+    runs of the same name older than manifest_max_age are removed
+    '''
+    now = int(time.time())
+    old_runs = set()
+    for key in aws_s3_list_objects(prefix=f"manifests/{name}/"):
+        run = key.split('/')[2]
+        started = run.split('-')[0]
+        if not started.isdigit() or now - int(started) > manifest_max_age:
+            old_runs.add(f"manifests/{name}/{run}")
+    for old in old_runs:
+        aws_purge_s3_path(old)
+    return f"manifests/{name}/{now}-{uuid.uuid4().hex[:8]}/"
+
+
+def write_manifest_part(items, prefix, part):
+    # write a list of work items to s3 as a single JSON Lines manifest part
+    key = f"{prefix}part-{part}.jsonl"
+    data = '\n'.join([json.dumps(item, default=str) for item in items])
+    aws_put_direct(data, key)
+    return key
+
+
+def write_manifest(items, name, chunk_size=500, engine='map'):
+    '''
+    write a list of step function work items to the carve s3 bucket as chunked JSON Lines
+    files under manifests/{name}/{run}/ and return a manifest reference for the state machine.
+    state machines read the parts with a distributed map S3 item reader, which keeps
+    large work lists out of the 256 KB step function payload.
+    '''
+    parts = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    return write_manifest_parts(parts, name, engine=engine)
+
+
+def write_manifest_parts(parts, name, wave_concurrency=10000, part_concurrency=10000, engine='map'):
+    '''
+    write a list of pre-grouped work item lists to s3, one JSON Lines file per group, in order.
+    the deploy stacks state machine runs up to wave_concurrency parts at once, and up to
+    part_concurrency items within each part. engine selects how the deploy stacks state
+    machine deploys a part: 'map' runs one state machine iteration per stack, 'batch' runs
+    the whole part in the multiplexed stack engine lambda, 'stackset' deploys the items as
+    stack set instances grouped by their StackSet key.
+    '''
+    prefix = manifest_prefix(name)
+
+    count = 0
+    for i, part in enumerate(parts):
+        write_manifest_part(part, prefix, f"{i:05d}")
+        count += len(part)
+
+    print(f"wrote {count} items in {len(parts)} parts to manifest s3://{os.environ['CarveS3Bucket']}/{prefix}")
+    return manifest_reference(prefix, count, len(parts), wave_concurrency, part_concurrency, engine)
+
+
+def manifest_reference(prefix, count, parts, wave_concurrency=10000, part_concurrency=10000, engine='map'):
+    # the small object passed between states in place of a work list
+    return {
+        "Bucket": os.environ['CarveS3Bucket'],
+        "Prefix": prefix,
+        "Count": count,
+        "Parts": parts,
+        "WaveConcurrency": wave_concurrency,
+        "PartConcurrency": part_concurrency,
+        "Engine": engine
+    }
+
+
+def read_manifest(manifest):
+    # load all work items from a manifest reference
+    items = []
+    if manifest['Count'] == 0:
+        return items
+    for key in aws_s3_list_objects(prefix=manifest['Prefix']):
+        data = aws_read_s3_direct(key)
+        for line in data.splitlines():
+            if line.strip() != '':
+                items.append(json.loads(line))
+    return items
+
+
 
 
@@ -0,0 +1,174 @@
+import json
+import sys
+import time
+import zlib
+from array import array
+from datetime import datetime, timedelta, timezone
+
+from aws import aws_delete_s3_object, aws_put_direct, aws_read_s3_binary, aws_s3_list_objects
+
+'''
+columnar verification history
+
+every routing verification run appends one row per (source, target) result to a columnar
+store in the carve s3 bucket, partitioned by hour:
+ - verification_history/runs/<hour>/<run>.bin holds one run
+ - verification_history/hours/<hour>.bin holds every run of a past hour. each append merges
+   the runs of finished hours into their hour object and removes the run objects
+an object is a zlib compressed json header line followed by the packed columns:
+ - run: epoch seconds of the run (uint32)
+ - source, target: positions in the header Nodes list (uint32)
+ - status: down, up, inferred or unknown (uint8)
+ - latency: probe milliseconds, 0 for links without a probe (uint16)
+
+    python verification_history.py pair subnet-a subnet-b t1 t2
+    python verification_history.py flaps t1 t2
+'''
+
+history_prefix = "verification_history"
+statuses = ['down', 'up', 'inferred', 'unknown']
+columns = [['run', 'I'], ['source', 'I'], ['target', 'I'], ['status', 'B'], ['latency', 'H']]
+
+
+def hour_of(run):
+    return datetime.fromtimestamp(run, timezone.utc).strftime('%Y-%m-%dT%H')
+
+
+def encode(nodes, data):
+    header = json.dumps({'Nodes': nodes, 'Rows': len(data['run']), 'Columns': columns})
+    body = b''.join([array(code, data[name]).tobytes() for name, code in columns])
+    return zlib.compress(header.encode() + b'\n' + body)
+
+
+def decode(blob):
+    ''' return (nodes, {column: array}) from a history object '''
+    raw = zlib.decompress(blob)
+    split = raw.index(b'\n')
+    header = json.loads(raw[:split])
+    data = {}
+    offset = split + 1
+    for name, code in header['Columns']:
+        column = array(code)
+        size = column.itemsize * header['Rows']
+        column.frombytes(raw[offset:offset + size])
+        data[name] = column
+        offset += size
+    return header['Nodes'], data
+
+
+def run_rows(run, results):
+    ''' pack [[source, target, status, latency]] results of a run into columns '''
+    nodes = sorted(set([r[0] for r in results] + [r[1] for r in results]))
+    position = {n: i for i, n in enumerate(nodes)}
+    data = {name: [] for name, code in columns}
+    for source, target, status, latency in results:
+        data['run'].append(run)
+        data['source'].append(position[source])
+        data['target'].append(position[target])
+        data['status'].append(statuses.index(status))
+        data['latency'].append(min(int(latency or 0), 65535))
+    return nodes, data
+
+
+def merge(parts):
+    ''' merge decoded (nodes, data) parts into one, remapping node positions '''
+    nodes = sorted(set([n for part_nodes, d in parts for n in part_nodes]))
+    position = {n: i for i, n in enumerate(nodes)}
+    merged = {name: array(code) for name, code in columns}
+    for part_nodes, data in parts:
+        remap = [position[n] for n in part_nodes]
+        for name, code in columns:
+            if name in ['source', 'target']:
+                merged[name].extend(array(code, [remap[i] for i in data[name]]))
+            else:
+                merged[name].extend(data[name])
+    return nodes, merged
+
+
+def compact(now=None):
+    ''' merge the run objects of every finished hour into their hour object '''
+    current = hour_of(now or int(time.time()))
+    hours = {}
+    for key in aws_s3_list_objects(prefix=f"{history_prefix}/runs/"):
+        hour = key.split('/')[-2]
+        if hour < current:
+            hours.setdefault(hour, []).append(key)
+
+    for hour, keys in sorted(hours.items()):
+        hour_key = f"{history_prefix}/hours/{hour}.bin"
+        parts = [decode(aws_read_s3_binary(key)) for key in keys]
+        existing = aws_read_s3_binary(hour_key)
+        if existing is not None:
+            parts.append(decode(existing))
+        aws_put_direct(encode(*merge(parts)), hour_key)
+        for key in keys:
+            aws_delete_s3_object(key)
+        print(f"compacted {len(keys)} verification runs into {hour_key}")
+
+
+def append_run(results, run=None):
+    '''
+    append the [[source, target, status, latency]] results of a verification run to the
+    history, and compact finished hours
+    '''
+    run = run or int(time.time())
+    key = f"{history_prefix}/runs/{hour_of(run)}/{run}.bin"
+    aws_put_direct(encode(*run_rows(run, results)), key)
+    print(f"appended {len(results)} results to {key}")
+    compact(run)
+    return key
+
+
+def load_history(t1, t2):
+    ''' return [(run, source, target, status, latency)] of the runs between epoch t1 and t2 '''
+    parts = []
+    hour = datetime.fromtimestamp(t1, timezone.utc).replace(minute=0, second=0, microsecond=0)
+    end = datetime.fromtimestamp(t2, timezone.utc)
+    while hour <= end:
+        name = hour.strftime('%Y-%m-%dT%H')
+        blob = aws_read_s3_binary(f"{history_prefix}/hours/{name}.bin")
+        if blob is not None:
+            parts.append(decode(blob))
+        else:
+            for key in aws_s3_list_objects(prefix=f"{history_prefix}/runs/{name}/"):
+                parts.append(decode(aws_read_s3_binary(key)))
+        hour += timedelta(hours=1)
+
+    rows = []
+    for nodes, data in parts:
+        for i, run in enumerate(data['run']):
+            if t1 <= run <= t2:
+                rows.append((run, nodes[data['source'][i]], nodes[data['target'][i]], statuses[data['status'][i]], data['latency'][i]))
+    return sorted(rows)
+
+
+def pair_history(a, b, t1, t2, rows=None):
+    ''' return [(run, status, latency)] of subnets a and b between t1 and t2, in either direction '''
+    if rows is None:
+        rows = load_history(t1, t2)
+    pair = set([a, b])
+    return [(r[0], r[3], r[4]) for r in rows if set(r[1:3]) == pair]
+
+
+def flaps(t1, t2, rows=None):
+    ''' return {(a, b): count} of the up/down changes of each pair between t1 and t2 '''
+    if rows is None:
+        rows = load_history(t1, t2)
+    last = {}
+    counts = {}
+    for run, source, target, status, latency in rows:
+        if status not in ['up', 'down']:
+            continue
+        pair = tuple(sorted([source, target]))
+        if pair in last and last[pair] != status:
+            counts[pair] = counts.get(pair, 0) + 1
+        last[pair] = status
+    return counts
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'pair':
+        print(pair_history(sys.argv[2], sys.argv[3], int(sys.argv[4]), int(sys.argv[5])))
+    elif sys.argv[1] == 'flaps':
+        for pair, count in sorted(flaps(int(sys.argv[2]), int(sys.argv[3])).items(), key=lambda p: -p[1]):
+            print(pair, count)
@@ -6,59 +6,181 @@ import concurrent.futures
 from networkx.readwrite import json_graph
 
 from aws import *
+from beacon_inventory import load_inventory
+from concurrency import AdaptiveLimiter, lambda_caps
+from hedging import hedged_calls, load_latencies
+from probe_plan import class_edges, compile_probe_plan
+from reachability_index import load_reachability_index, point, update_reachability_index
+from reachability_model import load_disagreements, load_routing, reachability_model, save_disagreements
+from verification_history import append_run
+from verify_schedule import load_schedule, schedule_probes, update_schedule
 from utils import (load_graph, save_graph, carve_role_arn,
                    get_deploy_key)
 
 
-def add_routes(G):
+def add_routes(G, scheduled=False, previous=None):
     '''
     run a verification of current routes, invoking every subnet lamabda function in a thread
-    then process the results and add verified routes to the graph
+    then process the results and add verified routes to the graph. a scheduled run only
+    probes the slice of the probe plan picked by the verification schedule, and the links
+    of the other probes are carried over from the previous reachability index
     '''
-    # pull beacon inventory from s3
-    inventory = json.loads(aws_read_s3_direct('managed_deployment/beacon-inventory.json'))
-    
-    # get all addresses from beacons
-    beacons = [beacon['address'] for beacon in inventory.values()]
+    # pull the compact beacon inventory from s3
+    inventory = load_inventory()['Beacons']
+
+    # expected reachability from the route tables found by the last network discovery
+    routing = load_routing()
+    model = None if routing is None else reachability_model(G, routing)
+
+    # plan the beacons each subnet probes, and the routes inferred without a probe
+    plan = compile_probe_plan(G, inventory, model=model, disagreements=load_disagreements())
+
+    probes = plan['Probes']
+    carried = []
+    if scheduled:
+        schedule = load_schedule()
+        probes, skipped, coverage = schedule_probes(plan['Probes'], schedule)
+        carried = carried_links(skipped, inventory, previous)
+
+    # subnet functions return what they measured a second before the run deadline
+    deadline = time.time() + float(os.environ.get('VerifyDeadlineSeconds', 40))
 
     cred_cache = {}
-    verified_routes = {}
-    futures = set()
+    calls = {}
     print("verifying routes...")
-    with concurrent.futures.ThreadPoolExecutor(max_workers=300) as executor:
-            for target, data in inventory.items():
-                # only create threads for carve managed subnet lambdas
-                if data['type'] == 'managed':
-
-                    # reuse account creds in threads
-                    if data['account'] not in cred_cache:
-                        credentials = aws_assume_role(carve_role_arn(data['account']), f"verification")
-                        cred_cache[data['account']] = credentials
-                    else:
-                        credentials = cred_cache[data['account']]
-
-                    # add a thread for each subnet lambda
-                    futures.add(executor.submit(
-                        verify_subnet_routes,
-                        subnet_id=target,
-                        credentials=credentials,
-                        region=data['region'],
-                        beacons=beacons
-                        ))
-
-            # collect thread results
-            for future in concurrent.futures.as_completed(futures):
-                for subnet, results in future.result().items():
-                    verified_routes[subnet] = results
+    for target, data in inventory.items():
+        # only create threads for carve managed subnet lambdas with probes planned
+        if data['type'] == 'managed' and len(probes.get(target, [])) > 0:
+
+            # reuse account creds in threads
+            if data['account'] not in cred_cache:
+                credentials = aws_assume_role(carve_role_arn(data['account']), f"verification")
+                cred_cache[data['account']] = credentials
+            else:
+                credentials = cred_cache[data['account']]
+
+            # a thread for each subnet lambda, stragglers are invoked again
+            calls[target] = {
+                'subnet_id': target,
+                'credentials': credentials,
+                'region': data['region'],
+                'beacons': probes[target],
+                'deadline': deadline - 1
+            }
+
+    # in-flight invokes adapt to throttling and latency in each account/region
+    limiter = AdaptiveLimiter('verify', initial=50, maximum=int(os.environ.get('VerifyMaxConcurrency', 1000)))
+    targets = {(c['credentials']['Account'], c['region']): c['credentials'] for c in calls.values()}
+    lambda_caps(limiter, [(account, region, credentials) for (account, region), credentials in targets.items()])
+    for call in calls.values():
+        call['limiter'] = limiter
+
+    # collect thread results until the deadline
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(2 * len(calls), limiter.maximum)))
+    groups = {subnet: (c['credentials']['Account'], c['region']) for subnet, c in calls.items()}
+    responses, hedging = hedged_calls(executor, verify_subnet_routes, calls, deadline, load_latencies(set(groups.values())), groups)
+    executor.shutdown(wait=False)
+    limiter.report()
+    verified_routes = {}
+    for response in responses.values():
+        verified_routes.update(response)
+    if len(responses) < len(calls):
+        print(f"verification deadline passed with {len(calls) - len(responses)} subnet functions pending")
+
+    # probes of subnet functions that did not answer are unknown, not down
+    for subnet in calls:
+        if subnet not in verified_routes:
+            verified_routes[subnet] = unknown_results(probes[subnet])
+    unknown = [[subnet, r['beacon']] for subnet, results in verified_routes.items() for r in results if r['result'] == 'unknown']
+    carried += carried_links(unknown, inventory, previous, 'unknown')
 
     # add verified routes to graph
-    R = add_graph_links(G, verified_routes, inventory)
+    R = add_graph_links(G, verified_routes, inventory, plan['Inferred'] + carried, plan['Classes'])
+
+    if scheduled:
+        update_schedule(schedule, verified_routes)
+        R.graph['Coverage'] = coverage
+    R.graph['Unknown'] = len(unknown)
+    R.graph['Hedging'] = hedging
+
+    # compare the probed pairs the model was certain about with the measured links
+    if model is not None:
+        disagreements = check_model(R, plan['Checks'], verified_routes, inventory)
+        R.graph['ModelDisagreements'] = disagreements
+        save_disagreements(disagreements)
+
+    # append the results of this run to the verification history
+    append_run(history_results(R, verified_routes, inventory))
     return R
 
 
-def add_graph_links(G, verified_routes, inventory):
+def history_results(G, verified_routes, inventory):
+    '''
+    return the [[source, target, status, latency]] results of a run for the verification
+    history, measured probes and the inferred links of graph G
+    '''
+    beacons_dict = {data['address']: beacon for beacon, data in inventory.items()}
+    results = []
+    for subnet, subnet_results in verified_routes.items():
+        for result in subnet_results:
+            target = beacons_dict.get(result['beacon'])
+            if target is not None and target != subnet:
+                results.append([subnet, target, result['result'], result.get('latency', 0)])
+    for source, target, inferred in G.edges(data='Inferred'):
+        if inferred is not None:
+            results.append([source, target, 'inferred', 0])
+    return results
+
+
+def unknown_results(beacons):
+    return [{'beacon': beacon, 'result': 'unknown'} for beacon in beacons]
+
+
+def carried_links(skipped, inventory, previous, rule='schedule'):
     '''
-    create new graph with links by adding routes to the currently deployed graph
+    return [[subnet, target, rule]] for the skipped [subnet, address] probes that were up in
+    the previous reachability index
+    '''
+    if previous is None:
+        return []
+    beacons_dict = {data['address']: beacon for beacon, data in inventory.items()}
+    carried = []
+    for subnet, address in skipped:
+        target = beacons_dict.get(address)
+        if target in previous['Position'] and subnet in previous['Position'] and point(previous, subnet, target)['Reachable']:
+            carried.append([subnet, target, rule])
+    print(f"carried {len(carried)} links of {len(skipped)} {rule} probes from the previous verification")
+    return carried
+
+
+def check_model(G, checks, verified_routes, inventory):
+    '''
+    return the [subnet, target, expected] checks where the measured link of graph G does not
+    match the reachability model, checks of pairs not probed this run are skipped
+    '''
+    beacons_dict = {data['address']: beacon for beacon, data in inventory.items()}
+    probed = set()
+    for subnet, results in verified_routes.items():
+        for result in results:
+            if result['result'] in ['up', 'down']:
+                probed.add(tuple(sorted([subnet, beacons_dict.get(result['beacon'], '')])))
+    checks = [c for c in checks if tuple(sorted(c[:2])) in probed]
+
+    disagreements = []
+    for source, target, expected in checks:
+        measured = G.has_edge(source, target) and G.edges[source, target]['Inferred'] is None
+        if measured != (expected == 'yes'):
+            disagreements.append([source, target, expected])
+            print(f"reachability model expected {expected} from {source} to {target}, measured {'yes' if measured else 'no'}")
+    print(f"reachability model agreed with {len(checks) - len(disagreements)} of {len(checks)} checked pairs")
+    return disagreements
+
+
+def add_graph_links(G, verified_routes, inventory, inferred=[], classes={}):
+    '''
+    create new graph with links by adding routes to the currently deployed graph. measured
+    links have Inferred set to None, links from the probe plan and from expanding subnet
+    equivalence classes have the rule that inferred them
     '''
     # make new dict from inventory with address as key and subnet/name for easy lookup
     print("adding routes to graph...")
@@ -69,27 +191,53 @@ def add_graph_links(G, verified_routes, inventory):
     # add route links to managed subnets in graph
     for subnet in list(G.nodes):
         if G.nodes[subnet]['Type'] == 'managed':
-            for result in verified_routes[subnet]:
+            for result in verified_routes.get(subnet, []):
                 if result['result'] == 'up':
                     beacon = result['beacon']
                     edge = beacons_dict[beacon]
                     if subnet != edge:
-                        G.add_edge(subnet, edge)
+                        G.add_edge(subnet, edge, Inferred=None)
+
+    # add links inferred by the probe plan
+    for source, target, rule in inferred:
+        if not G.has_edge(source, target):
+            G.add_edge(source, target, Inferred=rule)
+    print(f"added {len(inferred)} inferred routes to graph")
+
+    # expand the links of class representatives to the other members of their class
+    expanded = class_edges(G, classes)
+    for source, target, rule in expanded:
+        G.add_edge(source, target, Inferred=rule)
+    print(f"added {len(expanded)} routes from subnet equivalence classes to graph")
     return G
 
 
-def verify_subnet_routes(subnet_id, credentials, region, beacons):
+def verify_subnet_routes(subnet_id, credentials, region, beacons, deadline=None, limiter=None):
     '''
-    pass a payload of beacon targets to verify and return the results
+    pass a payload of beacon targets to verify and return the results. the subnet function
+    returns the results it has by the deadline (epoch seconds), the invoke waits for a slot
+    of the account/region in the limiter
     '''
     lambda_arn = f"arn:aws:lambda:{region}:{credentials['Account']}:function:{os.environ['Prefix']}carve-{subnet_id}"
-    payload = {'action': 'verify', 'beacons': beacons}
-    result = aws_invoke_lambda(lambda_arn, payload, credentials)
+    payload = {'action': 'verify', 'beacons': beacons, 'deadline': deadline}
+    try:
+        if limiter is None:
+            result = aws_invoke_lambda(lambda_arn, payload, credentials)
+        else:
+            with limiter.slot((credentials['Account'], region), deadline):
+                result = aws_invoke_lambda(lambda_arn, payload, credentials)
+    except Exception as e:
+        print(f"error invoking {lambda_arn}: {e}")
+        result = None
+    if not isinstance(result, list):
+        # the function failed or timed out, none of its probes were measured
+        print(f"no results from {subnet_id}: {result}")
+        result = unknown_results(beacons)
     verified = {subnet_id: result}
     return verified
 
 
-def verify_routing(G=None, graph_key=None, output_key=None):
+def verify_routing(G=None, graph_key=None, output_key=None, scheduled=False):
     '''
     main function to run routing verification. graph can be loaded 3 ways:
      - provide a graph_key to load from the carve s3 bucket
@@ -97,6 +245,7 @@ def verify_routing(G=None, graph_key=None, output_key=None):
      - providing neither graph_key or graph_data will load most recently deployed graph from s3
     
     If output_key is provided, the graph will be saved to provided key in the carve s3 bucket
+    If scheduled is True, only the probes picked by the verification schedule are run
     '''
 
     # determine which graph to use
@@ -118,7 +267,11 @@ def verify_routing(G=None, graph_key=None, output_key=None):
     G.remove_edges_from(G.edges)
 
     # create a new graph with verified routes
-    R = add_routes(G)
+    previous = load_reachability_index()
+    R = add_routes(G, scheduled, previous)
+
+    # update the reachability query index from the verified graph
+    update_reachability_index(R, previous)
 
     if output_key != None:
         # set a name for the new graph and save to s3
@@ -0,0 +1,150 @@
+import json
+import os
+import time
+import zlib
+
+from aws import aws_put_direct, aws_read_s3_direct
+
+'''
+rotating slice verification scheduler
+
+the scheduled verification run of the carve lambda doesn't probe the whole probe plan every
+run. the probes are split into slices by a hash of (subnet, beacon), and each run probes one
+slice, so every probe runs within VerifyWindowMinutes (default 15) when runs are
+VerifyIntervalMinutes (default 1) apart. on top of its slice each run probes:
+ - priority probes: every probe that was down or changed state in the last
+   VerifyPriorityMinutes (default 60)
+ - backlog probes: probes of earlier slices cut by the VerifyProbeBudget (default 0, no
+   budget) limit on the number of slice probes per run
+probes that are not run keep their last verified state. the coverage report of a run lists
+the backlog and the slices that have not run within the window.
+
+schedule = {
+    'Down': [probe keys down at the last run],
+    'Priority': {probe key: epoch the priority expires},
+    'Backlog': [probe keys],
+    'Slices': {slice: epoch of the last run of the slice},
+    'Started': epoch the schedule was created
+}
+'''
+
+schedule_key = "managed_deployment/verify-schedule.json"
+
+
+def slice_count():
+    window = float(os.environ.get('VerifyWindowMinutes', 15))
+    interval = float(os.environ.get('VerifyIntervalMinutes', 1))
+    return max(1, int(window // interval))
+
+
+def probe_key(subnet, address):
+    return f"{subnet}|{address}"
+
+
+def probe_slice(key, slices):
+    return zlib.crc32(key.encode()) % slices
+
+
+def load_schedule():
+    data = aws_read_s3_direct(schedule_key)
+    if data is None:
+        return {'Down': [], 'Priority': {}, 'Backlog': [], 'Slices': {}, 'Started': int(time.time())}
+    return json.loads(data)
+
+
+def save_schedule(schedule):
+    aws_put_direct(json.dumps(schedule, sort_keys=True), schedule_key)
+
+
+def schedule_probes(probes, schedule, now=None):
+    '''
+    pick the probes of this run from the planned probes {subnet: [beacon addresses]}.
+    returns the probes to run {subnet: [addresses]}, the [[subnet, address]] probes skipped
+    and the coverage report of the run
+    '''
+    if now is None:
+        now = int(time.time())
+    slices = slice_count()
+    interval = float(os.environ.get('VerifyIntervalMinutes', 1)) * 60
+    current = int(now // interval) % slices
+    budget = int(os.environ.get('VerifyProbeBudget', 0))
+
+    priority = set([k for k, expires in schedule['Priority'].items() if expires > now])
+    backlog = set(schedule['Backlog'])
+
+    selected = {}
+    in_slice = []
+    skipped = []
+    for subnet, addresses in probes.items():
+        for address in addresses:
+            key = probe_key(subnet, address)
+            if key in priority:
+                selected.setdefault(subnet, []).append(address)
+            elif key in backlog or probe_slice(key, slices) == current:
+                in_slice.append((key not in backlog, key, subnet, address))
+            else:
+                skipped.append([subnet, address])
+
+    # backlog first, then the slice, up to the budget
+    in_slice.sort()
+    if budget > 0 and len(in_slice) > budget:
+        cut = in_slice[budget:]
+        in_slice = in_slice[:budget]
+    else:
+        cut = []
+    for _, key, subnet, address in in_slice:
+        selected.setdefault(subnet, []).append(address)
+    for _, key, subnet, address in cut:
+        skipped.append([subnet, address])
+
+    schedule['Backlog'] = [key for _, key, subnet, address in cut]
+    schedule['Slices'][str(current)] = now
+    window = slices * interval
+    started = schedule.setdefault('Started', now)
+    stale = [s for s in range(slices) if now - schedule['Slices'].get(str(s), started) > window]
+
+    coverage = {
+        'Slice': current,
+        'Slices': slices,
+        'Priority': len(priority),
+        'Probes': sum([len(a) for a in selected.values()]),
+        'Skipped': len(skipped),
+        'Backlog': len(schedule['Backlog']),
+        'StaleSlices': stale
+    }
+    print(f"verification schedule: {coverage}")
+    if len(stale) > 0 or len(cut) > 0:
+        print(f"coverage gap: {len(cut)} probes over budget, slices {stale} not run within {window / 60:.0f} minutes")
+    return selected, skipped, coverage
+
+
+def update_schedule(schedule, verified_routes, now=None):
+    '''
+    record the results {subnet: [{'beacon', 'result'}]} of a run. probes that are down or
+    changed state are prioritized for VerifyPriorityMinutes, and unknown probes are added
+    to the backlog of the next run
+    '''
+    if now is None:
+        now = int(time.time())
+    expires = now + float(os.environ.get('VerifyPriorityMinutes', 60)) * 60
+    previous = set(schedule['Down'])
+    down = set()
+    measured = set()
+    for subnet, results in verified_routes.items():
+        for result in results:
+            key = probe_key(subnet, result['beacon'])
+            if result['result'] == 'unknown':
+                if key not in schedule['Backlog']:
+                    schedule['Backlog'].append(key)
+                continue
+            measured.add(key)
+            if result['result'] == 'down':
+                down.add(key)
+
+    for key in down.union(measured.intersection(previous)):
+        # down now, or up after being down
+        schedule['Priority'][key] = expires
+    schedule['Priority'] = {k: e for k, e in schedule['Priority'].items() if e > now}
+    schedule['Down'] = sorted(down.union(previous - measured))
+    save_schedule(schedule)
+    return schedule